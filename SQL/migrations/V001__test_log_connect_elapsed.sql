@@ -0,0 +1,3 @@
+-- 测试表：新增连接时长，响应时长和传输时长不再包含建立连接的耗时
+alter table test_log
+  add column connect_elapsed decimal(8, 4) comment '连接时长' after website_url;
@@ -0,0 +1,14 @@
+-- 代理统计表，随 test_log 的写入增量汇总（按小时）
+-- 较早的按小时统计由 MySQLMapper.rollup_proxy_stats() 定期合并（作业 001 / 004），行数与代理数量成正比，不随历史增长
+create table proxy_stats (
+  proxy_url varchar(40) comment '代理URL',
+  test_hour datetime comment '测试时间（按小时截断）',
+  verification_ip boolean comment '是否验证了IP',
+  valid_response boolean comment '是否有效响应',
+  test_count int comment '测试次数',
+  response_elapsed_sum decimal(14, 4) comment '响应时长之和',
+  transfer_elapsed_sum decimal(14, 4) comment '传输时长之和',
+  timeout_exception_count int comment '超时次数',
+  proxy_exception_count int comment '代理异常次数',
+  primary key (proxy_url, test_hour, verification_ip, valid_response)
+);
@@ -0,0 +1,3 @@
+-- 测试表：db_mapper 中的查询均按 proxy_url 关联、按 test_time 过滤
+create index idx_test_log_proxy_url_test_time on test_log (proxy_url, test_time);
+create index idx_test_log_test_time on test_log (test_time);
@@ -0,0 +1,12 @@
+-- 响应内容表：按内容的 SHA-1 去重，content 为 zlib 压缩后的 UTF-8 文本
+create table response_content (
+  content_hash char(40) primary key comment '内容SHA-1',
+  content_size int comment '原始大小（字节）',
+  content mediumblob comment 'zlib压缩的内容',
+  first_seen datetime comment '首次出现时间'
+);
+
+-- 测试表：响应头和响应体的 SHA-1 ，对应 response_content.content_hash
+alter table test_log
+  add column response_head_hash char(40) comment '响应头SHA-1' after response_body,
+  add column response_body_hash char(40) comment '响应体SHA-1' after response_head_hash;
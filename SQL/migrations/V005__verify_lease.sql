@@ -0,0 +1,17 @@
+-- 验证租约表：分片验证的任务队列。同一轮次（run_name）、同一位置（local）的代理由多个 worker 按批领取，互不重叠；
+-- lease_expire 为空或已过期的未完成代理可以被（重新）领取
+create table verify_lease (
+  run_name varchar(64) comment '验证轮次',
+  local varchar(100) comment '验证位置',
+  proxy_url varchar(40) comment '代理URL',
+  ip varchar(16) comment '代理IP',
+  port int comment '代理端口',
+  protocol char(5) comment '代理协议',
+  collect_time datetime comment '入池时间',
+  worker varchar(100) comment '租约持有者',
+  lease_expire datetime comment '租约到期时间',
+  done boolean not null default 0 comment '是否已验证',
+  enqueue_time datetime comment '入队时间',
+  primary key (run_name, local, proxy_url),
+  index idx_verify_lease_claim (run_name, local, done, lease_expire)
+);
@@ -0,0 +1,880 @@
+import os, sys, json, math, time, random, logging, asyncio, threading, contextlib, tracemalloc
+from datetime import datetime as Datetime, timedelta as Timedelta
+from config import Config
+from models import Proxy, TestLog
+from database import MySQLOperation
+from db_mapper import MySQLMapper
+from migration import Migration
+from filter import SimpleProxyFilter, SimpleProxyTestFilter
+from handler import Handler, MySQLStreamInserter, MySQLTestLogInserter
+from iproxy import ProxyPool, ProxyPoolContext, ProxyLoader, FatezeroProxySpider, IPValidator, RedisProxyStore
+from server import ProxyServer
+from scheduler import ProxyScheduler
+from exporter import CsvExporter, JsonExporter, JsonLinesExporter
+from util import trim_margin
+
+
+class FakeProxyServer:
+    """本地模拟代理，在后台线程的事件循环中运行。
+
+    监听 0.0.0.0 ，因此 127.0.0.0/8 内的每个地址都相当于一个独立代理，同时也是回显IP的验证目标；
+    存活的代理在 latency + [0, jitter) 秒后回显被连接的IP（其后填充 body_size 字节）。
+    按IP固定，比例为 dead_rate 的代理从不响应（超时），比例为 error_rate 的代理立即断开连接（代理异常）。
+    """
+
+    def __init__(self, latency=0.1, dead_rate=0.0, port=0, body_size=0, error_rate=0.0, jitter=0.0):
+        self._latency = latency
+        self._dead_rate = dead_rate
+        self._error_rate = error_rate
+        self._jitter = jitter
+        self._body_size = body_size
+        self._port = port
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._port
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, '0.0.0.0', self._port, backlog=4096)
+            )
+            self._port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def proxies(self, num, protocol='http'):
+        ls = []
+        for i in range(1, num + 1):
+            proxy = Proxy()
+            proxy.ip = f'127.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+            proxy.port = self._port
+            proxy.protocol = protocol
+            proxy.proxy_url = ProxyLoader.proxy_url(proxy.ip, proxy.port, proxy.protocol)
+            proxy.local = Config.local
+            ls.append(proxy)
+        return ls
+
+    def status(self, ip) -> str:
+        """返回代理的状态：alive 、timeout 或 error 。"""
+        r = random.Random(ip).random()
+        if r < self._dead_rate:
+            return 'timeout'
+        elif r < self._dead_rate + self._error_rate:
+            return 'error'
+        return 'alive'
+
+    async def _handle(self, reader, writer):
+        ip = writer.get_extra_info('sockname')[0]
+        status = self.status(ip)
+        try:
+            while True:
+                await reader.readuntil(b'\r\n\r\n')
+                if status == 'timeout':
+                    await reader.read()
+                    return
+                if status == 'error':
+                    return
+                await asyncio.sleep(self._latency + random.random() * self._jitter)
+                body = ip.encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nConnection: keep-alive\r\n')
+                writer.write(f'Content-Length: {len(body) + self._body_size}\r\n\r\n'.encode() + body)
+                await writer.drain()
+                for i in range(0, self._body_size, 65536):
+                    writer.write(b' ' * min(65536, self._body_size - i))
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeProxyListServer:
+    """本地模拟的代理列表网站，以 proxylist.fatezero.org 的格式（每行一个 JSON）输出 proxies ，供 FatezeroProxySpider 下载。"""
+
+    def __init__(self, proxies, port=0):
+        self._proxies = proxies
+        self._port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._port}/proxy.list'
+
+    def start(self):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        lines = [json.dumps(dict(host=p.ip, port=p.port, type=p.protocol, anonymity='high_anonymous', country='CN')).encode() + b'\n' for p in self._proxies]
+
+        class ListHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.end_headers()
+                for i in range(0, len(lines), 1000):
+                    self.wfile.write(b''.join(lines[i:i + 1000]))
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self._port), ListHandler)
+        self._port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class StaticProxyLoader(ProxyLoader):
+    def __init__(self, proxies, context=None):
+        super().__init__(context)
+        self._proxylist = proxies
+
+    def load(self) -> list:
+        return list(self._proxylist)
+
+
+class CountingHandler(Handler):
+    def __init__(self, proxy_test_filter=None, context=None):
+        super().__init__(context)
+        self._proxy_test_filter = proxy_test_filter
+        self._lock = threading.Lock()
+        self.proxy_count = 0
+        self.test_log_count = 0
+        self.transfer_size = 0
+        self.proxy_exception_count = 0
+
+    def is_decided(self, proxy, test_logs, repeat):
+        if self._proxy_test_filter is None:
+            return len(test_logs) >= repeat
+        return self._proxy_test_filter.is_decided(proxy, test_logs, repeat)
+
+    def handle(self, data):
+        with self._lock:
+            self.proxy_count += 1
+            self.test_log_count += len(data['test_logs'])
+            self.transfer_size += sum([tl.transfer_size for tl in data['test_logs'] if tl])
+            self.proxy_exception_count += sum([1 for tl in data['test_logs'] if tl and tl.proxy_exception])
+
+    def close(self):
+        pass
+
+
+class TimedValidator:
+    """包装验证器，记录每次验证（包括超时和异常）的耗时。"""
+
+    def __init__(self, validator):
+        self._validator = validator
+        self._lock = threading.Lock()
+        self.elapsed = []
+
+    def __getattr__(self, name):
+        return getattr(self._validator, name)
+
+    def verify(self, proxy, session=None):
+        start = time.perf_counter()
+        try:
+            return self._validator.verify(proxy, session)
+        finally:
+            with self._lock:
+                self.elapsed.append(time.perf_counter() - start)
+
+    async def averify(self, proxy, session):
+        start = time.perf_counter()
+        try:
+            return await self._validator.averify(proxy, session)
+        finally:
+            self.elapsed.append(time.perf_counter() - start)
+
+
+class Benchmarks:
+    def start(self, names, out=None):
+        """依次运行基准。基准返回指标（dict）时，若指定 out ，则以 JSON Lines 追加到该文件，便于比较多次运行的结果。"""
+        methods = {n: getattr(self, f'bench_{n}', None) for n in names}
+        if None in methods.values():
+            missing = ', '.join([n for n, m in methods.items() if m is None])
+            print(f'There are missing benchmarks: {missing}')
+            return
+
+        for n, m in methods.items():
+            print(f'== {n} ==')
+            metrics = m()
+            if out and metrics:
+                with open(out, 'a', encoding='utf-8') as f:
+                    record = dict(name=n, time=Datetime.now().strftime('%Y-%m-%d %H:%M:%S'), metrics=metrics)
+                    f.write(json.dumps(record) + '\n')
+
+    def bench_pipeline(self, num=1000, latency=0.05, jitter=0.1, dead_rate=0.2, error_rate=0.2, timeout=0.5, concurrency=50, repeat=1):
+        """端到端的基准：FatezeroProxySpider 从模拟的列表网站流式下载代理，边下载边用 IPValidator 验证模拟代理。
+
+        模拟代理中 dead_rate 比例超时、error_rate 比例立即断开，其余在 latency + [0, jitter) 秒后响应。
+        报告 verify 与 averify 的代理/秒，以及每次验证耗时的 p50 / p99 。
+        启动方式：$ python benchmark.py start pipeline
+        """
+        server = FakeProxyServer(latency=latency, dead_rate=dead_rate, error_rate=error_rate, jitter=jitter).start()
+        proxies = server.proxies(num)
+        list_server = FakeProxyListServer(proxies).start()
+        alive = sum([1 for p in proxies if server.status(p.ip) == 'alive'])
+        plan = dict(website_name='benchmark', http_url='http://echo.benchmark/', https_url=None)
+
+        metrics = {}
+        for method, kwargs in (('verify', dict(concurrency=concurrency)), ('averify', dict(concurrency=num))):
+            spider = FatezeroProxySpider(num=num)
+            spider._POOL_URL = list_server.url
+            validator = TimedValidator(IPValidator(**plan, timeout=timeout))
+            handler = CountingHandler()
+            pool = ProxyPool()
+            start = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                getattr(pool, method)(validator=validator, handler=handler, repeat=repeat, proxies=pool.iter_load(spider), **kwargs)
+            elapsed = time.time() - start
+            p50, p99 = percentile(validator.elapsed, 50), percentile(validator.elapsed, 99)
+            print(f'{method:<8} {handler.proxy_count} proxies ({alive} alive) in {elapsed:.2f}s, {handler.proxy_count / elapsed:.1f} proxies/s, '
+                f'check p50 {p50 * 1000:.0f}ms, p99 {p99 * 1000:.0f}ms')
+            metrics[method] = dict(proxies=handler.proxy_count, seconds=round(elapsed, 3), proxies_per_second=round(handler.proxy_count / elapsed, 1),
+                p50_ms=round(p50 * 1000, 1), p99_ms=round(p99 * 1000, 1))
+
+        list_server.stop()
+        server.stop()
+        return metrics
+
+    def bench_verify(self, num=500, latency=0.1, dead_rate=0.5, timeout=1, concurrency=50):
+        """对比 ProxyPool.verify（线程池）与 ProxyPool.averify（asyncio）的吞吐量。
+
+        启动方式：$ python benchmark.py start verify
+        """
+        server = FakeProxyServer(latency=latency, dead_rate=dead_rate).start()
+        plan = dict(website_name='benchmark', http_url='http://echo.benchmark/', https_url=None)
+        validator = IPValidator(**plan, timeout=timeout)
+        pool = ProxyPool()
+        pool.load(StaticProxyLoader(server.proxies(num)))
+
+        runs = (
+            (f'verify(concurrency={concurrency})', pool.verify, dict(concurrency=concurrency, sleep=0)),
+            (f'averify(concurrency={num})', pool.averify, dict(concurrency=num, sleep=0)),
+        )
+        for name, method, kwargs in runs:
+            handler = CountingHandler()
+            start = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                method(validator=validator, handler=handler, repeat=1, **kwargs)
+            elapsed = time.time() - start
+            print(f'{name:<32} {handler.proxy_count} proxies in {elapsed:.2f}s, {handler.proxy_count / elapsed:.1f} proxies/s')
+
+        server.stop()
+
+    def bench_early_stop(self, num=500, latency=0.05, dead_rate=0.7, timeout=0.5, repeat=3):
+        """对比开启与关闭 early_stop 时实际执行的验证次数。
+
+        启动方式：$ python benchmark.py start early_stop
+        """
+        server = FakeProxyServer(latency=latency, dead_rate=dead_rate).start()
+        plan = dict(website_name='benchmark', http_url='http://echo.benchmark/', https_url=None)
+        validator = IPValidator(**plan, timeout=timeout)
+        ptf = SimpleProxyTestFilter(
+            timeout_exception_pr=0.34,
+            proxy_exception_pr=0.34,
+            valid_responses_pr=1,
+            pre_verification_ip=True,
+        )
+        pool = ProxyPool()
+        pool.load(StaticProxyLoader(server.proxies(num)))
+
+        for early_stop in (False, True):
+            handler = CountingHandler(proxy_test_filter=ptf)
+            start = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                pool.averify(validator=validator, handler=handler, repeat=repeat, concurrency=num, early_stop=early_stop)
+            elapsed = time.time() - start
+            print(f'early_stop={str(early_stop):<8} {handler.test_log_count} checks for {handler.proxy_count} proxies in {elapsed:.2f}s')
+
+        server.stop()
+
+    def bench_fanout(self, num=200, latency=0.1, dead_rate=0.5, timeout=0.5, concurrency=20):
+        """对比一个验证器重复 3 次与三个验证器（不同网站）各验证 1 次的耗时，两者的验证次数相同。
+
+        启动方式：$ python benchmark.py start fanout
+        """
+        server = FakeProxyServer(latency=latency, dead_rate=dead_rate).start()
+        validators = [IPValidator(website_name=f'benchmark-{i}', http_url='http://echo.benchmark/', https_url=None, timeout=timeout) for i in range(3)]
+        pool = ProxyPool()
+        pool.load(StaticProxyLoader(server.proxies(num)))
+
+        runs = (
+            ('1 validator x repeat=3', 'verify', validators[0], 3),
+            ('3 validators x repeat=1', 'verify', validators, 1),
+            ('1 validator x repeat=3', 'averify', validators[0], 3),
+            ('3 validators x repeat=1', 'averify', validators, 1),
+        )
+        for name, method, validator, repeat in runs:
+            handler = CountingHandler()
+            start = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                getattr(pool, method)(validator=validator, handler=handler, repeat=repeat, concurrency=concurrency, sleep=0, early_stop=False)
+            elapsed = time.time() - start
+            print(f'{method:<8} {name:<24} {handler.test_log_count} checks in {elapsed:.2f}s, {handler.proxy_count / elapsed:.1f} proxies/s')
+
+        server.stop()
+
+    def bench_scheduler(self, num=200, dead_rate=0.5, duration=30, budget=1200, base_interval=3, timeout=0.5):
+        """在相同的请求预算下运行常驻调度器，统计存活与失效代理各自得到的验证次数；
+        按固定周期全量验证时两者相同（按 dead_rate 分配）。
+
+        启动方式：$ python benchmark.py start scheduler
+        """
+        server = FakeProxyServer(latency=0.05, dead_rate=dead_rate).start()
+        plan = dict(website_name='benchmark', http_url='http://echo.benchmark/', https_url=None)
+        validator = IPValidator(**plan, timeout=timeout)
+        proxies = server.proxies(num)
+        dead = {p.proxy_url for p in proxies if random.Random(p.ip).random() < dead_rate}
+
+        class Recorder(Handler):
+            def __init__(self):
+                super().__init__()
+                self.checks = {}
+
+            def handle(self, data):
+                url = data['proxy'].proxy_url
+                self.checks[url] = self.checks.get(url, 0) + len(data['test_logs'])
+
+            def close(self):
+                pass
+
+        recorder = Recorder()
+        scheduler = ProxyScheduler(validator, recorder, budget=budget, concurrency=20, base_interval=base_interval)
+        scheduler.seed(proxies[:num // 2])
+        threading.Timer(duration / 3, lambda: scheduler.add(proxies[num // 2:])).start()
+        threading.Timer(duration, scheduler.stop).start()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            scheduler.run()
+        server.stop()
+
+        alive_checks = sum([n for url, n in recorder.checks.items() if url not in dead])
+        dead_checks = sum([n for url, n in recorder.checks.items() if url in dead])
+        total = alive_checks + dead_checks
+        print(f'{total} checks in {duration}s (budget {budget}/min, {budget * duration / 60:.0f} max)')
+        print(f'alive proxies ({num - len(dead)}): {alive_checks} checks, {alive_checks / total * 100:.0f}% (fixed cycle: {(1 - len(dead) / num) * 100:.0f}%)')
+        print(f'dead proxies  ({len(dead)}): {dead_checks} checks, {dead_checks / total * 100:.0f}%')
+        print(f'late proxies tested: {sum([1 for p in proxies[num // 2:] if p.proxy_url in recorder.checks])}/{num - num // 2}')
+
+    def bench_startup(self, runs=5):
+        """测量在新进程中导入 iproxy 的耗时，与同时导入 pandas 和 redis（即以前 iproxy 在加载时导入的依赖）对比。
+
+        启动方式：$ python benchmark.py start startup
+        """
+        import subprocess, statistics
+
+        for name, code in (('import iproxy', 'import iproxy'), ('import iproxy, pandas, redis', 'import iproxy, pandas, redis')):
+            elapsed = []
+            for _ in range(runs):
+                start = time.time()
+                subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+                elapsed.append(time.time() - start)
+            print(f'{name:<32} {statistics.median(elapsed) * 1000:.0f}ms (median of {runs})')
+
+    def bench_export(self, proxies=200000):
+        """对比 pandas.DataFrame.to_csv 与流式导出器的耗时和内存峰值。
+
+        启动方式：$ python benchmark.py start export
+        """
+        import tempfile, pandas
+
+        proxy_list = fake_proxies(proxies)
+        pool = ProxyPool()
+        pool.load(StaticProxyLoader(proxy_list))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            runs = (
+                ('pandas to_csv', 'proxies.csv', lambda fp: pandas.DataFrame(pool.to_naive()).to_csv(fp, encoding='utf-8')),
+                ('CsvExporter', 'proxies.csv', lambda fp: CsvExporter(fp).export(pool)),
+                ('JsonLinesExporter', 'proxies.jsonl', lambda fp: JsonLinesExporter(fp).export(pool)),
+                ('JsonLinesExporter (gzip)', 'proxies.jsonl.gz', lambda fp: JsonLinesExporter(fp).export(pool)),
+                ('json.dump (to_naive)', 'proxies.json', lambda fp: json.dump(pool.to_naive(), open(fp, 'w'), cls=ProxyPool.ModelJsonEncoder)),
+                ('JsonExporter', 'proxies.json', lambda fp: JsonExporter(fp).export(pool)),
+            )
+            for name, filename, export in runs:
+                fp = os.path.join(tmp, filename)
+                tracemalloc.start()
+                start = time.time()
+                export(fp)
+                elapsed = time.time() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print(f'{name:<28} {elapsed:.2f}s, peak {peak / 1024 / 1024:6.1f} MiB, {os.path.getsize(fp) / 1024 / 1024:.1f} MiB written')
+
+    def bench_redis(self, proxies=10000, reads=1000, top=10):
+        """对比整体 JSON（setex 一个键）与 RedisProxyStore 结构化存储的写入耗时，以及读取最好的 top 个代理的耗时。
+
+        优先使用 fakeredis（如已安装），否则连接本地的 redis-server（localhost:6379）。
+        启动方式：$ python benchmark.py start redis
+        """
+        try:
+            import fakeredis
+            client = fakeredis.FakeStrictRedis()
+        except ImportError:
+            import redis
+            client = redis.StrictRedis()
+        key = f'benchmark_{random.randrange(1 << 30)}'
+        proxy_list = fake_proxies(proxies)
+        scores = {p.proxy_url: random.random() * 5 for p in proxy_list}
+        pool = ProxyPool()
+        pool.load(StaticProxyLoader(proxy_list))
+
+        start = time.time()
+        client.set(f'{key}:blob', pool.to_jsons(), ex=600)
+        write_blob = time.time() - start
+        start = time.time()
+        for _ in range(reads):
+            best = sorted(json.loads(client.get(f'{key}:blob')), key=lambda p: scores[p['proxy_url']])[:top]
+        read_blob = (time.time() - start) / reads
+        print(f'{"json blob":<12} write {write_blob:.3f}s, read top {top} {read_blob * 1000:.2f}ms')
+
+        store = RedisProxyStore(client, key, ttl=600)
+        start = time.time()
+        for i in range(0, proxies, 500):
+            store.update([(p, scores[p.proxy_url]) for p in proxy_list[i:i + 500]])
+        write_store = time.time() - start
+        start = time.time()
+        for _ in range(reads):
+            result = store.top(top, 'http')
+        read_store = (time.time() - start) / reads
+        expected = sorted(scores, key=scores.get)[:top]
+        print(f'{"structured":<12} write {write_store:.3f}s, read top {top} {read_store * 1000:.2f}ms, '
+            f'correct: {[p["proxy_url"] for p in result] == expected == [p["proxy_url"] for p in best]}')
+
+        expired = RedisProxyStore(client, key, ttl=-1)
+        expired.update([(proxy_list[0], 0)])
+        print(f'{"expiry":<12} expired proxy purged: {proxy_list[0].proxy_url not in [p["proxy_url"] for p in store.top(top)]}')
+
+        store.remove([p.proxy_url for p in proxy_list])
+        client.delete(f'{key}:blob', f'{key}:all', f'{key}:protocols', f'{key}:expire', f'{key}:protocol:http')
+
+    def bench_server(self, proxies=10000, requests=20000, concurrency=50):
+        """在子进程中启动 ProxyServer（单核），测量 GET /proxy 和 GET /proxies 的吞吐量和延迟。
+
+        启动方式：$ python benchmark.py start server
+        """
+        import aiohttp, multiprocessing
+
+        port = 18000 + random.randrange(1000)
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_proxy_server, args=(port, proxies, ready), daemon=True)
+        process.start()
+        ready.wait()
+
+        async def run(path):
+            latencies = []
+            connector = aiohttp.TCPConnector(limit=concurrency)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                async def worker(n):
+                    for _ in range(n):
+                        start = time.perf_counter()
+                        async with session.get(f'http://127.0.0.1:{port}{path}') as response:
+                            await response.read()
+                        latencies.append(time.perf_counter() - start)
+
+                start = time.time()
+                await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+                return time.time() - start, sorted(latencies)
+
+        for path in ('/proxy', '/proxy?protocol=http&local=' + Config.local, '/proxies?num=10'):
+            elapsed, latencies = asyncio.run(run(path))
+            p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+            print(f'{path:<32} {len(latencies) / elapsed:.0f} requests/s, p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms')
+
+        process.terminate()
+        process.join()
+
+    def bench_rate_limit(self, num=100, latency=0.05, concurrency=10, rate_limit=50):
+        """对比每个任务 sleep=1 与按网站的令牌桶限速（rate_limit 次/秒）实际达到的请求速率。
+
+        启动方式：$ python benchmark.py start rate_limit
+        """
+        server = FakeProxyServer(latency=latency).start()
+        pool = ProxyPool()
+        pool.load(StaticProxyLoader(server.proxies(num)))
+
+        runs = (
+            ('sleep=1', dict(website_name='benchmark-sleep', http_url='http://echo.benchmark/', https_url=None), 1),
+            (f'rate_limit={rate_limit}', dict(website_name='benchmark-bucket', http_url='http://echo.benchmark/', https_url=None, rate_limit=rate_limit, burst=5), 0),
+        )
+        for name, plan, sleep in runs:
+            handler = CountingHandler()
+            start = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                pool.verify(validator=IPValidator(**plan, timeout=1), handler=handler, concurrency=concurrency, sleep=sleep)
+            elapsed = time.time() - start
+            print(f'{name:<20} {handler.test_log_count} requests in {elapsed:.2f}s, {handler.test_log_count / elapsed:.1f} requests/s')
+
+        server.stop()
+
+    def bench_large_response(self, num=100, body_size=4 * 1024 * 1024, timeout=5, concurrency=10):
+        """代理返回 body_size 字节的页面时，对比完整读取与限量、提前匹配读取的耗时和读取量。
+
+        启动方式：$ python benchmark.py start large_response
+        """
+        server = FakeProxyServer(latency=0, body_size=body_size).start()
+        plan = dict(website_name='benchmark', http_url='http://echo.benchmark/', https_url=None)
+        pool = ProxyPool()
+        pool.load(StaticProxyLoader(server.proxies(num)))
+
+        runs = (
+            ('full read', IPValidator(**plan, timeout=timeout, max_bytes=None, early_match=False)),
+            ('max_bytes=64KiB', IPValidator(**plan, timeout=timeout, max_bytes=64 * 1024, early_match=False)),
+            ('early_match', IPValidator(**plan, timeout=timeout)),
+        )
+        for name, validator in runs:
+            handler = CountingHandler()
+            tracemalloc.start()
+            start = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                pool.verify(validator=validator, handler=handler, concurrency=concurrency, sleep=0)
+            elapsed = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'{name:<20} {elapsed:.2f}s, {handler.transfer_size / handler.proxy_count / 1024:.1f} KiB/check, '
+                f'peak {peak / 1024 / 1024:.1f} MiB, {handler.proxy_exception_count} proxy exceptions')
+
+        server.stop()
+
+    def bench_batch_insert(self, rows=20000, batch_size=500, body_size=2048):
+        """对比 MySQLOperation.batch_insert 各方式写入 TestLog 的速度（行/秒）。
+
+        需要可用的 MySQL ，基准在同一服务器的 `<Config.database.db>_benchmark` 库中进行，
+        load_data 方式还需要服务端开启 local_infile 。
+        启动方式：$ python benchmark.py start batch_insert
+        """
+        test_logs = fake_test_logs(rows, body_size)
+
+        with benchmark_database():
+            for method in ('sql', 'executemany', 'load_data'):
+                MySQLOperation.execute('truncate table test_log;')
+                start = time.time()
+                for i in range(0, rows, batch_size):
+                    MySQLOperation.batch_insert(test_logs[i:i + batch_size], method=method)
+                elapsed = time.time() - start
+                print(f'{method:<16} {rows} rows in {elapsed:.2f}s, {rows / elapsed:.0f} rows/s (batch_size={batch_size})')
+
+    def bench_metrics(self, ops=200000, num=1000, latency=0.02, concurrency=50):
+        """指标的开销：单次记录的耗时，以及 verify 在每个代理都报告进度（report_every=1）与每 100 个报告一次时的吞吐量。
+        最后打印本次运行收集到的各阶段耗时和验证耗时（p50 / p99 按分桶估计）。
+
+        启动方式：$ python benchmark.py start metrics
+        """
+        from metrics import REGISTRY, Histogram, Counter
+
+        histogram, counter = Histogram('bench_seconds', labelnames=('website',)), Counter('bench_total', labelnames=('website',))
+        for name, record in (('Histogram.observe', lambda: histogram.observe(0.1, website='benchmark')), ('Counter.inc', lambda: counter.inc(website='benchmark'))):
+            start = time.perf_counter()
+            for _ in range(ops):
+                record()
+            print(f'{name:<20} {(time.perf_counter() - start) / ops * 1e9:.0f}ns/op')
+
+        server = FakeProxyServer(latency=latency).start()
+        plan = dict(website_name='benchmark', http_url='http://echo.benchmark/', https_url=None)
+        validator = IPValidator(**plan, timeout=1)
+        pool = ProxyPool(context=ProxyPoolContext('benchmark', logger=logging.getLogger('benchmark')))
+        pool.load(StaticProxyLoader(server.proxies(num)))
+        for report_every in (1, 100):
+            handler = CountingHandler()
+            start = time.time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                pool.verify(validator=validator, handler=handler, concurrency=concurrency, report_every=report_every)
+            elapsed = time.time() - start
+            print(f'report_every={report_every:<4} {handler.proxy_count / elapsed:.1f} proxies/s')
+        server.stop()
+
+        snapshot = REGISTRY.snapshot()
+        for name in ('proxy_pipeline_stage_seconds', 'validator_check_seconds'):
+            for sample in snapshot[name]:
+                print(f"{name}{sample['labels']} count={sample['count']} p50<={sample['p50']} p99<={sample['p99']}")
+
+    def bench_stream_insert(self, rows=20000, buffer_size=500, concurrency=4, body_size=2048):
+        """MySQLStreamInserter（代理）和 MySQLTestLogInserter（测试日志与 proxy_stats）的流式写入速度（行/秒）。
+
+        需要可用的 MySQL ，基准在 `<Config.database.db>_benchmark` 库中进行。
+        启动方式：$ python benchmark.py start stream_insert
+        """
+        proxies = fake_proxies(rows // 10)
+        test_logs = fake_test_logs(rows, body_size, proxies)
+
+        metrics = {}
+        with benchmark_database():
+            runs = (
+                ('MySQLStreamInserter', proxies, lambda: MySQLStreamInserter(buffer_size, concurrency, upsert=True)),
+                ('MySQLTestLogInserter', test_logs, lambda: MySQLTestLogInserter(buffer_size, concurrency, capture='zlib')),
+            )
+            for name, data, new_handler in runs:
+                handler = new_handler()
+                start = time.time()
+                for entity in data:
+                    handler.handle(entity)
+                handler.close()
+                elapsed = time.time() - start
+                print(f'{name:<24} {len(data)} rows in {elapsed:.2f}s, {len(data) / elapsed:.0f} rows/s, {handler.stats()}')
+                metrics[name] = dict(rows=len(data), seconds=round(elapsed, 3), rows_per_second=round(len(data) / elapsed))
+        return metrics
+
+    def bench_find_proxies(self, proxies=20000, rows=2000000, days=60, batch_size=20000, insert_method='load_data'):
+        """在生成的数据集上测量 MySQLMapper.find_proxies 的耗时：无索引、有索引、按月分区，以及 find_proxies_by_stats 。
+
+        需要可用的 MySQL ，数据生成在 `<Config.database.db>_benchmark` 库中，结束后删除。
+        启动方式：$ python benchmark.py start find_proxies
+        """
+        ptf = SimpleProxyTestFilter(
+            response_elapsed_mean=6,
+            transfer_elapsed_mean=10,
+            timeout_exception_pr=0.34,
+            proxy_exception_pr=0.34,
+            valid_responses_pr=1,
+            pre_tested_timedelta=Timedelta(days=1),
+            pre_verification_ip=True,
+        )
+        pf_cond, ptf_cond = {}, ptf._conditions
+
+        def timed(name, find_proxies):
+            start = time.time()
+            result = find_proxies(pf_cond, ptf_cond, Proxy._fields)
+            print(f'{name:<40} {time.time() - start:.3f}s, {len(result)} proxies')
+
+        with benchmark_database() as migration:
+            indexes = next(path for v, _, path in migration.migrations() if v == 3)
+            MySQLOperation.execute('drop index idx_test_log_proxy_url_test_time on test_log;')
+            MySQLOperation.execute('drop index idx_test_log_test_time on test_log;')
+            start = time.time()
+            proxy_list = fake_proxies(proxies)
+            for i in range(0, proxies, batch_size):
+                MySQLOperation.batch_insert(proxy_list[i:i + batch_size], method=insert_method)
+            for i in range(0, rows, batch_size):
+                MySQLOperation.batch_insert(fake_test_logs(min(batch_size, rows - i), 64, proxy_list, days), method=insert_method)
+            print(f'{"generate":<40} {time.time() - start:.3f}s, {proxies} proxies, {rows} test logs')
+
+            timed('find_proxies (no index)', MySQLMapper.find_proxies)
+            migration.execute_script(indexes)
+            timed('find_proxies (indexes)', MySQLMapper.find_proxies)
+            migration.partition_test_log()
+            timed('find_proxies (indexes, partitions)', MySQLMapper.find_proxies)
+            MySQLMapper.rebuild_proxy_stats()
+            timed('find_proxies_by_stats', MySQLMapper.find_proxies_by_stats)
+
+    def bench_assess_batch(self, proxies=100000, rows=1000000, days=2):
+        """对比逐个代理调用 SimpleProxyTestFilter.assess 与一次性调用 assess_batch 的耗时，并核对两者结果一致。
+
+        启动方式：$ python benchmark.py start assess_batch
+        """
+        proxy_list = fake_proxies(proxies)
+        test_logs = fake_test_logs(rows, 256, proxy_list, days)
+        ptf = SimpleProxyTestFilter(
+            proxy_filter=SimpleProxyFilter(protocol_list=['http', 'https']),
+            response_elapsed_mean=2.5,
+            transfer_elapsed_mean=4,
+            timeout_exception_pr=0.5,
+            proxy_exception_pr=0.5,
+            valid_responses_pr=0.5,
+            # 时间窗口覆盖全部测试日志，避免两次评估之间的时间推移造成边界上的差异
+            pre_tested_timedelta=Timedelta(days=days + 1),
+            pre_verification_ip=True,
+        )
+
+        start = time.time()
+        grouped = {}
+        for tl in test_logs:
+            grouped.setdefault(tl.proxy_url, []).append(tl)
+        expected = [ptf.assess(p, grouped.get(p.proxy_url, [])) for p in proxy_list]
+        elapsed = time.time() - start
+        print(f'{"assess (per proxy)":<24} {elapsed:.2f}s, {sum(expected)} passed')
+
+        start = time.time()
+        result = ptf.assess_batch(proxy_list, test_logs)
+        elapsed = time.time() - start
+        print(f'{"assess_batch":<24} {elapsed:.2f}s, {sum(result)} passed, identical: {result == expected}')
+
+    def bench_capture(self, rows=15000, proxies=5000, body_size=2048):
+        """对比 MySQLTestLogInserter 各 capture 方式写入 test_log 和 response_content 的数据量（不需要 MySQL）。
+
+        模拟 5000 个代理各验证 3 次，响应体只在包含的 IP 上有所不同。
+        启动方式：$ python benchmark.py start capture
+        """
+        proxy_list = fake_proxies(proxies)
+        test_logs = fake_test_logs(rows, body_size, proxy_list)
+        for tl in test_logs:
+            tl.response_body = tl.response_body.replace('127.0.0.1', tl.proxy_url[7:-5])
+
+        def size(entities):
+            params = [v for e in entities for _, v in e]
+            return sum([len(v.encode('utf-8')) if isinstance(v, str) else len(v) if isinstance(v, bytes) else 8 for v in params if v is not None])
+
+        baseline = None
+        for capture in MySQLTestLogInserter._CAPTURE_MODES:
+            inserter = MySQLTestLogInserter(buffer_size=rows, concurrency=1, capture=capture)
+            start = time.time()
+            captured, contents = inserter.capture(test_logs)
+            elapsed = time.time() - start
+            inserter.close()
+            total = size(captured) + size(contents.values())
+            baseline = baseline or total
+            print(f'{capture:<12} {total / 1024 / 1024:8.2f} MiB ({baseline / total:5.1f}x), {len(contents)} contents, capture {elapsed:.2f}s')
+
+    def bench_model(self, rows=100000):
+        """测量由数据行构造 TestLog 的速度，以及每个实例的内存占用。
+
+        启动方式：$ python benchmark.py start model
+        """
+        fields = TestLog._fields
+        row = tuple(range(len(fields)))
+
+        def by_setattr():
+            entity = TestLog()
+            for field, value in zip(fields, row):
+                setattr(entity, field, value)
+            return entity
+
+        runs = (
+            ('TestLog() + setattr', by_setattr),
+            ('TestLog.from_row(row)', lambda: TestLog.from_row(row)),
+        )
+        for name, build in runs:
+            start = time.time()
+            entities = [build() for _ in range(rows)]
+            elapsed = time.time() - start
+            print(f'{name:<24} {rows / elapsed:.0f} rows/s')
+            del entities
+
+        tracemalloc.start()
+        entities = [TestLog.from_row(row) for _ in range(rows)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{"memory":<24} {size / len(entities):.0f} bytes/row')
+
+
+def run_proxy_server(port, proxies, ready):
+    """bench_server 的子进程：以随机的平均响应时长加载 proxies 个模拟代理并启动 ProxyServer 。"""
+    from aiohttp import web
+
+    proxy_list = fake_proxies(proxies)
+    server = ProxyServer(loader=None, port=port, refresh_interval=None)
+    server.update(proxy_list, {p.proxy_url: random.random() * 5 for p in proxy_list})
+
+    async def start():
+        runner = web.AppRunner(server.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(start())
+
+
+@contextlib.contextmanager
+def benchmark_database(version=None):
+    """在 `<Config.database.db>_benchmark` 库中建表并执行迁移（至 version），期间 MySQLOperation 连接该库，结束后删除该库。"""
+    database = Config.database
+    bench_db = f"{database['db']}_benchmark"
+
+    Config.database = dict(database, local_infile=True)
+    MySQLOperation.init_pool()
+    try:
+        MySQLOperation.execute(f'drop database if exists {bench_db};')
+        MySQLOperation.execute(f'create database {bench_db} character set utf8mb4;')
+        MySQLOperation.close_pool()
+
+        Config.database = dict(database, db=bench_db, local_infile=True)
+        MySQLOperation.init_pool()
+        migration = Migration()
+        migration.execute_script(os.path.join(Migration._SQL_DIR, 'create_tables.sql'))
+        migration.upgrade(version)
+        yield migration
+        MySQLOperation.execute(f'drop database {bench_db};')
+    finally:
+        MySQLOperation.close_pool()
+        Config.database = database
+
+
+def percentile(values, p):
+    """最近秩法的百分位数，values 为空时返回 0 。"""
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def fake_proxies(num):
+    now = Datetime.now()
+    ls = []
+    for i in range(num):
+        proxy = Proxy()
+        proxy.ip = f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}'
+        proxy.port = 8080
+        proxy.protocol = 'http'
+        proxy.proxy_url = ProxyLoader.proxy_url(proxy.ip, proxy.port, proxy.protocol)
+        proxy.local = Config.local
+        proxy.collect_time = now
+        ls.append(proxy)
+    return ls
+
+
+def fake_test_logs(num, body_size=2048, proxies=None, days=0):
+    """生成 num 条 TestLog 。指定 proxies 时从中随机挑选代理，test_time 随机分布在最近 days 天内。"""
+    body = ('<p class="ip">127.0.0.1</p>\n\t\'"\\ ' * (body_size // 32 + 1))[:body_size]
+    now = Datetime.now().replace(microsecond=0)
+    ls = []
+    for i in range(num):
+        valid = random.random() < 0.6
+        tl = TestLog()
+        tl.proxy_url = random.choice(proxies).proxy_url if proxies else f'http://127.0.{i >> 8 & 255}.{i & 255}:8080'
+        tl.website_name = 'benchmark'
+        tl.website_url = 'http://echo.benchmark/'
+        tl.connect_elapsed = 0.1
+        tl.response_elapsed = round(random.random() * 5, 4) if valid else 0
+        tl.transfer_elapsed = round(random.random() * 8, 4) if valid else 0
+        tl.transfer_size = body_size if valid else 0
+        tl.timeout_exception = not valid
+        tl.proxy_exception = valid and random.random() < 0.1
+        tl.test_time = now - Timedelta(seconds=random.randint(0, days * 86400)) if days else now
+        tl.job_time = tl.test_time
+        tl.verification_ip = True
+        tl.response_head = "{'Content-Type': 'text/html'}"
+        tl.response_body = body
+        ls.append(tl)
+    return ls
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(trim_margin('''
+        |Example:
+        |  $ python benchmark.py start name
+        |  $ python benchmark.py start name1 name2 name3 ...
+        |  $ python benchmark.py start name1 name2 --out results.jsonl
+        '''))
+    elif sys.argv[1] == 'start':
+        names, out = sys.argv[2:], None
+        if '--out' in names:
+            i = names.index('--out')
+            names, out = names[:i] + names[i + 2:], names[i + 1]
+        Benchmarks().start(names, out)
@@ -29,3 +29,12 @@ class Config:
         # 可选。指定日志文件的绝对路径。
         'path': 'D:/temp/proxy_pool/job.log',
     }
+
+    # 可选。指定指标（见 metrics.py）的输出方式，均不设置时只在进程内收集。
+    metrics = {
+        # 可选。在该端口提供 /metrics（Prometheus 文本）和 /metrics.json 。
+        'port': None,
+        # 可选。每隔 snapshot_interval 秒将快照追加到该文件（JSON Lines）。
+        'snapshot_path': None,
+        'snapshot_interval': 60,
+    }
@@ -1,11 +1,26 @@
-from models import Model
+from models import Model, BytesField
 from config import Config
+from datetime import datetime as Datetime
 
+import os
+import time
+import tempfile
+import threading
 import pymysql
+from contextlib import contextmanager
 from dbutils.pooled_db import PooledDB
+from metrics import REGISTRY
+
+
+_POOL_CONNECTIONS = REGISTRY.gauge('mysql_pool_connections', 'Connections of the MySQL pool by state (in_use, idle).', ('state',))
+_BATCH_INSERT_SECONDS = REGISTRY.histogram('mysql_batch_insert_seconds', 'Duration of successful MySQLOperation.batch_insert() calls.', ('method',))
+_BATCH_INSERT_ROWS = REGISTRY.counter('mysql_batch_insert_rows_total', 'Rows written by MySQLOperation.batch_insert().', ('method',))
 
 class MySQLOperation:
     _POOL: PooledDB = None
+    _LOCAL = threading.local()
+    # 连接失败/断开、连接数过多、锁等待超时、死锁
+    _TRANSIENT_ERROR_CODES = (1040, 1205, 1213, 2003, 2006, 2013)
 
     @staticmethod
     def init_pool():
@@ -16,80 +31,268 @@ class MySQLOperation:
     def close_pool():
         if MySQLOperation._POOL:
             MySQLOperation._POOL.close()
+            MySQLOperation._POOL = None
+
+    @staticmethod
+    @contextmanager
+    def transaction():
+        """在当前线程中开启事务，with 块内的 execute()、executemany()、query() 共用同一个连接，
+        正常退出时提交，发生异常时回滚。"""
+        if getattr(MySQLOperation._LOCAL, 'connect', None) is not None:
+            yield
+            return
+
+        connect = MySQLOperation._POOL.connection()
+        MySQLOperation._LOCAL.connect = connect
+        try:
+            yield
+            connect.commit()
+        except:
+            connect.rollback()
+            raise
+        finally:
+            MySQLOperation._LOCAL.connect = None
+            connect.close()
 
     @staticmethod
-    def insert(entity:Model) -> bool:
+    def insert(entity:Model, upsert:bool=False) -> bool:
         table = MySQLOperation.table_name(entity)
         fields = MySQLOperation.fields_substament(entity)
-        values = MySQLOperation.__values_substament(entity)
+        placeholders = MySQLOperation.placeholders_substament(entity)
+        params = MySQLOperation.__values_params(entity)
+        on_duplicate = MySQLOperation.on_duplicate_substament(entity) if upsert else ''
 
-        row_num = MySQLOperation.execute(f'insert into {table}({fields}) \nvalues ({values});')
+        row_num = MySQLOperation.execute(f'insert into {table}({fields}) \nvalues ({placeholders}){on_duplicate};', params)
         return row_num > 0
 
     @staticmethod
-    def batch_insert(entity_list:list) -> int:
+    def batch_insert(entity_list:list, method:str='executemany', upsert:bool=False) -> int:
+        """批量插入。
+
+        upsert 为 True 时，主键或唯一键重复的记录改为更新（insert ... on duplicate key update），
+        主键和 immutable 字段保持原值；load_data 方式先导入临时表，再以同样的语句合并。重复的记录不会导致整批失败。
+
+        method 的有效值：
+        * executemany ：参数化插入，由 pymysql 负责转义并合并为多行 insert 语句（默认）。
+        * load_data ：写入临时文件后使用 LOAD DATA LOCAL INFILE 导入，适合大批量数据，
+          需要在 Config.database 中设置 local_infile=True 并在服务端开启 local_infile 。
+        * sql ：使用 Field.to_sql 拼接 SQL 语句（旧方式）。
+        """
+        if not entity_list:
+            return
+        start = time.perf_counter()
+        row_num = MySQLOperation.__batch_insert(entity_list, method, upsert)
+        _BATCH_INSERT_SECONDS.observe(time.perf_counter() - start, method=method)
+        _BATCH_INSERT_ROWS.inc(len(entity_list), method=method)
+        return row_num
+
+    @staticmethod
+    def __batch_insert(entity_list:list, method:str, upsert:bool) -> int:
+        if method == 'executemany':
+            table = MySQLOperation.table_name(entity_list[0])
+            fields = MySQLOperation.fields_substament(entity_list[0])
+            placeholders = MySQLOperation.placeholders_substament(entity_list[0])
+            params_list = [MySQLOperation.__values_params(entity) for entity in entity_list]
+            on_duplicate = MySQLOperation.on_duplicate_substament(entity_list[0]) if upsert else ''
+            return MySQLOperation.executemany(f'insert into {table}({fields}) \nvalues ({placeholders}){on_duplicate};', params_list)
+        elif method == 'load_data':
+            return MySQLOperation.load_data(entity_list, upsert=upsert)
+        elif method == 'sql':
+            table = MySQLOperation.table_name(entity_list[0])
+            fields = MySQLOperation.fields_substament(entity_list[0])
+            values_list = [MySQLOperation.__values_substament(entity) for entity in entity_list]
+            mult_values = '\n, '.join(map(lambda values: '({})'.format(values), values_list))
+            on_duplicate = MySQLOperation.on_duplicate_substament(entity_list[0]) if upsert else ''
+            return MySQLOperation.execute(f'insert into {table}({fields}) \nvalues {mult_values}{on_duplicate};')
+        raise ValueError(f'Unsupported batch insert method "{method}".')
+
+    @staticmethod
+    def load_data(entity_list:list, replace:bool=False, upsert:bool=False) -> int:
+        """使用 LOAD DATA LOCAL INFILE 导入。replace 为 True 时主键重复的记录被整行替换；
+        upsert 为 True 时先导入临时表，再按 on_duplicate_substament() 合并（保留主键和 immutable 字段的原值）。"""
         if not entity_list:
             return
         table = MySQLOperation.table_name(entity_list[0])
         fields = MySQLOperation.fields_substament(entity_list[0])
-        values_list = [MySQLOperation.__values_substament(entity) for entity in entity_list]
-        mult_values = '\n, '.join(map(lambda values: '({})'.format(values), values_list))
-        
-        return MySQLOperation.execute(f'insert into {table}({fields}) \nvalues {mult_values};')
+
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv', delete=False) as f:
+            for entity in entity_list:
+                values = map(MySQLOperation.__tsv_value, MySQLOperation.__values_params(entity))
+                f.write('\t'.join(values) + '\n')
+        try:
+            if not upsert:
+                return MySQLOperation.__load_data_file(f.name, table, entity_list[0], replace)
+
+            # 临时表只属于当前连接，在同一事务（连接）中导入和合并；只复制列定义，不复制分区和索引
+            staging = f'{table}_staging'
+            with MySQLOperation.transaction():
+                MySQLOperation.execute(f'drop temporary table if exists {staging};')
+                MySQLOperation.execute(f'create temporary table {staging} select {fields} from {table} where 1 = 0;')
+                MySQLOperation.__load_data_file(f.name, staging, entity_list[0], False)
+                on_duplicate = MySQLOperation.on_duplicate_substament(entity_list[0])
+                row_num = MySQLOperation.execute(f'insert into {table}({fields}) \nselect {fields} from {staging}{on_duplicate};')
+                MySQLOperation.execute(f'drop temporary table {staging};')
+                return row_num
+        finally:
+            os.remove(f.name)
+
+    @staticmethod
+    def __load_data_file(path:str, table:str, entity, replace:bool) -> int:
+        """BytesField 在文件中是十六进制文本，读入用户变量后以 unhex() 还原。"""
+        metadata = entity._metadata
+        bytes_fields = [fn for fn in entity._fields if isinstance(metadata[fn], BytesField)]
+        columns = ', '.join([f'@{fn}' if fn in bytes_fields else fn for fn in entity._fields])
+        return MySQLOperation.execute('\n'.join((
+            f"load data local infile %s {'replace ' if replace else ''}into table {table} character set utf8mb4",
+            f"fields terminated by '\\t' escaped by '\\\\'",
+            f"lines terminated by '\\n'",
+            f"({columns})",
+            f"set {', '.join([f'{fn} = unhex(@{fn})' for fn in bytes_fields])};" if bytes_fields else ";",
+        )), (path,))
 
     @staticmethod
     def select_all(_type:type) -> list:
         if not isinstance(_type, type) or not issubclass(_type, Model):
             raise TypeError('Parameter "_type" must be a Model subtype')
 
-        entity = _type()
-        table = MySQLOperation.table_name(entity)
-        fields = MySQLOperation.fields_substament(entity)
+        table = MySQLOperation.table_name(_type)
+        fields = MySQLOperation.fields_substament(_type)
         return MySQLOperation.query(f'select {fields} from {table};', _type)
 
     @staticmethod
-    def execute(sql:str) -> int:
+    def execute(sql:str, params=None) -> int:
         row_num = 0
-        connect = MySQLOperation._POOL.connection()
+        connect, autocommit = MySQLOperation.__connection()
         with connect.cursor() as cursor:
-            row_num = cursor.execute(sql)
-            connect.commit()
-        connect.close()
+            row_num = cursor.execute(sql, params)
+            if autocommit: connect.commit()
+        if autocommit: connect.close()
         return row_num
 
+    @staticmethod
+    def executemany(sql:str, params_list:list) -> int:
+        row_num = 0
+        connect, autocommit = MySQLOperation.__connection()
+        with connect.cursor() as cursor:
+            row_num = cursor.executemany(sql, params_list)
+            if autocommit: connect.commit()
+        if autocommit: connect.close()
+        return row_num
+
+    @staticmethod
+    def fetchall(sql:str, params=None) -> tuple:
+        """执行查询并返回原始的数据行。"""
+        connect, autocommit = MySQLOperation.__connection()
+        with connect.cursor() as cursor:
+            cursor.execute(sql, params)
+            data = cursor.fetchall() or tuple()
+        if autocommit: MySQLOperation.__end_read(connect)
+        return data
+
     @staticmethod
     def query(sql:str, _type:type) -> list:
         if not isinstance(_type, type) or not issubclass(_type, Model):
             raise TypeError('Parameter "_type" must be a Model subtype')
 
         result = []
-        fields = _type()._metadata.keys()
-        connect = MySQLOperation._POOL.connection()
+        connect, autocommit = MySQLOperation.__connection()
         with connect.cursor() as cursor:
             cursor.execute(sql)
             data = cursor.fetchall()
-            cols = {d[0]: i for i, d in enumerate(cursor.description) if d[0] in fields}
-            
             if not data: data = tuple()
-            for row in data:
-                entity = _type()
-                for col, i in cols.items():
-                    setattr(entity, col, row[i])
-                result.append(entity)
 
-        connect.close()
+            to_entity = MySQLOperation.__entity_factory(cursor.description, _type)
+            result = [to_entity(row) for row in data]
+
+        if autocommit: MySQLOperation.__end_read(connect)
         return result
 
     @staticmethod
-    def table_name(entity:Model) -> str:
-        ls = list(entity.__class__.__name__)
+    def iter_query(sql:str, _type:type, chunk_size:int=1000, net_write_timeout:int=3600):
+        """query() 的流式版本，基于服务端游标（SSCursor）每次读取 chunk_size 行，逐个产出实体。
+
+        内存占用与结果集大小无关。提前结束迭代时，剩余的结果会在关闭游标时被读取并丢弃。
+        迭代期间服务端一直在等待客户端读取：两次读取之间的间隔超过 net_write_timeout 秒时，服务端会断开连接，
+        因此本次会话的 net_write_timeout 被调高为该参数（默认 1 小时，MySQL 的默认值只有 60 秒），
+        迭代结束后恢复为全局值。消费者（如逐个验证代理）可能停顿更久时，应调大该参数或改用 query() 。
+        """
+        if not isinstance(_type, type) or not issubclass(_type, Model):
+            raise TypeError('Parameter "_type" must be a Model subtype')
+
+        connect = MySQLOperation._POOL.connection()
+        try:
+            with connect.cursor() as cursor:
+                cursor.execute('set session net_write_timeout = %s;', (net_write_timeout,))
+            with connect.cursor(pymysql.cursors.SSCursor) as cursor:
+                cursor.execute(sql)
+                to_entity = MySQLOperation.__entity_factory(cursor.description, _type)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield to_entity(row)
+        finally:
+            # 连接会回到连接池，恢复会话变量并结束读事务；连接已断开时由连接池丢弃，无需恢复
+            try:
+                with connect.cursor() as cursor:
+                    cursor.execute('set session net_write_timeout = default;')
+                connect.commit()
+            except pymysql.err.Error:
+                pass
+            connect.close()
+
+    @staticmethod
+    def iter_select_all(_type:type, chunk_size:int=1000, net_write_timeout:int=3600):
+        if not isinstance(_type, type) or not issubclass(_type, Model):
+            raise TypeError('Parameter "_type" must be a Model subtype')
+
+        table = MySQLOperation.table_name(_type)
+        fields = MySQLOperation.fields_substament(_type)
+        return MySQLOperation.iter_query(f'select {fields} from {table};', _type, chunk_size, net_write_timeout)
+
+    @staticmethod
+    def classify_error(e:Exception) -> str:
+        """将异常分为 transient（可整批重试）、row（数据问题，需逐条隔离）、fatal（重试无用）。
+
+        只有 IntegrityError（如主键重复）和 DataError（如数据过长）与具体的数据行有关；
+        其余数据库错误（如未执行迁移导致的 1054 Unknown column 、1045 Access denied）对每一行都会发生，属于 fatal 。
+        """
+        if isinstance(e, pymysql.err.OperationalError) and e.args and e.args[0] in MySQLOperation._TRANSIENT_ERROR_CODES:
+            return 'transient'
+        if isinstance(e, (pymysql.err.InterfaceError, ConnectionError, TimeoutError)):
+            return 'transient'
+        if isinstance(e, (pymysql.err.IntegrityError, pymysql.err.DataError)):
+            return 'row'
+        if isinstance(e, pymysql.err.Error):
+            return 'fatal'
+        return 'row'
+
+    @staticmethod
+    def table_name(entity) -> str:
+        """entity 可以是模型实例，也可以是模型类。"""
+        _type = entity if isinstance(entity, type) else entity.__class__
+        ls = list(_type.__name__)
         ls[0] = ls[0].lower()
         iter = map(lambda letter: letter if letter.islower() else f'_{letter.lower()}', ls)
         return ''.join(iter)
 
     @staticmethod
-    def fields_substament(entity:Model) -> str:
-        return ', '.join(entity._metadata.keys())
+    def fields_substament(entity) -> str:
+        return ', '.join(entity._fields)
+
+    @staticmethod
+    def placeholders_substament(entity:Model) -> str:
+        return ', '.join(['%s'] * len(entity._fields))
+
+    @staticmethod
+    def on_duplicate_substament(entity) -> str:
+        """主键或唯一键重复时，用新值更新除主键和 immutable 字段（如 Proxy.collect_time）以外的字段。"""
+        metadata = entity._metadata
+        fields = [fn for fn in entity._fields if not metadata[fn]._is_primary_key and not metadata[fn]._is_immutable]
+        # 没有可更新的字段时，以不改变数据的赋值保持 upsert 不报错
+        updates = ', '.join([f'{fn} = values({fn})' for fn in fields]) or f'{entity._fields[0]} = {entity._fields[0]}'
+        return f' \non duplicate key update {updates}'
 
     @staticmethod
     def __values_substament(entity:Model, field_names:list=None) -> str:
@@ -98,3 +301,64 @@ class MySQLOperation:
             field_names = metadata.keys()
         field_values = [metadata[fn].to_sql(getattr(entity, fn)) for fn in field_names]
         return ', '.join(field_values)
+
+    @staticmethod
+    def __values_params(entity:Model, field_names:list=None) -> tuple:
+        metadata = entity._metadata
+        if field_names is None:
+            field_names = metadata.keys()
+        return tuple([metadata[fn].to_param(getattr(entity, fn)) for fn in field_names])
+
+    @staticmethod
+    def __tsv_value(value) -> str:
+        if value is None:
+            return '\\N'
+        elif isinstance(value, bool):
+            return '1' if value else '0'
+        elif isinstance(value, Datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(value, (bytes, bytearray)):
+            return value.hex()
+        elif isinstance(value, str):
+            return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n') \
+                .replace('\r', '\\r').replace('\0', '\\0')
+        return str(value)
+
+    @staticmethod
+    def __entity_factory(description, _type:type):
+        names = tuple([d[0] for d in description])
+        if names == _type._fields:
+            return _type.from_row
+
+        cols = [(i, name) for i, name in enumerate(names) if name in _type._metadata]
+        fields = [name for _, name in cols]
+        return lambda row: _type.from_row([row[i] for i, _ in cols], fields)
+
+    @staticmethod
+    def __end_read(connect):
+        """提交后归还连接。pymysql 的连接不自动提交，只读的查询也会开启事务；
+        不结束它的话，连接池中的连接会一直使用第一次查询时的快照（REPEATABLE READ），看不到其他连接之后提交的数据。"""
+        connect.commit()
+        connect.close()
+
+    @staticmethod
+    def __connection():
+        """返回 (连接, 是否自行提交并关闭)。处于 transaction() 中时返回事务的连接。"""
+        connect = getattr(MySQLOperation._LOCAL, 'connect', None)
+        if connect is not None:
+            return connect, False
+        return MySQLOperation._POOL.connection(), True
+
+
+def _pool_connections(state:str) -> int:
+    """连接池中使用中（in_use）或空闲（idle）的连接数，读取 PooledDB 的内部状态。"""
+    pool = MySQLOperation._POOL
+    if pool is None:
+        return 0
+    if state == 'in_use':
+        return getattr(pool, '_connections', 0)
+    return len(getattr(pool, '_idle_cache', ()))
+
+
+_POOL_CONNECTIONS.set_function(lambda: _pool_connections('in_use'), state='in_use')
+_POOL_CONNECTIONS.set_function(lambda: _pool_connections('idle'), state='idle')
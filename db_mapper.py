@@ -1,15 +1,276 @@
+import zlib
 import database, models
+from datetime import datetime as Datetime
+
+
+def _join(iter, as_str=False):
+    ls = [f"'{val}'" for val in iter] if as_str \
+        else [str(val) for val in iter]
+    return ','.join(ls)
+
 
 class MySQLMapper:
     @staticmethod
     def find_proxies(pf_cond, ptf_cond, field_names):
-        def join(iter, as_str=False):
-            ls = [f"'{val}'" for val in iter] if as_str \
-                else [str(val) for val in iter]
-            return ','.join(ls)
+        sql = MySQLMapper.__find_proxies_sql(pf_cond, ptf_cond, field_names)
+        return database.MySQLOperation.query(sql, _type=models.Proxy)
+
+    @staticmethod
+    def iter_find_proxies(pf_cond, ptf_cond, field_names, chunk_size=1000):
+        sql = MySQLMapper.__find_proxies_sql(pf_cond, ptf_cond, field_names)
+        return database.MySQLOperation.iter_query(sql, _type=models.Proxy, chunk_size=chunk_size)
+
+    @staticmethod
+    def find_proxies_by_stats(pf_cond, ptf_cond, field_names):
+        """与 find_proxies() 的条件相同，但从 proxy_stats 表中汇总，耗时与代理数量成正比，与测试日志数量无关。
+
+        proxy_stats 按小时汇总，pre_tested_timedelta 会向前取整到包含截止时间的那一小时。
+        """
+        sql = MySQLMapper.__find_proxies_by_stats_sql(pf_cond, ptf_cond, field_names)
+        return database.MySQLOperation.query(sql, _type=models.Proxy)
 
+    @staticmethod
+    def iter_find_proxies_by_stats(pf_cond, ptf_cond, field_names, chunk_size=1000):
+        sql = MySQLMapper.__find_proxies_by_stats_sql(pf_cond, ptf_cond, field_names)
+        return database.MySQLOperation.iter_query(sql, _type=models.Proxy, chunk_size=chunk_size)
+
+    @staticmethod
+    def find_response_elapsed_means(pre_tested_timedelta=None):
+        """从 proxy_stats 表汇总各代理有效响应的平均响应时长，返回 {proxy_url: 平均响应时长} 。"""
         sql = '\n'.join((
-            f"select {join(field_names)}",
+            "select proxy_url, sum(response_elapsed_sum) / sum(test_count)",
+            "from proxy_stats",
+            "where valid_response",
+            f"    and test_hour > date_sub(now(), interval {pre_tested_timedelta.total_seconds() + 3600} second)" if pre_tested_timedelta else "",
+            "group by proxy_url;",
+        ))
+        return {proxy_url: elapsed for proxy_url, elapsed in database.MySQLOperation.fetchall(sql)}
+
+    @staticmethod
+    def update_proxy_stats(test_logs):
+        """将一批 TestLog 累加到 proxy_stats 表中。应与 TestLog 的插入处于同一事务。"""
+        stats = {}
+        for tl in test_logs:
+            if tl.test_time is None:
+                continue
+            key = (
+                tl.proxy_url,
+                tl.test_time.replace(minute=0, second=0, microsecond=0),
+                bool(tl.verification_ip),
+                bool(tl.transfer_size and tl.transfer_size > 0),
+            )
+            s = stats.setdefault(key, [0, 0, 0, 0, 0])
+            s[0] += 1
+            s[1] += tl.response_elapsed or 0
+            s[2] += tl.transfer_elapsed or 0
+            s[3] += 1 if tl.timeout_exception else 0
+            s[4] += 1 if tl.proxy_exception else 0
+        if not stats:
+            return 0
+
+        sql = '\n'.join((
+            "insert into proxy_stats(proxy_url, test_hour, verification_ip, valid_response",
+            "    , test_count, response_elapsed_sum, transfer_elapsed_sum, timeout_exception_count, proxy_exception_count)",
+            "values (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            "on duplicate key update",
+            "    test_count = test_count + values(test_count)",
+            "    , response_elapsed_sum = response_elapsed_sum + values(response_elapsed_sum)",
+            "    , transfer_elapsed_sum = transfer_elapsed_sum + values(transfer_elapsed_sum)",
+            "    , timeout_exception_count = timeout_exception_count + values(timeout_exception_count)",
+            "    , proxy_exception_count = proxy_exception_count + values(proxy_exception_count);",
+        ))
+        params_list = [(*key, *[round(v, 4) if isinstance(v, float) else v for v in s]) for key, s in stats.items()]
+        return database.MySQLOperation.executemany(sql, params_list)
+
+    @staticmethod
+    def insert_response_contents(contents):
+        """写入 ResponseContent ，内容已存在（content_hash 相同）时忽略。"""
+        contents = list(contents)
+        if not contents:
+            return 0
+        fields = database.MySQLOperation.fields_substament(models.ResponseContent)
+        placeholders = database.MySQLOperation.placeholders_substament(models.ResponseContent)
+        sql = '\n'.join((
+            f"insert into response_content({fields})",
+            f"values ({placeholders})",
+            f"on duplicate key update content_hash = content_hash;",
+        ))
+        params_list = [tuple([c.content_hash, c.content_size, c.content, c.first_seen]) for c in contents]
+        return database.MySQLOperation.executemany(sql, params_list)
+
+    @staticmethod
+    def find_response_content(content_hash):
+        """按 SHA-1 查找并解压响应内容，不存在时返回 None 。"""
+        rows = database.MySQLOperation.fetchall('select content from response_content where content_hash = %s;', (content_hash,))
+        if not rows:
+            return None
+        return zlib.decompress(rows[0][0]).decode('utf-8')
+
+    @staticmethod
+    def enqueue_verify_leases(run_name, local, proxies):
+        """将代理加入分片验证的队列（verify_lease 表），已在队列中的代理（包括已完成的）保持不变。
+
+        入队时间作为参数传入：values 中只有占位符时，pymysql 才会把 executemany 合并为一条多行 insert 语句。
+        """
+        enqueue_time = Datetime.now()
+        params_list = [(run_name, local, p.proxy_url, p.ip, p.port, p.protocol, p.collect_time, enqueue_time) for p in proxies]
+        if not params_list:
+            return 0
+        sql = '\n'.join((
+            "insert ignore into verify_lease(run_name, local, proxy_url, ip, port, protocol, collect_time, enqueue_time)",
+            "values (%s, %s, %s, %s, %s, %s, %s, %s);",
+        ))
+        return database.MySQLOperation.executemany(sql, params_list)
+
+    @staticmethod
+    def claim_verify_leases(run_name, local, worker, num, lease_seconds):
+        """领取至多 num 个未完成、且未被领取或租约已过期的代理，租约 lease_seconds 秒后到期，返回 Proxy 列表。
+
+        `for update skip locked`（MySQL 8.0+）使并发领取的 worker 跳过彼此锁定的行，不会领取到同一个代理；
+        到期时间按数据库时间计算，不受各主机时钟偏差的影响。
+        """
+        with database.MySQLOperation.transaction():
+            rows = database.MySQLOperation.fetchall('\n'.join((
+                "select proxy_url, ip, port, protocol, local, collect_time",
+                "from verify_lease",
+                "where run_name = %s and local = %s and not done",
+                "    and (lease_expire is null or lease_expire < now())",
+                "limit %s",
+                "for update skip locked;",
+            )), (run_name, local, num))
+            if rows:
+                database.MySQLOperation.execute('\n'.join((
+                    "update verify_lease",
+                    "set worker = %s, lease_expire = date_add(now(), interval %s second)",
+                    f"where run_name = %s and local = %s and proxy_url in ({', '.join(['%s'] * len(rows))});",
+                )), (worker, lease_seconds, run_name, local, *[row[0] for row in rows]))
+        fields = ('proxy_url', 'ip', 'port', 'protocol', 'local', 'collect_time')
+        return [models.Proxy.from_row(row, fields) for row in rows]
+
+    @staticmethod
+    def renew_verify_leases(run_name, local, worker, lease_seconds):
+        """延长 worker 持有的未完成租约（心跳），返回延长的数量。"""
+        return database.MySQLOperation.execute('\n'.join((
+            "update verify_lease",
+            "set lease_expire = date_add(now(), interval %s second)",
+            "where run_name = %s and local = %s and worker = %s and not done and lease_expire is not null;",
+        )), (lease_seconds, run_name, local, worker))
+
+    @staticmethod
+    def finish_verify_leases(run_name, local, proxy_urls):
+        """将代理标记为已验证。"""
+        proxy_urls = list(proxy_urls)
+        if not proxy_urls:
+            return 0
+        return database.MySQLOperation.execute('\n'.join((
+            "update verify_lease",
+            "set done = 1, lease_expire = null",
+            f"where run_name = %s and local = %s and proxy_url in ({', '.join(['%s'] * len(proxy_urls))});",
+        )), (run_name, local, *proxy_urls))
+
+    @staticmethod
+    def release_verify_leases(run_name, local, worker):
+        """归还 worker 持有的未完成租约，使其可以立即被其他 worker 领取。"""
+        return database.MySQLOperation.execute('\n'.join((
+            "update verify_lease",
+            "set worker = null, lease_expire = null",
+            "where run_name = %s and local = %s and worker = %s and not done;",
+        )), (run_name, local, worker))
+
+    @staticmethod
+    def verify_lease_progress(run_name, local, worker=None):
+        """返回分片验证的进度：total 、done（已验证）、leased（租约未到期）、pending（待领取，包括租约已过期的），
+        以及 own（leased 中由 worker 持有的数量）。"""
+        rows = database.MySQLOperation.fetchall('\n'.join((
+            "select count(*)",
+            "    , coalesce(sum(done), 0)",
+            "    , coalesce(sum(not done and lease_expire >= now()), 0)",
+            "    , coalesce(sum(not done and (lease_expire is null or lease_expire < now())), 0)",
+            "    , coalesce(sum(not done and lease_expire >= now() and worker = %s), 0)",
+            "from verify_lease",
+            "where run_name = %s and local = %s;",
+        )), (worker, run_name, local))
+        return dict(zip(('total', 'done', 'leased', 'pending', 'own'), [int(v) for v in rows[0]]))
+
+    @staticmethod
+    def rebuild_proxy_stats():
+        """根据 test_log 表全量重建 proxy_stats 表，用于初始化或修复统计数据。重建的是按小时的统计，之后可以再执行 rollup_proxy_stats() 。"""
+        with database.MySQLOperation.transaction():
+            database.MySQLOperation.execute('delete from proxy_stats;')
+            return database.MySQLOperation.execute('\n'.join((
+                "insert into proxy_stats(proxy_url, test_hour, verification_ip, valid_response",
+                "    , test_count, response_elapsed_sum, transfer_elapsed_sum, timeout_exception_count, proxy_exception_count)",
+                "select proxy_url",
+                "    , date_format(test_time, '%%Y-%%m-%%d %%H:00:00') test_hour",
+                "    , coalesce(verification_ip, 0) verification_ip",
+                "    , coalesce(transfer_size > 0, 0) valid_response",
+                "    , count(*), coalesce(sum(response_elapsed), 0), coalesce(sum(transfer_elapsed), 0)",
+                "    , coalesce(sum(timeout_exception), 0), coalesce(sum(proxy_exception), 0)",
+                "from test_log",
+                "where test_time is not null",
+                "group by 1, 2, 3, 4;",
+            )), ())
+
+    @staticmethod
+    def rollup_proxy_stats(keep):
+        """将 keep（timedelta）之前的按小时统计合并为每个代理每种（verification_ip, valid_response）一行，返回合并后的行数。
+
+        合并行的 test_hour 取被合并各行中最晚的一小时，各项之和不变，因此不限测试时间的查询结果不变；
+        定期执行后 proxy_stats 的行数约为 代理数 * (keep 内的小时数 + 4) ，不再随历史增长。
+        pre_tested_timedelta 不应超过 keep ，否则合并行只会被整体计入或排除。
+        """
+        cutoff = (Datetime.now() - keep).replace(minute=0, second=0, microsecond=0)
+        with database.MySQLOperation.transaction():
+            rows = database.MySQLOperation.fetchall('\n'.join((
+                "select proxy_url, max(test_hour), verification_ip, valid_response",
+                "    , sum(test_count), sum(response_elapsed_sum), sum(transfer_elapsed_sum)",
+                "    , sum(timeout_exception_count), sum(proxy_exception_count)",
+                "from proxy_stats",
+                "where test_hour < %s",
+                "group by proxy_url, verification_ip, valid_response",
+                "for update;",
+            )), (cutoff,))
+            if not rows:
+                return 0
+            database.MySQLOperation.execute('delete from proxy_stats where test_hour < %s;', (cutoff,))
+            return database.MySQLOperation.executemany('\n'.join((
+                "insert into proxy_stats(proxy_url, test_hour, verification_ip, valid_response",
+                "    , test_count, response_elapsed_sum, transfer_elapsed_sum, timeout_exception_count, proxy_exception_count)",
+                "values (%s, %s, %s, %s, %s, %s, %s, %s, %s);",
+            )), [tuple(row) for row in rows])
+
+    @staticmethod
+    def __find_proxies_by_stats_sql(pf_cond, ptf_cond, field_names):
+        sql = '\n'.join((
+            f"select {_join(field_names)}",
+            f"from (",
+            f"    select {','.join(['p.' + f for f in field_names])}",
+            f"        -- proxy_stats 聚合条件",
+            f"        , sum(s.response_elapsed_sum) / sum(s.test_count) response_elapsed_mean" if ptf_cond.get('response_elapsed_mean') else "",
+            f"        , sum(s.transfer_elapsed_sum) / sum(s.test_count) transfer_elapsed_mean" if ptf_cond.get('transfer_elapsed_mean') else "",
+            f"        , sum(s.timeout_exception_count) / sum(s.test_count) timeout_exception_pr" if ptf_cond.get('timeout_exception_pr') else "",
+            f"        , sum(s.proxy_exception_count) / sum(s.test_count) proxy_exception_pr" if ptf_cond.get('proxy_exception_pr') else "",
+            f"        , sum(s.test_count * s.valid_response) / sum(s.test_count) valid_responses_pr" if ptf_cond.get('valid_responses_pr') else "",
+            f"    from proxy p",
+            f"        left join proxy_stats s on p.proxy_url = s.proxy_url" if ptf_cond else "",
+            f"    where 1 = 1",
+            f"        -- proxy_stats 前置条件",
+            f"        and s.valid_response" if ptf_cond.get('pre_valid_responses') else "",
+            f"        and s.verification_ip" if ptf_cond.get('pre_verification_ip') else "",
+            f"        and s.test_hour > date_sub(now(), interval {ptf_cond.get('pre_tested_timedelta').total_seconds() + 3600} second)" if ptf_cond.get('pre_tested_timedelta') else "",
+            f"    group by p.proxy_url",
+            f"    having 1=1",
+            *MySQLMapper.__proxy_conditions(pf_cond),
+            f") p",
+            f"where 1 = 1",
+            *MySQLMapper.__aggregate_conditions(ptf_cond),
+        ))
+        return sql
+
+    @staticmethod
+    def __find_proxies_sql(pf_cond, ptf_cond, field_names):
+        sql = '\n'.join((
+            f"select {_join(field_names)}",
             f"from (",
             f"    select {','.join(['p.' + f for f in field_names])}",
             f"        -- test_log 聚合条件",
@@ -27,19 +288,30 @@ class MySQLMapper:
             f"        and tl.test_time > date_sub(now(), interval {ptf_cond.get('pre_tested_timedelta').total_seconds()} second)" if ptf_cond.get('pre_tested_timedelta') else "",
             f"    group by p.proxy_url",
             f"    having 1=1",
-            f"        -- proxy 条件",
-            f"        and p.port in ({join(pf_cond.get('port_list'))})" if pf_cond.get('port_list') else "",
-            f"        and p.protocol in ({join(pf_cond.get('protocol_list'), as_str=True)})" if pf_cond.get('protocol_list') else "",
-            f"        and p.local in ({join(pf_cond.get('local_list'), as_str=True)})" if pf_cond.get('local_list') else "",
-            f"        and p.collect_time > date_sub(now(), interval {pf_cond.get('collected_timedelta').total_seconds()} second)" if pf_cond.get('collected_timedelta') else "",
+            *MySQLMapper.__proxy_conditions(pf_cond),
             f") p",
             f"where 1 = 1",
-            f"    -- test_log 聚合条件",
+            *MySQLMapper.__aggregate_conditions(ptf_cond),
+        ))
+        return sql
+
+    @staticmethod
+    def __proxy_conditions(pf_cond):
+        return (
+            f"        -- proxy 条件",
+            f"        and p.port in ({_join(pf_cond.get('port_list'))})" if pf_cond.get('port_list') else "",
+            f"        and p.protocol in ({_join(pf_cond.get('protocol_list'), as_str=True)})" if pf_cond.get('protocol_list') else "",
+            f"        and p.local in ({_join(pf_cond.get('local_list'), as_str=True)})" if pf_cond.get('local_list') else "",
+            f"        and p.collect_time > date_sub(now(), interval {pf_cond.get('collected_timedelta').total_seconds()} second)" if pf_cond.get('collected_timedelta') else "",
+        )
+
+    @staticmethod
+    def __aggregate_conditions(ptf_cond):
+        return (
+            f"    -- 聚合条件",
             f"    and response_elapsed_mean < {ptf_cond.get('response_elapsed_mean')}" if ptf_cond.get('response_elapsed_mean') else "",
             f"    and transfer_elapsed_mean < {ptf_cond.get('transfer_elapsed_mean')}" if ptf_cond.get('transfer_elapsed_mean') else "",
             f"    and timeout_exception_pr < {ptf_cond.get('timeout_exception_pr')}" if ptf_cond.get('timeout_exception_pr') else "",
             f"    and proxy_exception_pr < {ptf_cond.get('proxy_exception_pr')}" if ptf_cond.get('proxy_exception_pr') else "",
             f"    and valid_responses_pr >= {ptf_cond.get('valid_responses_pr')}" if ptf_cond.get('valid_responses_pr') else "",
-        ))
-
-        return database.MySQLOperation.query(sql, _type=models.Proxy)
+        )
@@ -0,0 +1,105 @@
+import os, sys, csv, gzip, json
+from datetime import datetime as Datetime
+from models import Proxy
+from util import trim_margin
+
+
+class ModelExporter:
+    """流式导出器：逐个写入模型实体（如代理池、ProxyLoader.iter_load() 或 MySQLOperation.iter_select_all() 的结果），
+    内存占用与实体数量无关。
+
+    fp 以 .gz 结尾时使用 gzip 压缩。fields 默认为 Proxy 的全部字段。
+    """
+
+    def __init__(self, fp:str, fields:tuple=None):
+        self._fp = fp
+        self._fields = fields or Proxy._fields
+
+    def export(self, entities) -> int:
+        """写入所有实体，返回写入的数量。"""
+        count = 0
+        with self._open() as f:
+            self._begin(f)
+            for entity in entities:
+                self._write(f, [(field, self._value(getattr(entity, field))) for field in self._fields], count)
+                count += 1
+            self._end(f)
+        return count
+
+    def _open(self):
+        if self._fp.endswith('.gz'):
+            return gzip.open(self._fp, 'wt', encoding='utf-8', newline='')
+        return open(self._fp, 'w', encoding='utf-8', newline='')
+
+    def _begin(self, f):
+        pass
+
+    def _write(self, f, row:list, index:int):
+        raise NotImplementedError()
+
+    def _end(self, f):
+        pass
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, Datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        return value
+
+
+class CsvExporter(ModelExporter):
+    def _begin(self, f):
+        self._writer = csv.writer(f)
+        self._writer.writerow(self._fields)
+
+    def _write(self, f, row:list, index:int):
+        self._writer.writerow([value for _, value in row])
+
+
+class JsonLinesExporter(ModelExporter):
+    """每行一个 JSON 对象（JSON Lines）。"""
+
+    def _write(self, f, row:list, index:int):
+        f.write(json.dumps(dict(row), ensure_ascii=False, default=str))
+        f.write('\n')
+
+
+class JsonExporter(ModelExporter):
+    """一个 JSON 数组，与 ProxyPool.to_jsons() 的格式相同，但逐个写入。"""
+
+    def _begin(self, f):
+        f.write('[')
+
+    def _write(self, f, row:list, index:int):
+        if index:
+            f.write(', ')
+        f.write(json.dumps(dict(row), default=str))
+
+    def _end(self, f):
+        f.write(']')
+
+
+def exporter_for(fp:str, fields:tuple=None) -> ModelExporter:
+    """按文件扩展名（.csv 、.jsonl 、.json ，可再加 .gz）选择导出器。"""
+    name = fp[:-3] if fp.endswith('.gz') else fp
+    ext = os.path.splitext(name)[1]
+    exporters = {'.csv': CsvExporter, '.jsonl': JsonLinesExporter, '.json': JsonExporter}
+    if ext not in exporters:
+        raise ValueError(f'Unsupported export format "{ext}".')
+    return exporters[ext](fp, fields)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(trim_margin('''
+        |Example:
+        |  $ python exporter.py proxies.csv
+        |  $ python exporter.py proxies.jsonl.gz
+        '''))
+    else:
+        from database import MySQLOperation
+
+        MySQLOperation.init_pool()
+        count = exporter_for(sys.argv[1]).export(MySQLOperation.iter_select_all(Proxy))
+        MySQLOperation.close_pool()
+        print(f'Exported {count} proxies to {sys.argv[1]}.')
@@ -1,3 +1,5 @@
+from operator import attrgetter
+from itertools import repeat
 from datetime import (
     datetime as Datetime,
     timedelta as Timedelta
@@ -8,6 +10,9 @@ class ProxyFilter:
     def assess(self, proxy) -> bool:
         return True
 
+    def assess_batch(self, proxies: list) -> list:
+        return [self.assess(p) for p in proxies]
+
 
 class SimpleProxyFilter(ProxyFilter):
     _SUPPORTED_CONDITION = ('port_list', 'protocol_list', 'local_list', 'collected_timedelta')
@@ -21,6 +26,25 @@ class SimpleProxyFilter(ProxyFilter):
             self.assess_local(proxy.local) and \
             self.assess_collected_timedelta(proxy.collect_time)
 
+    def assess_batch(self, proxies: list) -> list:
+        """批量评估，返回与 proxies 一一对应的评估结果，当前时间只取一次。"""
+        port_list = self._conditions.get('port_list')
+        protocol_list = self._conditions.get('protocol_list')
+        local_list = self._conditions.get('local_list')
+        timedelta = self._conditions.get('collected_timedelta')
+        port_list = port_list if isinstance(port_list, (list, tuple)) else None
+        protocol_list = protocol_list if isinstance(protocol_list, (list, tuple)) else None
+        local_list = local_list if isinstance(local_list, (list, tuple)) else None
+        now = Datetime.now() if isinstance(timedelta, Timedelta) else None
+
+        return [
+            (port_list is None or p.port in port_list) and \
+                (protocol_list is None or p.protocol in protocol_list) and \
+                (local_list is None or p.local in local_list) and \
+                (now is None or now - p.collect_time < timedelta)
+            for p in proxies
+        ]
+
     def assess_port(self, port: str) -> bool:
         port_list = self._conditions.get('port_list')
         if isinstance(port_list, (list, tuple)):
@@ -53,6 +77,10 @@ class ProxyTestFilter:
     def assess(self, proxy, test_logs: list) -> bool:
         return True
 
+    def is_decided(self, proxy, test_logs: list, repeat: int) -> bool:
+        """在完成 len(test_logs) 次（共 repeat 次）验证后，判断评估结果是否已经确定，确定时可以跳过剩余的验证。"""
+        return len(test_logs) >= repeat
+
 
 class SimpleProxyTestFilter(ProxyTestFilter):
     _SUPPORTED_CONDITION = (
@@ -87,6 +115,84 @@ class SimpleProxyTestFilter(ProxyTestFilter):
             self.assess_proxy_exception_pr(proxy, test_logs) and \
             self.assess_valid_responses_pr(proxy, test_logs)
 
+    def is_decided(self, proxy, test_logs: list, repeat: int) -> bool:
+        """剩余的验证即使全部是理想结果（零耗时、有效响应、无异常、经过IP验证）也无法通过评估时，结果已经确定。
+
+        每项条件都是均值或比例，理想结果只会让它们变好，所以这个判断不会误伤能够达标的代理。
+        """
+        if len(test_logs) >= repeat:
+            return True
+        if self._proxy_filter and not self._proxy_filter.assess(proxy):
+            return True
+        if len(test_logs) == 0:
+            return False
+
+        ideal = self.__ideal_test_log(test_logs[-1])
+        return not self.assess(proxy, test_logs + [ideal] * (repeat - len(test_logs)))
+
+    def assess_batch(self, proxies: list, test_logs) -> list:
+        """批量评估，返回与 proxies 一一对应的评估结果，与逐个调用 assess() 的结果相同。
+
+        test_logs 为这些代理的全部测试日志（按 proxy_url 关联），可以是 TestLog 列表，
+        也可以是包含 TestLog 各列的 pandas.DataFrame 。所有条件在列数组上一次性计算。
+        """
+        import numpy
+
+        proxies = list(proxies)
+        index = {}
+        for i, proxy in enumerate(proxies):
+            index.setdefault(proxy.proxy_url, i)
+        if not hasattr(test_logs, 'columns'):
+            test_logs = list(test_logs)
+        since = None
+        if isinstance(self._conditions.get('pre_tested_timedelta'), Timedelta):
+            since = Datetime.now() - self._conditions['pre_tested_timedelta']
+        cols = self.__batch_columns(test_logs, index, since)
+
+        # 仅保留符合前置条件的测试日志
+        mask = cols['pos'] >= 0
+        if self._conditions.get('pre_valid_responses') == True:
+            mask &= cols['transfer_size'] > 0
+        if since is not None:
+            mask &= cols['recent']
+        if self._conditions.get('pre_verification_ip') == True:
+            mask &= cols['verification_ip']
+
+        size = len(proxies)
+        pos = cols['pos'][mask]
+        count = numpy.bincount(pos, minlength=size)
+        divisor = numpy.maximum(count, 1)
+        passed = count > 0
+        if self._proxy_filter:
+            passed &= numpy.array(self._proxy_filter.assess_batch(proxies), dtype=bool)
+
+        # 均值的浮点求和顺序与 assess() 不同，与阈值几乎相等的代理交由 assess() 判定
+        uncertain = numpy.zeros(size, dtype=bool)
+        for column, condition in (('response_elapsed', 'response_elapsed_mean'), ('transfer_elapsed', 'transfer_elapsed_mean')):
+            threshold = self._conditions.get(condition)
+            if isinstance(threshold, (int, float)):
+                values = cols[column][mask]
+                mean = numpy.bincount(pos, weights=numpy.where(values > 0, values, 0), minlength=size) / divisor
+                uncertain |= numpy.abs(mean - threshold) <= 1e-9 * max(1, abs(threshold))
+                passed &= mean <= threshold
+
+        for column, condition in (('timeout_exception', 'timeout_exception_pr'), ('proxy_exception', 'proxy_exception_pr')):
+            threshold = self._conditions.get(condition)
+            if isinstance(threshold, (int, float)):
+                pr = numpy.bincount(pos, weights=cols[column][mask], minlength=size) / divisor
+                passed &= pr <= threshold
+
+        threshold = self._conditions.get('valid_responses_pr')
+        if isinstance(threshold, (int, float)):
+            pr = numpy.bincount(pos, weights=cols['transfer_size'][mask] > 0, minlength=size) / divisor
+            passed &= pr >= threshold
+
+        result = passed.tolist()
+        rows = numpy.flatnonzero(mask)
+        for i in numpy.flatnonzero(uncertain & (count > 0)):
+            result[i] = self.assess(proxies[i], self.__batch_test_logs(test_logs, rows[pos == i]))
+        return [result[index[p.proxy_url]] for p in proxies]
+
     def assess_response_elapsed_mean(self, proxy, test_logs: list) -> bool:
         response_elapsed_mean = self._conditions.get('response_elapsed_mean')
         if isinstance(response_elapsed_mean, (int, float)):
@@ -144,3 +250,52 @@ class SimpleProxyTestFilter(ProxyTestFilter):
         if verification_ip == True:
             return tl.verification_ip
         return True
+
+    @staticmethod
+    def __ideal_test_log(tl):
+        ideal = tl.__class__.from_row([value for _, value in tl])
+        ideal.response_elapsed = 0
+        ideal.transfer_elapsed = 0
+        ideal.transfer_size = max(tl.transfer_size or 0, 1)
+        ideal.timeout_exception = False
+        ideal.proxy_exception = False
+        ideal.test_time = Datetime.now()
+        # 剩余的验证可能来自其他验证器（如 IP 验证），理想结果须满足全部前置条件
+        ideal.verification_ip = True
+        return ideal
+
+    @staticmethod
+    def __batch_columns(test_logs, index: dict, since: Datetime=None) -> dict:
+        """将 test_logs 转为按列的 numpy 数组。pos 为所属代理在 proxies 中的下标（-1 表示不在其中），
+        recent 为 test_time 是否晚于 since 。"""
+        import numpy
+
+        if hasattr(test_logs, 'columns'):
+            column = lambda name: test_logs[name].tolist()
+        else:
+            column = lambda name: map(attrgetter(name), test_logs)
+        size = len(test_logs)
+
+        cols = {'pos': numpy.fromiter(map(index.get, column('proxy_url'), repeat(-1)), numpy.int64, size)}
+        for name in ('response_elapsed', 'transfer_elapsed', 'transfer_size'):
+            cols[name] = numpy.fromiter((v if v == v and v else 0 for v in column(name)), numpy.float64, size)
+        for name in ('timeout_exception', 'proxy_exception', 'verification_ip'):
+            cols[name] = numpy.fromiter((v == v and bool(v) for v in column(name)), bool, size)
+        if since is not None:
+            cols['recent'] = numpy.fromiter(map(since.__lt__, column('test_time')), bool, size)
+        return cols
+
+    @staticmethod
+    def __batch_test_logs(test_logs, rows) -> list:
+        if not hasattr(test_logs, 'columns'):
+            return [test_logs[j] for j in rows]
+
+        from models import TestLog
+        ls = []
+        for row in test_logs.iloc[rows].to_dict('records'):
+            tl = TestLog()
+            for field, value in row.items():
+                if field in TestLog._metadata:
+                    setattr(tl, field, value)
+            ls.append(tl)
+        return ls
@@ -1,6 +1,17 @@
-from threading import RLock, Thread
+import time, json, hashlib, zlib, weakref
+from datetime import datetime as Datetime
+from threading import RLock, Thread, Event, BoundedSemaphore
 from database import MySQLOperation
+from db_mapper import MySQLMapper
+from models import ResponseContent
 from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY, STAGE_SECONDS
+
+
+_BUFFERED = REGISTRY.gauge('stream_handler_buffered', 'Items waiting in StreamHandler buffers.', ('handler',))
+_PENDING = REGISTRY.gauge('stream_handler_pending_batches', 'Batches queued or running in StreamHandler executors.', ('handler',))
+_EVENTS = REGISTRY.counter('stream_handler_events_total', 'StreamHandler counts: handled, retries, isolated_rows, dead, shed.', ('handler', 'event'))
+_BATCH_SECONDS = REGISTRY.histogram('stream_handler_batch_seconds', 'Duration of each batch_handle() attempt.', ('handler',))
 
 
 class HandlerContext:
@@ -38,73 +49,239 @@ class OnceHandler(BufferHandler):
 
 
 class StreamHandler(BufferHandler):
-    def __init__(self, buffer_size:int, concurrency:int, context=None):
+    """缓冲到 buffer_size 条后由线程池调用 batch_handle() 批量处理。
+
+    batch_handle() 失败时按 _classify_error() 的结果处理：
+    * transient ：暂时性错误（如连接断开、死锁），整批按指数退避重试，最多 max_retries 次。
+    * row ：数据错误（如违反约束），逐条重新处理一遍，隔离出有问题的数据。
+    * fatal ：无法通过重试解决的错误（如SQL语法错误、缺少字段），不再重试，此后的批次也不再处理，
+      之后调用 handle() 会抛出 RuntimeError（数据先写入死信），使作业停止而不是逐批失败。
+    最终未能处理的数据写入死信文件 dead_letter_path（JSON Lines，未设置时只记录日志），各种结果的数量见 stats() 。
+
+    同一时刻最多有 max_pending（默认为 concurrency 的两倍）个批次在等待或处理中，队列满时：
+    overflow 为 block 则阻塞调用 handle() 的线程，为 shed 则丢弃这一批（计入 shed 并写入死信）。
+    设置 linger（秒）时，缓冲区中最早的数据等待超过 linger 秒后，即使未满也会被提交。
+    """
+    _TRANSIENT = 'transient'
+    _ROW = 'row'
+    _FATAL = 'fatal'
+
+    def __init__(self, buffer_size:int, concurrency:int, context=None, max_retries:int=3, retry_backoff:float=0.5, dead_letter_path:str=None,
+            max_pending:int=None, overflow:str='block', linger:float=None):
         super().__init__(context)
+        if overflow not in ('block', 'shed'):
+            raise ValueError(f'Unsupported overflow "{overflow}".')
         self._buffer_size = buffer_size
+        self._buffer_time = None
         self._lock = RLock()
         self._executor = ThreadPoolExecutor(concurrency)
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._dead_letter_path = dead_letter_path
+        self._max_pending = max_pending or concurrency * 2
+        self._slots = BoundedSemaphore(self._max_pending)
+        self._overflow = overflow
+        self._fatal_error = None
+        self._stats = dict(batches=0, handled=0, retries=0, isolated_batches=0, isolated_rows=0, dead=0, shed=0, pending=0)
+
+        self._name = self.__class__.__name__
+        ref = weakref.ref(self)
+        _BUFFERED.set_function(lambda: len(ref()._buffer) if ref() else None, handler=self._name)
+        _PENDING.set_function(lambda: ref()._stats['pending'] if ref() else None, handler=self._name)
+
+        self._linger = linger
+        self._closed = Event()
+        self._linger_thread = None
+        if linger:
+            self._linger_thread = Thread(target=self.__linger_loop, name=f'{self.__class__.__name__}-linger', daemon=True)
+            self._linger_thread.start()
 
     def handle(self, data):
-        self._lock.acquire()
-        if len(self._buffer) >= self._buffer_size:
-            self.flush()
-        super().handle(data)
-        self._lock.release()
+        if self._fatal_error is not None:
+            self.__dead_letter([data], self._fatal_error)
+            raise RuntimeError(f'{self.__class__.__name__}: Stopped after a fatal error. {self._fatal_error!r}') from self._fatal_error
+        with self._lock:
+            if not self._buffer:
+                self._buffer_time = time.time()
+            super().handle(data)
+            old = self.clear() if len(self._buffer) >= self._buffer_size else None
+        if old:
+            self.__submit(old)
 
     def flush(self):
-        self._lock.acquire()
-        old = self.clear()
-        self._lock.release()
-        self._executor.submit(self.__run, old)
+        with self._lock:
+            old = self.clear()
+        if old:
+            self.__submit(old)
 
     def close(self):
+        self._closed.set()
+        if self._linger_thread:
+            self._linger_thread.join()
         self.flush()
         self._executor.shutdown(True)
+        if self._context and self._context.logger:
+            self._context.logger.info(f'{self.__class__.__name__}: {self.stats()}.')
 
     def batch_handle(self, data_list:list): 
         raise NotImplementedError()
 
+    def stats(self) -> dict:
+        """返回计数的副本：batches 批次数，handled 成功处理的数据条数，retries 暂时性错误的重试次数，
+        isolated_batches / isolated_rows 逐条处理的批次数和数据条数，dead 写入死信的数据条数（含 shed），
+        shed 因队列已满被丢弃的数据条数，pending 当前等待或处理中的批次数。"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _classify_error(self, e:Exception) -> str:
+        if isinstance(e, (ConnectionError, TimeoutError)):
+            return self._TRANSIENT
+        return self._ROW
+
+    def __submit(self, data_list:list):
+        if not self._slots.acquire(blocking=self._overflow == 'block'):
+            self.__count(shed=len(data_list))
+            self.__dead_letter(data_list, RuntimeError(f'{self.__class__.__name__}: queue is full.'))
+            return
+        self.__count(pending=1)
+        future = self._executor.submit(self.__run, data_list)
+        future.add_done_callback(self.__release)
+
+    def __release(self, future):
+        self.__count(pending=-1)
+        self._slots.release()
+
+    def __linger_loop(self):
+        timeout = self._linger
+        while not self._closed.wait(timeout):
+            with self._lock:
+                age = time.time() - self._buffer_time if self._buffer else 0
+                old = self.clear() if age >= self._linger else None
+            if old:
+                self.__submit(old)
+                age = 0
+            timeout = self._linger - age if age > 0 else self._linger
+
     def __run(self, data_list:list):
+        if self._fatal_error is not None:
+            self.__dead_letter(data_list, self._fatal_error)
+            return
+        self.__count(batches=1)
+        kind, e = self.__handle_with_retry(data_list)
+        if kind is None:
+            return
+        if kind == self._FATAL:
+            with self._lock:
+                if self._fatal_error is None:
+                    self._fatal_error = e
+        if kind == self._ROW and len(data_list) > 1:
+            self.__count(isolated_batches=1, isolated_rows=len(data_list))
+            for data in data_list:
+                kind, e = self.__handle_with_retry([data])
+                if kind is not None:
+                    self.__dead_letter([data], e)
+        else:
+            self.__dead_letter(data_list, e)
+
+    def __handle_with_retry(self, data_list:list):
+        """处理一批数据，成功时返回 (None, None)，否则返回 (错误类型, 异常)。暂时性错误会在这里重试。"""
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                self.batch_handle(data_list)
+                self.__observe(time.perf_counter() - start)
+                self.__count(handled=len(data_list))
+                return None, None
+            except Exception as e:
+                self.__observe(time.perf_counter() - start)
+                kind = self._classify_error(e)
+                if kind != self._TRANSIENT or attempt >= self._max_retries:
+                    return kind, e
+                self.__count(retries=1)
+                time.sleep(self._retry_backoff * 2 ** attempt)
+                attempt += 1
+
+    def __dead_letter(self, data_list:list, e:Exception):
+        self.__count(dead=len(data_list))
+        if self._context and self._context.logger:
+            self._context.logger.error(f'{self.__class__.__name__}: {len(data_list)} rows rejected. {e!r}')
+        if not self._dead_letter_path:
+            return
+
+        now = Datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        lines = [json.dumps(dict(time=now, error=repr(e), data=self.__naive(data)), ensure_ascii=False, default=str) for data in data_list]
+        with self._lock:
+            with open(self._dead_letter_path, 'a', encoding='utf-8') as f:
+                f.write(''.join([line + '\n' for line in lines]))
+
+    def __count(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                self._stats[name] += n
+        for name, n in counts.items():
+            if name in ('handled', 'retries', 'isolated_rows', 'dead', 'shed'):
+                _EVENTS.inc(n, handler=self._name, event=name)
+
+    def __observe(self, elapsed:float):
+        _BATCH_SECONDS.observe(elapsed, handler=self._name)
+        STAGE_SECONDS.observe(elapsed, stage='flush')
+
+    @staticmethod
+    def __naive(data):
         try:
-            self.batch_handle(data_list)
-        except Exception as e:
-            half = len(data_list) // 2
-            if half == 0:
-                raise RuntimeError(str(data_list[0]), *e.args)
-            self.__run(data_list[half:])
-            self.__run(data_list[:half])
+            return dict(data)
+        except (TypeError, ValueError):
+            return data
 
 
 class DatabaseOperationMixin:
     def _operator(self):
         raise NotImplementedError()
 
+    def _classify_error(self, e:Exception) -> str:
+        return self._operator().classify_error(e)
+
 
 class OnceDatabaseOperation(OnceHandler, DatabaseOperationMixin):
     pass
 
 
 class StreamDatabaseOperation(StreamHandler, DatabaseOperationMixin):
-    pass
+    def _classify_error(self, e:Exception) -> str:
+        return DatabaseOperationMixin._classify_error(self, e)
 
 
 class OnceInsertDatabase(OnceDatabaseOperation):
+    def __init__(self, context=None, insert_method='executemany', upsert=False):
+        super().__init__(context)
+        self._insert_method = insert_method
+        self._upsert = upsert
+
     def handle_all(self):
         try:
-            self._operator().batch_insert(self.clear())
+            self._operator().batch_insert(self.clear(), method=self._insert_method, upsert=self._upsert)
         except:
             if self._context and self._context.logger:
-                self._context.logger.exception(f'OnceInsertDatabase: Failed be insert data.')
+                self._context.logger.exception(f'OnceInsertDatabase: Failed to insert data.')
             raise
 
 
 class StreamInsertDatabase(StreamDatabaseOperation):
+    """upsert 为 True 时，主键重复的记录改为更新，不会触发整批失败后的逐条重试。
+    其余关键字参数（重试、死信、背压和 linger）传给 StreamHandler 。"""
+
+    def __init__(self, buffer_size:int, concurrency:int, context=None, insert_method='executemany', upsert=False, **keyword):
+        super().__init__(buffer_size, concurrency, context, **keyword)
+        self._insert_method = insert_method
+        self._upsert = upsert
+
     def batch_handle(self, data_list:list):
         try:
-            self._operator().batch_insert(data_list)
+            self._operator().batch_insert(data_list, method=self._insert_method, upsert=self._upsert)
         except:
             if self._context and self._context.logger:
-                self._context.logger.exception(f'StreamInsertDatabase: Failed be insert data.')
+                self._context.logger.exception(f'StreamInsertDatabase: Failed to insert data.')
             raise
 
 
@@ -121,12 +298,145 @@ class MySQLStreamInserter(StreamInsertDatabase, MySQLOperationMixin):
     pass
 
 
+class MySQLTestLogInserter(MySQLStreamInserter):
+    """TestLog 专用的流式插入处理器，在同一事务中插入 TestLog 并累加 proxy_stats 统计。
+
+    capture 决定响应头和响应体（response_head / response_body）的保存方式：
+    * full ：原样保存（默认）。
+    * none ：不保存。
+    * truncated ：只保存前 capture_limit 个字符。
+    * hash ：只在 response_head_hash / response_body_hash 中保存 SHA-1 。
+    * zlib ：保存 SHA-1 ，内容经 zlib 压缩后写入按 SHA-1 去重的 response_content 表，
+      可通过 MySQLMapper.find_response_content() 取回。
+    """
+    _CAPTURE_MODES = ('full', 'none', 'truncated', 'hash', 'zlib')
+    _KNOWN_HASHES_LIMIT = 100000
+
+    def __init__(self, buffer_size:int, concurrency:int, context=None, insert_method='executemany', capture='full', capture_limit=1024, **keyword):
+        if capture not in self._CAPTURE_MODES:
+            raise ValueError(f'Unsupported capture mode "{capture}".')
+        # 更新已存在的 TestLog 会使 proxy_stats 重复累加，因此不支持 upsert
+        if keyword.pop('upsert', False):
+            raise ValueError('MySQLTestLogInserter does not support upsert.')
+        super().__init__(buffer_size, concurrency, context, insert_method, **keyword)
+        self._capture = capture
+        self._capture_limit = capture_limit
+        self._known_hashes = set()
+
+    def batch_handle(self, data_list:list):
+        try:
+            test_logs, contents = self.capture(data_list)
+            with MySQLOperation.transaction():
+                MySQLOperation.batch_insert(test_logs, method=self._insert_method)
+                MySQLMapper.update_proxy_stats(test_logs)
+                MySQLMapper.insert_response_contents(contents.values())
+            with self._lock:
+                if len(self._known_hashes) > self._KNOWN_HASHES_LIMIT:
+                    self._known_hashes.clear()
+                self._known_hashes.update(contents.keys())
+        except:
+            if self._context and self._context.logger:
+                self._context.logger.exception(f'MySQLTestLogInserter: Failed to insert data.')
+            raise
+
+    def capture(self, data_list:list) -> tuple:
+        """按 capture 处理一批 TestLog ，返回 (TestLog 列表, {content_hash: ResponseContent}) 。
+        返回的是副本，原 TestLog 不会被修改，以便失败后重试。"""
+        contents = {}
+        return [self.__capture(tl, contents) for tl in data_list], contents
+
+    def __capture(self, tl, contents:dict):
+        if self._capture == 'full':
+            return tl
+
+        tl = tl.__class__.from_row([value for _, value in tl])
+        head, body = tl.response_head, tl.response_body
+        tl.response_head = tl.response_body = None
+        if self._capture == 'truncated':
+            tl.response_head = head[:self._capture_limit] if head is not None else None
+            tl.response_body = body[:self._capture_limit] if body is not None else None
+        elif self._capture in ('hash', 'zlib'):
+            tl.response_head_hash = self.__content_hash(head, contents, tl.test_time)
+            tl.response_body_hash = self.__content_hash(body, contents, tl.test_time)
+        return tl
+
+    def __content_hash(self, text, contents:dict, test_time):
+        if text is None:
+            return None
+        data = text.encode('utf-8')
+        content_hash = hashlib.sha1(data).hexdigest()
+        if self._capture == 'zlib' and content_hash not in contents and content_hash not in self._known_hashes:
+            content = ResponseContent()
+            content.content_hash = content_hash
+            content.content_size = len(data)
+            content.content = zlib.compress(data)
+            content.first_seen = test_time
+            contents[content_hash] = content
+        return content_hash
+
+
+class RedisProxyInserter(StreamHandler):
+    """将达标的验证结果（{proxy, test_logs}）批量写入 Redis ，结构见 iproxy.RedisProxyStore 。
+
+    分数为有效响应的平均响应时长（越小越好），没有有效响应时为 default_score 。
+    其余关键字参数（重试、死信、背压和 linger）传给 StreamHandler 。
+    """
+
+    def __init__(self, buffer_size:int, concurrency:int, conn_config:dict, key='proxy_pool', ttl=3600, default_score=60, context=None, **keyword):
+        import redis
+        from iproxy import RedisProxyStore
+
+        super().__init__(buffer_size, concurrency, context, **keyword)
+        self._store = RedisProxyStore(redis.StrictRedis(**conn_config), key, ttl)
+        self._default_score = default_score
+
+    def batch_handle(self, data_list:list):
+        try:
+            self._store.update([(data['proxy'], self.score(data['test_logs'])) for data in data_list])
+        except:
+            if self._context and self._context.logger:
+                self._context.logger.exception(f'RedisProxyInserter: Failed to write proxies.')
+            raise
+
+    def score(self, test_logs:list) -> float:
+        elapsed = [float(tl.response_elapsed) for tl in test_logs if tl.transfer_size and tl.transfer_size > 0]
+        return round(sum(elapsed) / len(elapsed), 4) if elapsed else self._default_score
+
+    def _classify_error(self, e:Exception) -> str:
+        import redis
+
+        if isinstance(e, (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)):
+            return self._TRANSIENT
+        return super()._classify_error(e)
+
+
+class MySQLLeaseFinisher(StreamDatabaseOperation, MySQLOperationMixin):
+    """将验证结果（{proxy, test_logs}）对应的代理在 verify_lease 表中标记为已验证，配合 iproxy.LeasedProxyLoader 使用。"""
+
+    def __init__(self, loader, buffer_size:int=50, concurrency:int=1, context=None, **keyword):
+        super().__init__(buffer_size, concurrency, context, **keyword)
+        self._loader = loader
+
+    def batch_handle(self, data_list:list):
+        try:
+            self._loader.finish([data['proxy'] for data in data_list])
+        except:
+            if self._context and self._context.logger:
+                self._context.logger.exception(f'MySQLLeaseFinisher: Failed to finish leases.')
+            raise
+
+
 class ProxyValidateHandler(Handler):
-    def __init__(self, proxy_handler=None, test_log_handler=None, proxy_test_filter=None, context=None):
+    """result_handler 接收达标代理的完整验证结果（{proxy, test_logs}），例如 RedisProxyInserter ；
+    finish_handler 接收每个代理的验证结果（无论是否达标），在其余处理器之后调用，例如 MySQLLeaseFinisher 。"""
+
+    def __init__(self, proxy_handler=None, test_log_handler=None, proxy_test_filter=None, context=None, result_handler=None, finish_handler=None):
         super().__init__(context)
         self.__proxy_handler = proxy_handler
         self.__test_log_handler = test_log_handler
         self.__proxy_test_filter = proxy_test_filter
+        self.__result_handler = result_handler
+        self.__finish_handler = finish_handler
 
     def handle(self, result:dict):
         proxy = result['proxy']
@@ -135,17 +445,34 @@ class ProxyValidateHandler(Handler):
             self._context.logger.info(f'ProxyValidateHandler: Handling test result from proxy "{proxy.proxy_url}".')
 
         try:
-            if self.__proxy_test_filter is None or self.__proxy_test_filter.assess(proxy, test_logs):
+            with STAGE_SECONDS.time(stage='filter'):
+                passed = self.__proxy_test_filter is None or self.__proxy_test_filter.assess(proxy, test_logs)
+            if passed:
                 if self.__proxy_handler is not None:
                     self.__proxy_handler.handle(proxy)
                 if self.__test_log_handler is not None:
                     for tl in test_logs:
                         self.__test_log_handler.handle(tl)
+                if self.__result_handler is not None:
+                    self.__result_handler.handle(result)
+            if self.__finish_handler is not None:
+                self.__finish_handler.handle(result)
         except:
             if self._context and self._context.logger:
-                self._context.logger.exception(f'ProxyValidateHandler: Failed be handle test result from proxy "{proxy.proxy_url}".')
+                self._context.logger.exception(f'ProxyValidateHandler: Failed to handle test result from proxy "{proxy.proxy_url}".')
             raise
 
+    def is_decided(self, proxy, test_logs:list, repeat:int) -> bool:
+        if self.__proxy_test_filter is None:
+            return len(test_logs) >= repeat
+        return self.__proxy_test_filter.is_decided(proxy, test_logs, repeat)
+
     def close(self):
-        self.__proxy_handler.close()
-        self.__test_log_handler.close()
+        if self.__proxy_handler is not None:
+            self.__proxy_handler.close()
+        if self.__test_log_handler is not None:
+            self.__test_log_handler.close()
+        if self.__result_handler is not None:
+            self.__result_handler.close()
+        if self.__finish_handler is not None:
+            self.__finish_handler.close()
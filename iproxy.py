@@ -1,14 +1,22 @@
-import time, re, json, traceback, math
+import os, time, re, json, socket, traceback, math, asyncio, threading, contextlib
 import requests
-import pandas
-import redis
 
 from datetime import datetime as Datetime
-from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, as_completed
 from models import Proxy, TestLog
 from config import Config
 from database import MySQLOperation
 from db_mapper import MySQLMapper
+from metrics import REGISTRY, STAGE_SECONDS
+
+
+_LOADED = REGISTRY.counter('proxy_loader_proxies_total', 'Proxies loaded into ProxyPool.', ('loader',))
+_VERIFIED = REGISTRY.counter('proxy_pool_verified_total', 'Proxies verified by ProxyPool.')
+_CHECK_SECONDS = REGISTRY.histogram('validator_check_seconds', 'Duration of each validator check.', ('website',))
+_CHECKS = REGISTRY.counter('validator_checks_total', 'Validator checks by result.', ('website', 'result'))
 
 
 class ProxyPoolContext:
@@ -19,60 +27,254 @@ class ProxyPoolContext:
 
 
 class ProxyPool:
+    """代理池。代理以 proxy_url 为键保存（保持加入顺序），重复加入的代理只更新数据，不会被重复验证。"""
+
     def __init__(self, context:ProxyPoolContext=None):
-        self._proxylist:dict = []
+        self._proxylist:dict = {}
         self._context = context
     
     def load(self, loader, override=True, proxy_filter=None):
         if override:
             self._proxylist.clear()
 
-        ls = loader.load()
+        with STAGE_SECONDS.time(stage='load'):
+            ls = loader.load()
+        _LOADED.inc(len(ls), loader=loader.__class__.__name__)
         if proxy_filter:
             ls = [p for p in ls if proxy_filter.assess(p)]
-        self._proxylist.extend(ls)
+        for proxy in ls:
+            self.add(proxy)
+
+    def iter_load(self, loader, override=True, proxy_filter=None):
+        """load() 的流式版本：逐个产出加载到的代理，同时将其加入代理池。
+
+        可直接作为 verify() 的 proxies 参数，边下载边验证。已在池中的代理不会被再次产出。
+        """
+        if override:
+            self._proxylist.clear()
 
-    def verify(self, validator, handler, repeat=1, concurrency=10, sleep=1):
-        proxy_count = len(self._proxylist)
+        loader_name = loader.__class__.__name__
+        proxies = loader.iter_load()
+        while True:
+            start = time.perf_counter()
+            proxy = next(proxies, None)
+            if proxy is None:
+                break
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='load')
+            _LOADED.inc(loader=loader_name)
+            if proxy_filter and not proxy_filter.assess(proxy):
+                continue
+            if self.add(proxy):
+                yield proxy
+
+    def add(self, proxy) -> bool:
+        """加入代理，返回是否为新代理。已存在时用新的数据覆盖，位置不变。"""
+        is_new = proxy.proxy_url not in self._proxylist
+        self._proxylist[proxy.proxy_url] = proxy
+        return is_new
+
+    def get(self, proxy_url:str):
+        return self._proxylist.get(proxy_url)
+
+    def verify(self, validator, handler, repeat=1, concurrency=10, sleep=0, proxies=None, max_pending=None, early_stop=True, report_every=1):
+        """验证代理，并按完成顺序报告进度。
+
+        validator 可以是一个验证器，也可以是验证器列表：同一代理在各个验证器上的验证同时进行（每个验证器验证 repeat 次），
+        全部结果合并后调用一次 handler.handle() 。以多个验证器代替多次重复，可以缩短每个代理的验证时间，并分散各网站的压力。
+        proxies 可以是任意可迭代对象（包括生成器），默认为池中的代理；
+        同一时刻最多只有 max_pending（默认为 concurrency 的两倍）个任务在途，内存占用与代理总数无关。
+        early_stop 为 True 且 handler 提供 is_decided() 时，每次验证后询问结果是否已经确定，确定后跳过剩余的验证。
+        请求速率应通过验证器的 rate_limit 控制；sleep 为每个任务开始前的等待（秒），会占用工作线程，仅为兼容而保留。
+        进度每验证 report_every 个代理打印并记录一次（代理很多时可以调大），各阶段的耗时见 metrics 模块。
+        无论是否出错，结束时都会调用 handler.close() 。
+        """
+        validators = self._validators(validator)
+        proxies = self._proxylist.values() if proxies is None else proxies
+        proxy_count = len(proxies) if hasattr(proxies, '__len__') else None
         progress_count = 0
+        is_decided = getattr(handler, 'is_decided', None) if early_stop else None
+        total = repeat * len(validators)
+
+        def check(validator, proxy, test_logs, lock, decided):
+            with validator.new_session() as session:
+                for _ in range(repeat):
+                    if decided.is_set():
+                        break
+                    tl = validator.verify(proxy, session)
+                    if tl is None:
+                        break
+                    with lock:
+                        test_logs.append(tl)
+                        if is_decided and is_decided(proxy, test_logs, total):
+                            decided.set()
+
         def run(proxy):
-            time.sleep(sleep)
-            test_logs = list([validator.verify(proxy) for _ in range(repeat)])
+            if sleep:
+                time.sleep(sleep)
+            start = time.perf_counter()
+            test_logs, lock, decided = [], threading.Lock(), threading.Event()
+            futures = [fanout.submit(check, v, proxy, test_logs, lock, decided) for v in validators[1:]]
+            check(validators[0], proxy, test_logs, lock, decided)
+            for future in futures:
+                future.result()
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='verify')
             data = dict(proxy=proxy, test_logs=test_logs)
-            handler.handle(data)
+            with STAGE_SECONDS.time(stage='handle'):
+                handler.handle(data)
+            _VERIFIED.inc()
             return proxy
 
-        excutor = ThreadPoolExecutor(max_workers=concurrency)
-        for proxy in excutor.map(run, self._proxylist):
-            progress_count += 1
+        max_pending = max_pending or concurrency * 2
+        fanout_workers = max(concurrency * (len(validators) - 1), 1)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as excutor, ThreadPoolExecutor(max_workers=fanout_workers) as fanout:
+                pending = set()
+                for proxy in proxies:
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            progress_count += 1
+                            self._report_progress(future.result(), progress_count, proxy_count, report_every)
+                    pending.add(excutor.submit(run, proxy))
+
+                for future in as_completed(pending):
+                    progress_count += 1
+                    self._report_progress(future.result(), progress_count, proxy_count, report_every)
+        finally:
+            # 加载器或验证器中途出错时，也要写入缓冲区中的数据并停止处理器的后台线程
+            handler.close()
+
+    def averify(self, validator, handler, repeat=1, concurrency=1000, sleep=0, proxies=None, early_stop=True, report_every=1):
+        """基于 asyncio 的验证方式，单个事件循环即可同时保持上千个验证请求。
+
+        产出的 TestLog 以及对 handler 的调用方式与 verify() 相同（validator 同样可以是列表），需要安装 aiohttp 。
+        同一时刻最多只有 concurrency 个任务在途。handler.handle() 在线程池中调用，handler 阻塞（如 overflow='block' 的
+        StreamHandler 队列已满）时不会拖慢其他验证。无论是否出错，结束时都会调用 handler.close() 。
+        """
+        proxies = self._proxylist.values() if proxies is None else proxies
+        try:
+            asyncio.run(self._averify(self._validators(validator), handler, repeat, concurrency, sleep, proxies, early_stop, report_every))
+        finally:
+            handler.close()
+
+    async def _averify(self, validators, handler, repeat, concurrency, sleep, proxies, early_stop, report_every):
+        import aiohttp
+
+        proxy_count = len(proxies) if hasattr(proxies, '__len__') else None
+        progress_count = 0
+        is_decided = getattr(handler, 'is_decided', None) if early_stop else None
+        total = repeat * len(validators)
+
+        async def check(validator, session, proxy, test_logs, decided):
+            for _ in range(repeat):
+                if decided.is_set():
+                    break
+                tl = await validator.averify(proxy, session)
+                if tl is None:
+                    break
+                test_logs.append(tl)
+                if is_decided and is_decided(proxy, test_logs, total):
+                    decided.set()
+
+        async def run(sessions, proxy):
+            if sleep:
+                await asyncio.sleep(sleep)
+            start = time.perf_counter()
+            test_logs, decided = [], asyncio.Event()
+            await asyncio.gather(*[check(v, session, proxy, test_logs, decided) for v, session in zip(validators, sessions)])
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='verify')
+            data = dict(proxy=proxy, test_logs=test_logs)
+            # handler.handle() 可能阻塞（如 StreamHandler 的队列已满、数据库变慢），放到线程中执行，不阻塞事件循环中的其他验证；
+            # 等待期间该任务仍占用一个在途名额，压力会传递给加载代理的循环
+            with STAGE_SECONDS.time(stage='handle'):
+                await loop.run_in_executor(None, handler.handle, data)
+            _VERIFIED.inc()
+            return proxy
+
+        loop = asyncio.get_running_loop()
+        async with contextlib.AsyncExitStack() as stack:
+            sessions = []
+            for v in validators:
+                connector = aiohttp.TCPConnector(limit=concurrency)
+                sessions.append(await stack.enter_async_context(v.new_asession(connector=connector)))
+
+            pending = set()
+            for proxy in proxies:
+                if len(pending) >= concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        progress_count += 1
+                        self._report_progress(task.result(), progress_count, proxy_count, report_every)
+                pending.add(asyncio.ensure_future(run(sessions, proxy)))
+
+            for task in asyncio.as_completed(pending):
+                progress_count += 1
+                self._report_progress(await task, progress_count, proxy_count, report_every)
+
+    @staticmethod
+    def _validators(validator) -> list:
+        validators = list(validator) if isinstance(validator, (list, tuple)) else [validator]
+        if not validators:
+            raise ValueError('At least one validator is required.')
+        return validators
+
+    def _report_progress(self, proxy, progress_count, proxy_count=None, report_every=1):
+        if progress_count % report_every and progress_count != proxy_count:
+            return
+        if proxy_count:
             progress = round(progress_count / proxy_count * 100, 2)
-            
-            print(f'Verified [ {progress}% | {progress_count}/{proxy_count} ] {proxy.proxy_url}')
-            if self._context and self._context.logger:
-                self._context.logger.info(f'ProxyPool: Verified [ {progress}% | {progress_count}/{proxy_count} ] {proxy.proxy_url}.')
+            status = f'{progress}% | {progress_count}/{proxy_count}'
+        else:
+            status = f'{progress_count}'
 
-        handler.close()
+        print(f'Verified [ {status} ] {proxy.proxy_url}')
+        if self._context and self._context.logger:
+            self._context.logger.info(f'ProxyPool: Verified [ {status} ] {proxy.proxy_url}.')
 
     def to_naive(self):
-        return [dict(p) for p in self._proxylist]
+        return [dict(p) for p in self._proxylist.values()]
 
     def to_json(self, fp:str):
-        with open(fp, mode="w") as json_file:
-            json.dump(self.to_naive(), json_file, cls=self.ModelJsonEncoder)
+        """逐个写入 JSON 数组。导出为 CSV 、JSON Lines 或 gzip 压缩的文件见 exporter 模块。"""
+        from exporter import JsonExporter
+        JsonExporter(fp).export(self._proxylist.values())
  
     def to_jsons(self):
         return json.dumps(self.to_naive(), cls=self.ModelJsonEncoder)
     
     def to_csv(self, fp:str):
-        pandas.DataFrame(self.to_naive()).to_csv(fp, encoding='utf-8')
+        from exporter import CsvExporter
+        CsvExporter(fp).export(self._proxylist.values())
+
+    def to_jsonl(self, fp:str):
+        from exporter import JsonLinesExporter
+        JsonLinesExporter(fp).export(self._proxylist.values())
+
+    def to_redis(self, conn_config, key, ex, scores:dict=None, default_score:float=60, elapsed_timedelta=None):
+        """以 RedisProxyStore 的结构写入 Redis（每个代理一个哈希，按协议分组的有序集合），ex 秒后过期。
 
-    def to_redis(self, conn_config, key, ex):
+        scores 为 {proxy_url: 分数}（越小越好）。未提供时取 proxy_stats 表中最近 elapsed_timedelta（默认 1 天）内
+        有效响应的平均响应时长（需要先调用 MySQLOperation.init_pool()）；没有分数的代理为 default_score 。
+        """
+        import redis
+        from datetime import timedelta as Timedelta
+
+        if scores is None:
+            scores = MySQLMapper.find_response_elapsed_means(elapsed_timedelta or Timedelta(days=1))
         with redis.StrictRedis(**conn_config) as r:
-            r.setex(key, ex, self.to_jsons())
+            items = [(p, float(scores[p.proxy_url]) if scores.get(p.proxy_url) is not None else default_score) for p in self._proxylist.values()]
+            RedisProxyStore(r, key, ttl=ex).update(items)
 
     def __len__(self):
         return len(self._proxylist)
 
+    def __iter__(self):
+        return iter(self._proxylist.values())
+
+    def __contains__(self, proxy):
+        """proxy 可以是 Proxy 实例，也可以是 proxy_url 。"""
+        return getattr(proxy, 'proxy_url', proxy) in self._proxylist
+
     class ModelJsonEncoder(json.JSONEncoder):
         def default(self, o):
             if isinstance(o, Datetime):
@@ -81,6 +283,104 @@ class ProxyPool:
                 return json.JSONEncoder.default(o)
 
 
+class RedisProxyStore:
+    """代理在 Redis 中的结构化存储，key 为键名前缀：
+
+    * `<key>:proxy:<proxy_url>` ：哈希，代理的各个字段，ttl 秒后过期。
+    * `<key>:all` 、`<key>:protocol:<protocol>` ：有序集合，成员为 proxy_url ，分数越小越好（如平均响应时长），
+      `ZRANGE <key>:protocol:http 0 9` 即可取得最好的 10 个 HTTP 代理。
+    * `<key>:expire` ：有序集合，成员的过期时间，update() 和 top() 时清理有序集合中已过期的成员。
+
+    有序集合本身也在 ttl 秒后过期（每次 update() 时刷新），写入停止后，直接读取有序集合的使用者不会一直读到失效的代理。
+    所有写入都在一个 pipeline 中完成。
+    """
+
+    def __init__(self, client, key:str='proxy_pool', ttl:int=3600):
+        self._client = client
+        self._key = key
+        self._ttl = ttl
+
+    def update(self, items) -> int:
+        """写入或刷新 [(proxy, score), ...] ，返回写入的代理数量。"""
+        now = time.time()
+        count = 0
+        protocols = set()
+        with self._client.pipeline(transaction=False) as pipe:
+            for proxy, score in items:
+                url = proxy.proxy_url
+                detail = {k: self.__to_str(v) for k, v in proxy}
+                pipe.hset(self.__proxy_key(url), mapping=detail)
+                pipe.expire(self.__proxy_key(url), self._ttl)
+                pipe.zadd(f'{self._key}:all', {url: score})
+                pipe.zadd(self.__protocol_key(proxy.protocol), {url: score})
+                pipe.sadd(f'{self._key}:protocols', proxy.protocol)
+                pipe.zadd(f'{self._key}:expire', {url: now + self._ttl})
+                protocols.add(proxy.protocol)
+                count += 1
+            for name in ('all', 'protocols', 'expire'):
+                pipe.expire(f'{self._key}:{name}', self._ttl)
+            for protocol in protocols:
+                pipe.expire(self.__protocol_key(protocol), self._ttl)
+            pipe.execute()
+        self.purge_expired()
+        return count
+
+    def purge_expired(self) -> int:
+        """从有序集合中移除已过期的代理，返回移除的数量。"""
+        expired = self._client.zrangebyscore(f'{self._key}:expire', '-inf', time.time())
+        if not expired:
+            return 0
+        protocols = self._client.smembers(f'{self._key}:protocols')
+        with self._client.pipeline(transaction=False) as pipe:
+            pipe.zrem(f'{self._key}:all', *expired)
+            for protocol in protocols:
+                pipe.zrem(self.__protocol_key(self.__to_str(protocol)), *expired)
+            pipe.zrem(f'{self._key}:expire', *expired)
+            pipe.execute()
+        return len(expired)
+
+    def remove(self, proxy_urls) -> int:
+        proxy_urls = list(proxy_urls)
+        if not proxy_urls:
+            return 0
+        protocols = self._client.smembers(f'{self._key}:protocols')
+        with self._client.pipeline(transaction=False) as pipe:
+            pipe.delete(*[self.__proxy_key(url) for url in proxy_urls])
+            pipe.zrem(f'{self._key}:all', *proxy_urls)
+            for protocol in protocols:
+                pipe.zrem(self.__protocol_key(self.__to_str(protocol)), *proxy_urls)
+            pipe.zrem(f'{self._key}:expire', *proxy_urls)
+            pipe.execute()
+        return len(proxy_urls)
+
+    def top(self, num:int=10, protocol:str=None) -> list:
+        """返回分数最小的至多 num 个代理（字段均为字符串的 dict），跳过已过期的代理。"""
+        self.purge_expired()
+        zkey = self.__protocol_key(protocol) if protocol else f'{self._key}:all'
+        urls = [self.__to_str(url) for url in self._client.zrange(zkey, 0, num - 1)]
+        with self._client.pipeline(transaction=False) as pipe:
+            for url in urls:
+                pipe.hgetall(self.__proxy_key(url))
+            details = pipe.execute() if urls else []
+        return [{self.__to_str(k): self.__to_str(v) for k, v in d.items()} for d in details if d]
+
+    def __proxy_key(self, proxy_url:str) -> str:
+        return f'{self._key}:proxy:{proxy_url}'
+
+    def __protocol_key(self, protocol:str) -> str:
+        return f'{self._key}:protocol:{protocol}'
+
+    @staticmethod
+    def __to_str(value) -> str:
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        elif isinstance(value, Datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        elif value is None:
+            return ''
+        return str(value)
+
+
 class ProxyLoaderContext:
     def __init__(self, job_name, job_time=None, logger=None): 
         self.job_name = job_name
@@ -96,6 +396,9 @@ class ProxyLoader:
     def load(self) -> list:
         raise NotImplementedError()
 
+    def iter_load(self):
+        yield from self.load()
+
     @staticmethod
     def proxy_url(ip, port, protocol='http'):
         return f'{protocol}://{ip}:{port}'
@@ -113,32 +416,38 @@ class FatezeroProxySpider(ProxySpider):
     _POOL_URL = 'http://proxylist.fatezero.org/proxy.list'
 
     def load(self) -> list:
-        ls = []
+        return list(self.iter_load())
+
+    def iter_load(self):
+        """以流的方式逐行解析代理列表，解析满 num 个代理后立即停止下载。"""
+        if self._num is not None and self._num <= 0:
+            return
 
         if self._context and self._context.logger:
             self._context.logger.info('FatezeroProxySpider: loading proxy list.')
         try:
-            res = requests.get(FatezeroProxySpider._POOL_URL, proxies=self._sys_proxy, timeout=self._timeout)
-            for text in res.text.split('\n'):
-                try:
-                    p = json.loads(text, encoding='utf-8')
-                    proxy = Proxy()
-                    proxy.ip = p['host']
-                    proxy.port = p['port']
-                    proxy.protocol = p['type']
-                    proxy.proxy_url = self.proxy_url(proxy.ip, proxy.port, proxy.protocol)
-                    proxy.collect_time = Datetime.now()
-                    proxy.local = Config.local
-                    ls.append(proxy)
-                except:
-                    pass
-            if self._num is None:
-                return ls
-            else:
-                return ls[:self._num]
-        except:
+            count = 0
+            with requests.get(self._POOL_URL, proxies=self._sys_proxy, timeout=self._timeout, stream=True) as res:
+                for line in res.iter_lines():
+                    try:
+                        p = json.loads(line)
+                        proxy = Proxy()
+                        proxy.ip = p['host']
+                        proxy.port = p['port']
+                        proxy.protocol = p['type']
+                        proxy.proxy_url = self.proxy_url(proxy.ip, proxy.port, proxy.protocol)
+                        proxy.collect_time = Datetime.now()
+                        proxy.local = Config.local
+                    except:
+                        continue
+
+                    yield proxy
+                    count += 1
+                    if self._num is not None and count >= self._num:
+                        break
+        except Exception:
             if self._context and self._context.logger:
-                self._context.logger.exception('FatezeroProxySpider: Failed be load proxy list.')
+                self._context.logger.exception('FatezeroProxySpider: Failed to load proxy list.')
             raise
 
 
@@ -173,7 +482,7 @@ class SixSixIPProxySpider(ProxySpider):
             return ls
         except:
             if self._context and self._context.logger:
-                self._context.logger.exception('SixSixIPProxySpider: Failed be load proxy list.')
+                self._context.logger.exception('SixSixIPProxySpider: Failed to load proxy list.')
             raise
 
 
@@ -182,6 +491,10 @@ class DatabaseProxyLoader(ProxyLoader):
 
 
 class MySQLProxyLoader(DatabaseProxyLoader):
+    def __init__(self, context=None, chunk_size=1000):
+        super().__init__(context)
+        self._chunk_size = chunk_size
+
     def load(self):
         if self._context and self._context.logger:
             self._context.logger.info('MySQLProxyLoader: loading proxy list.')
@@ -190,32 +503,282 @@ class MySQLProxyLoader(DatabaseProxyLoader):
             return MySQLOperation.select_all(Proxy)
         except:
             if self._context and self._context.logger:
-                self._context.logger.exception('MySQLProxyLoader: Failed be load proxy list.')
+                self._context.logger.exception('MySQLProxyLoader: Failed to load proxy list.')
+            raise
+
+    def iter_load(self):
+        """使用服务端游标逐个产出代理，每次从数据库读取 chunk_size 行。"""
+        if self._context and self._context.logger:
+            self._context.logger.info('MySQLProxyLoader: loading proxy list.')
+
+        try:
+            yield from MySQLOperation.iter_select_all(Proxy, self._chunk_size)
+        except Exception:
+            if self._context and self._context.logger:
+                self._context.logger.exception('MySQLProxyLoader: Failed to load proxy list.')
             raise
 
 
 class SimpleMySQLProxyLoder(MySQLProxyLoader):
-    def __init__(self, proxy_test_filter, context=None):
-        super().__init__(context=context)
+    def __init__(self, proxy_test_filter, context=None, chunk_size=1000, from_stats=False):
+        """from_stats 为 True 时从 proxy_stats 表中汇总（需要使用 MySQLTestLogInserter 写入测试日志），
+        不再扫描 test_log 表。"""
+        super().__init__(chunk_size=chunk_size, context=context)
         self._proxy_test_filter = proxy_test_filter
-        self._entity = Proxy()
+        self._from_stats = from_stats
 
     def load(self):
         if self._context and self._context.logger:
             self._context.logger.info('SimpleMySQLProxyLoder: loading proxy list.')
 
         try:
-            field_names = self._entity._metadata.keys()
-            ptf_cond = self._proxy_test_filter._conditions
-            pf_cond = self._proxy_test_filter._proxy_filter._conditions \
-                if self._proxy_test_filter._proxy_filter \
-                else {}
-            return MySQLMapper.find_proxies(pf_cond, ptf_cond, field_names)
+            pf_cond, ptf_cond = self._conditions()
+            find_proxies = MySQLMapper.find_proxies_by_stats if self._from_stats else MySQLMapper.find_proxies
+            return find_proxies(pf_cond, ptf_cond, Proxy._fields)
         except:
             if self._context and self._context.logger:
-                self._context.logger.exception('SimpleMySQLProxyLoder: Failed be load proxy list.')
+                self._context.logger.exception('SimpleMySQLProxyLoder: Failed to load proxy list.')
             raise
 
+    def iter_load(self):
+        if self._context and self._context.logger:
+            self._context.logger.info('SimpleMySQLProxyLoder: loading proxy list.')
+
+        try:
+            pf_cond, ptf_cond = self._conditions()
+            iter_find_proxies = MySQLMapper.iter_find_proxies_by_stats if self._from_stats else MySQLMapper.iter_find_proxies
+            yield from iter_find_proxies(pf_cond, ptf_cond, Proxy._fields, self._chunk_size)
+        except Exception:
+            if self._context and self._context.logger:
+                self._context.logger.exception('SimpleMySQLProxyLoder: Failed to load proxy list.')
+            raise
+
+    def _conditions(self):
+        ptf_cond = self._proxy_test_filter._conditions
+        pf_cond = self._proxy_test_filter._proxy_filter._conditions \
+            if self._proxy_test_filter._proxy_filter \
+            else {}
+        return pf_cond, ptf_cond
+
+
+class LeasedProxyLoader(DatabaseProxyLoader):
+    """分片验证：多个进程或主机通过 verify_lease 表分担同一轮（run_name）验证，互不重叠。
+
+    队列按 (run_name, local) 划分，local 默认为 Config.local ：同一位置的 worker 分担验证，不同位置的 worker 各自验证全部代理。
+    iter_load() 每次领取 batch_size 个代理，租约 lease_ttl 秒后到期，后台线程每 lease_ttl / 3 秒续租（心跳）；
+    worker 退出时归还未完成的租约，意外终止时租约到期后由其他 worker 重新领取。
+    队列为空但仍有其他 worker 的租约未到期时，每隔 poll_interval 秒再次尝试，以接手这些代理。
+    验证结果需要通过 MySQLLeaseFinisher 标记为已完成（见 ProxyValidateHandler 的 finish_handler）。
+
+        with LeasedProxyLoader('001_20201115') as loader:
+            loader.enqueue(MySQLProxyLoader().iter_load())
+            pool.verify(v, ProxyValidateHandler(..., finish_handler=MySQLLeaseFinisher(loader)), proxies=pool.iter_load(loader))
+    """
+
+    def __init__(self, run_name:str, batch_size:int=100, lease_ttl:int=300, poll_interval:float=10, local:str=None, worker:str=None, context=None):
+        super().__init__(context)
+        self.run_name = run_name
+        self.local = local or Config.local
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self._batch_size = batch_size
+        self._lease_ttl = lease_ttl
+        self._poll_interval = poll_interval
+        self._heartbeat = None
+        self._closed = threading.Event()
+
+    def enqueue(self, proxies) -> int:
+        """将代理加入本轮的队列，已在队列中的代理不变，因此各个 worker 可以重复执行。"""
+        count, chunk = 0, []
+        for proxy in proxies:
+            chunk.append(proxy)
+            if len(chunk) >= 1000:
+                count += MySQLMapper.enqueue_verify_leases(self.run_name, self.local, chunk)
+                chunk = []
+        count += MySQLMapper.enqueue_verify_leases(self.run_name, self.local, chunk)
+        return count
+
+    def load(self) -> list:
+        """领取一批代理。"""
+        self.__start_heartbeat()
+        return MySQLMapper.claim_verify_leases(self.run_name, self.local, self.worker, self._batch_size, self._lease_ttl)
+
+    def iter_load(self):
+        """逐批领取代理，直到本轮的代理都已验证或由其他 worker 持有有效的租约。"""
+        while not self._closed.is_set():
+            batch = self.load()
+            if batch:
+                self.__log(f'LeasedProxyLoader: {len(batch)} proxies claimed by "{self.worker}".')
+                yield from batch
+                continue
+
+            progress = self.progress()
+            if progress['pending'] == 0 and progress['leased'] == progress['own']:
+                break
+            # 待领取的行正被其他 worker 的事务锁定时稍后重试
+            self._closed.wait(self._poll_interval if progress['pending'] == 0 else 0.1)
+
+    def finish(self, proxies) -> int:
+        return MySQLMapper.finish_verify_leases(self.run_name, self.local, [p.proxy_url for p in proxies])
+
+    def progress(self) -> dict:
+        return MySQLMapper.verify_lease_progress(self.run_name, self.local, self.worker)
+
+    def close(self):
+        """停止心跳，并归还未完成的租约。应在验证结束（处理器关闭）之后调用。"""
+        self._closed.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        released = MySQLMapper.release_verify_leases(self.run_name, self.local, self.worker)
+        if released:
+            self.__log(f'LeasedProxyLoader: {released} unfinished leases released by "{self.worker}".')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self.__heartbeat_loop, daemon=True)
+            self._heartbeat.start()
+
+    def __heartbeat_loop(self):
+        while not self._closed.wait(self._lease_ttl / 3):
+            try:
+                MySQLMapper.renew_verify_leases(self.run_name, self.local, self.worker, self._lease_ttl)
+            except Exception:
+                if self._context and self._context.logger:
+                    self._context.logger.exception('LeasedProxyLoader: Failed to renew leases.')
+
+    def __log(self, msg):
+        if self._context and self._context.logger:
+            self._context.logger.info(msg)
+
+
+class _TimedConnectionMixin:
+    def connect(self):
+        start = time.time()
+        try:
+            super().connect()
+        finally:
+            timer = TimedHTTPAdapter.connect_timer
+            timer.elapsed = getattr(timer, 'elapsed', 0) + time.time() - start
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """会记录建立连接耗时（包括代理隧道和 TLS 握手）的 HTTPAdapter 。
+
+    耗时累加在线程局部变量 connect_timer.elapsed 中，复用的连接不计时。
+    """
+    connect_timer = threading.local()
+    _POOL_CLASSES = {'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self._POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if not proxy.lower().startswith('socks'):
+            manager.pool_classes_by_scheme = self._POOL_CLASSES
+        return manager
+
+    @classmethod
+    def reset_timer(cls):
+        cls.connect_timer.elapsed = 0
+
+    @classmethod
+    def connect_elapsed(cls):
+        return getattr(cls.connect_timer, 'elapsed', 0)
+
+
+class TokenBucket:
+    """令牌桶限速：每秒补充 rate 个令牌，最多积攒 burst 个。有令牌时 acquire() 立即返回，否则只等待到下一个令牌产生。
+
+    shared() 按 key（如验证网站名称）返回同一个令牌桶，同一进程内访问同一网站的所有验证器共用一个速率。
+    """
+    _SHARED = {}
+    _SHARED_LOCK = threading.Lock()
+
+    def __init__(self, rate:float, burst:float=None):
+        self._rate = rate
+        self._burst = burst or max(rate, 1)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, key, rate:float, burst:float=None):
+        with cls._SHARED_LOCK:
+            if key not in cls._SHARED:
+                cls._SHARED[key] = cls(rate, burst)
+            return cls._SHARED[key]
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self):
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def _take(self) -> float:
+        """取出一个令牌并返回 0 ；没有令牌时返回需要等待的秒数。"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self._rate
+
+
+class _CappedReader:
+    """逐块接收响应内容，最多保留 max_bytes 字节；提供 needles 时，任意一个出现后即可停止读取。"""
+
+    def __init__(self, max_bytes:int=None, needles:tuple=()):
+        self.max_bytes = max_bytes
+        self.needles = needles
+        self.buffer = bytearray()
+        self.matched = False
+        self.truncated = False
+
+    def feed(self, chunk:bytes) -> bool:
+        """加入一块内容，返回是否应当停止读取。"""
+        if self.max_bytes is not None and len(self.buffer) + len(chunk) >= self.max_bytes:
+            chunk = chunk[:self.max_bytes - len(self.buffer)]
+            self.truncated = True
+        # 从上一块末尾回退 needle 长度开始查找，避免遗漏跨块的匹配
+        start = max(len(self.buffer) - max([len(n) for n in self.needles], default=0), 0)
+        self.buffer += chunk
+        self.matched = any([self.buffer.find(n, start) >= 0 for n in self.needles])
+        return self.matched or self.truncated
+
 
 class ProxyValidatorContext:
     def __init__(self, job_name, job_time=None, logger=None): 
@@ -225,18 +788,148 @@ class ProxyValidatorContext:
 
 
 class ProxyValidator:
+    """代理验证器。
+
+    响应内容以流的方式读取，最多读取 max_bytes 字节（None 表示不限制）；
+    early_match 为 True 时，验证所需的内容（如IP、关键词）一旦出现就停止读取，
+    此时 transfer_size 、transfer_elapsed 和 response_body 都只对应已读取的部分。
+    设置 rate_limit 时，对同一 website_name 的请求速率不超过每秒 rate_limit 次（允许突发 burst 次），见 TokenBucket 。
+    """
+    _CHUNK_SIZE = 8192
     __REQUEST_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.108 Safari/537.36'}
 
-    def __init__(self, website_name, http_url, https_url, timeout, context=None):
-        self._request_config = dict(timeout=timeout, headers=self.__REQUEST_HEADERS)
+    def __init__(self, website_name, http_url, https_url, timeout, context=None, max_bytes=1024 * 1024, early_match=True,
+            rate_limit=None, burst=None):
+        self._request_config = dict(timeout=timeout, headers=self.__REQUEST_HEADERS, stream=True)
         self._website_name = website_name
         self._http_url = http_url
         self._https_url = https_url
+        self._timeout = timeout
         self._job_time = Datetime.now() if not context or not context.job_time else context.job_time
         self._verification_ip = False
+        self._max_bytes = max_bytes
+        self._early_match = early_match
+        self._rate_limiter = TokenBucket.shared(website_name, rate_limit, burst) if rate_limit else None
         self._context = context
 
-    def verify(self, proxy:Proxy) -> TestLog:
+    def new_session(self) -> requests.Session:
+        """创建 verify() 使用的会话。同一代理的多次验证共用一个会话，可以复用连接。"""
+        session = requests.Session()
+        session.mount('http://', TimedHTTPAdapter())
+        session.mount('https://', TimedHTTPAdapter())
+        return session
+
+    def new_asession(self, **kwargs):
+        """创建 averify() 使用的 aiohttp.ClientSession ，kwargs 会传递给 ClientSession 。"""
+        import aiohttp
+
+        async def on_connection_create_start(session, trace_config_ctx, params):
+            trace_config_ctx.connect_start = time.time()
+
+        async def on_connection_create_end(session, trace_config_ctx, params):
+            timing = trace_config_ctx.trace_request_ctx
+            if timing is not None:
+                timing['connect_elapsed'] += time.time() - trace_config_ctx.connect_start
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return aiohttp.ClientSession(trace_configs=[trace_config], **kwargs)
+
+    def verify(self, proxy:Proxy, session:requests.Session=None) -> TestLog:
+        """验证代理。
+
+        connect_elapsed 为建立连接的耗时，response_elapsed（首字节）和 transfer_elapsed（传输完毕）均不含建立连接的耗时。
+        未指定 session 时，使用一个仅供本次验证的会话。
+        """
+        if session is None:
+            with self.new_session() as session:
+                return self.verify(proxy, session)
+
+        tl = self._new_test_log(proxy)
+        if tl.website_url is None:
+            return None
+        begin = time.perf_counter()
+        try:
+            proxies = {proxy.protocol: proxy.proxy_url}
+            if self._rate_limiter:
+                self._rate_limiter.acquire()
+                begin = time.perf_counter()
+            TimedHTTPAdapter.reset_timer()
+            start = time.time()
+            with session.get(tl.website_url, proxies=proxies, **self._request_config) as response:
+                reader = self._new_reader(proxy, response.encoding)
+                for chunk in response.iter_content(self._CHUNK_SIZE):
+                    if reader.feed(chunk):
+                        break
+                    # requests 的 timeout 只限制单次读取，这里限制读取响应内容的总时长
+                    if time.time() - start > self._timeout:
+                        raise requests.ReadTimeout(f'Reading response exceeded {self._timeout}s.')
+                end = time.time()
+            connect_elapsed = TimedHTTPAdapter.connect_elapsed()
+
+            tl.connect_elapsed = round(connect_elapsed, 4)
+            tl.response_elapsed = round(max(response.elapsed.total_seconds() - connect_elapsed, 0), 4)
+            tl.transfer_elapsed = round(end - start - connect_elapsed, 4)
+            self._fill_response(tl, proxy, reader, str(response.headers), response.encoding)
+        except requests.Timeout:
+            tl.timeout_exception = True
+        except:
+            tl.exception = traceback.format_exc()
+        self._record(tl, time.perf_counter() - begin)
+        return tl
+
+    async def averify(self, proxy:Proxy, session) -> TestLog:
+        """verify() 的协程版本，session 由 new_asession() 创建。"""
+        import aiohttp
+
+        tl = self._new_test_log(proxy)
+        if tl.website_url is None:
+            return None
+        begin = time.perf_counter()
+        try:
+            # aiohttp 只支持 HTTP 代理，https 代理即通过 CONNECT 建立隧道的 HTTP 代理
+            proxy_url = ProxyLoader.proxy_url(proxy.ip, proxy.port)
+            timeout = aiohttp.ClientTimeout(total=self._timeout)
+            timing = dict(connect_elapsed=0)
+            if self._rate_limiter:
+                await self._rate_limiter.aacquire()
+                begin = time.perf_counter()
+            start = time.time()
+            async with session.get(tl.website_url, proxy=proxy_url, timeout=timeout, headers=self.__REQUEST_HEADERS, trace_request_ctx=timing) as response:
+                response_end = time.time()
+                reader = self._new_reader(proxy, response.charset)
+                async for chunk in response.content.iter_chunked(self._CHUNK_SIZE):
+                    if reader.feed(chunk):
+                        break
+            end = time.time()
+            connect_elapsed = timing['connect_elapsed']
+
+            tl.connect_elapsed = round(connect_elapsed, 4)
+            tl.response_elapsed = round(response_end - start - connect_elapsed, 4)
+            tl.transfer_elapsed = round(end - start - connect_elapsed, 4)
+            self._fill_response(tl, proxy, reader, str(response.headers), response.charset)
+        except asyncio.TimeoutError:
+            tl.timeout_exception = True
+        except:
+            tl.exception = traceback.format_exc()
+        self._record(tl, time.perf_counter() - begin)
+        return tl
+
+    def _record(self, tl:TestLog, elapsed:float):
+        """记录验证耗时（不含等待令牌的时间）和验证结果。"""
+        if tl.timeout_exception:
+            result = 'timeout'
+        elif tl.exception:
+            result = 'error'
+        elif tl.proxy_exception:
+            result = 'proxy_exception'
+        else:
+            result = 'valid' if tl.transfer_size else 'empty'
+        _CHECK_SECONDS.observe(elapsed, website=self._website_name)
+        _CHECKS.inc(website=self._website_name, result=result)
+
+    def _new_test_log(self, proxy:Proxy) -> TestLog:
         if self._context and self._context.logger:
             validator_name = self.__class__.__name__
             self._context.logger.info(f'{validator_name}: Verifying proxy "{proxy.proxy_url}".')
@@ -245,6 +938,7 @@ class ProxyValidator:
         tl.proxy_url = proxy.proxy_url
         tl.website_name = self._website_name
         tl.website_url = self._get_url(proxy.protocol)
+        tl.connect_elapsed = 0
         tl.response_elapsed = 0
         tl.transfer_elapsed = 0
         tl.transfer_size = 0
@@ -256,27 +950,31 @@ class ProxyValidator:
         tl.response_head = None
         tl.response_body = None
         tl.exception = None
-
-        if tl.website_url is None:
-            return None
-        try:
-            proxies = {proxy.protocol: proxy.proxy_url}
-            start = time.time()
-            response = requests.get(tl.website_url, proxies=proxies, **self._request_config)
-            end = time.time()
-
-            tl.response_elapsed = round(response.elapsed.total_seconds(), 4)
-            tl.transfer_elapsed = round(end - start, 4)
-            tl.transfer_size = len(response.content)
-            tl.proxy_exception = self._proxy_exception(proxy, response)
-            tl.response_head = str(response.headers)
-            tl.response_body = response.text
-        except requests.Timeout:
-            tl.timeout_exception = True
-        except:
-            tl.exception = traceback.format_exc()
         return tl
 
+    def _new_reader(self, proxy:Proxy, encoding:str) -> _CappedReader:
+        """needles 按解码响应时使用的编码严格编码；无法编码的 needle（如 ISO-8859-1 下的中文）不参与提前匹配。"""
+        needles = []
+        if self._early_match:
+            for n in self._needles(proxy):
+                try:
+                    needles.append(n.encode(encoding or 'utf-8'))
+                except (UnicodeEncodeError, LookupError):
+                    continue
+        return _CappedReader(self._max_bytes, tuple([n for n in needles if n]))
+
+    def _fill_response(self, tl:TestLog, proxy:Proxy, reader:_CappedReader, head:str, encoding:str):
+        text = bytes(reader.buffer).decode(encoding or 'utf-8', errors='replace')
+        tl.transfer_size = len(reader.buffer)
+        # 提前匹配只决定何时停止读取，结果仍以解码后的内容为准（多字节编码中字节匹配不一定对应字符匹配）
+        tl.proxy_exception = self._proxy_exception(proxy, text)
+        tl.response_head = head
+        tl.response_body = text
+
+    def _needles(self, proxy:Proxy) -> tuple:
+        """验证所需的内容，任意一个出现在响应中即可提前停止读取。"""
+        return ()
+
     def _get_url(self, protocol:str):
         if protocol == 'http':
             return self._http_url
@@ -285,7 +983,7 @@ class ProxyValidator:
         else:
             return None
 
-    def _proxy_exception(self, proxy:Proxy, response:requests.Response):
+    def _proxy_exception(self, proxy:Proxy, text:str):
         return False
 
 
@@ -295,21 +993,27 @@ class IPValidator(ProxyValidator):
     PLAN_IP_CN = dict(website_name='ip.cn', http_url=None, https_url='https://ip.cn/')
     PLAN_WHATISMYIP_AKAMAI_COM = dict(website_name='whatismyip.akamai.com', http_url='http://whatismyip.akamai.com/', https_url='https://whatismyip.akamai.com/')
 
-    def __init__(self, website_name, http_url, https_url, timeout=5, context=None):
-        super().__init__(website_name, http_url, https_url, timeout, context)
+    def __init__(self, website_name, http_url, https_url, timeout=5, context=None, **keyword):
+        super().__init__(website_name, http_url, https_url, timeout, context, **keyword)
         self._verification_ip = True
 
-    def _proxy_exception(self, proxy:Proxy, response:requests.Response):
-        return proxy.ip not in response.text
+    def _proxy_exception(self, proxy:Proxy, text:str):
+        return proxy.ip not in text
+
+    def _needles(self, proxy:Proxy) -> tuple:
+        return (proxy.ip,)
 
 
 class KeywordValidator(ProxyValidator):
     PLAN_BAIDU_SUG = dict(website_name='百度SUG', http_url=None, https_url='https://www.baidu.com/su', kw='window.baidu.sug')
     PLAN_ZHIHU_SIGNIN = dict(website_name='知乎登录', http_url=None, https_url='https://www.zhihu.com/signin', kw='有问题，上知乎')
 
-    def __init__(self, website_name, http_url, https_url, kw, timeout=5, context=None):
-        super().__init__(website_name, http_url, https_url, timeout, context)
+    def __init__(self, website_name, http_url, https_url, kw, timeout=5, context=None, **keyword):
+        super().__init__(website_name, http_url, https_url, timeout, context, **keyword)
         self._kw = kw
 
-    def _proxy_exception(self, proxy:Proxy, response:requests.Response):
-        return self._kw not in response.text
+    def _proxy_exception(self, proxy:Proxy, text:str):
+        return self._kw not in text
+
+    def _needles(self, proxy:Proxy) -> tuple:
+        return (self._kw,)
@@ -1,4 +1,4 @@
-import sys, logging
+import os, sys, logging
 from datetime import datetime as Datetime
 from config import Config
 from iproxy import ProxyPool
@@ -29,9 +29,10 @@ class Jobs:
 
         from iproxy import ProxyPoolContext, ProxyLoaderContext, ProxyValidatorContext, \
             FatezeroProxySpider, IPValidator
-        from handler import HandlerContext, ProxyValidateHandler, MySQLStreamInserter
+        from handler import HandlerContext, ProxyValidateHandler, MySQLStreamInserter, MySQLTestLogInserter
         from datetime import timedelta as Timedelta
         from database import MySQLOperation
+        from db_mapper import MySQLMapper
 
         ## 0. 配置上下文，为各个组件提供全局环境
         ctx = {
@@ -50,13 +51,14 @@ class Jobs:
             num=5000,                                 # 需要加载的代理数量
             context=ProxyLoaderContext(**ctx),
         )
-        # 执行加载
-        pool.load(loader)
+        # 流式加载，边下载边验证（也可以使用 pool.load(loader) 一次性加载）
+        proxies = pool.iter_load(loader)
 
         ## 3. 准备验证器
         v = IPValidator(
             **IPValidator.PLAN_IP138,               # 指定验证方式，这里使用预定义方案
             timeout=5,                              # 设置超时（可选）
+            rate_limit=10,                          # 对该网站每秒最多请求次数（可选，同名网站共用）
             context=ProxyValidatorContext(**ctx),
         )
 
@@ -86,12 +88,18 @@ class Jobs:
         ph = MySQLStreamInserter(
             buffer_size=50,                         # 缓冲区大小
             concurrency=10,                         # 最大并发数量
+            linger=10,                              # 缓冲区中数据的最长等待时间（秒，可选）
+            upsert=True,                            # 代理已存在时更新（入池时间保持不变），而不是插入失败
+            dead_letter_path=context.dead_letter_path('proxy'),  # 最终未能写入的数据（可选，默认只记录日志）
             context=HandlerContext(**ctx),
         )
-        # 创建测试日志处理器
-        tlh = MySQLStreamInserter(
+        # 创建测试日志处理器（同时累加 proxy_stats 统计）
+        tlh = MySQLTestLogInserter(
             buffer_size=50,                         # 缓冲区大小
             concurrency=10,                         # 最大并发数量
+            linger=10,                              # 缓冲区中数据的最长等待时间（秒，可选）
+            capture='zlib',                         # 响应内容压缩去重后保存（可选，默认原样保存）
+            dead_letter_path=context.dead_letter_path('test_log'),
             context=HandlerContext(**ctx),
         )
         # 创建验证结果处理器，负责达标代理的处理（如入库）
@@ -105,12 +113,144 @@ class Jobs:
         ## 6. 执行验证
         MySQLOperation.init_pool()
         pool.verify(
-            validator=v,                            # 验证器
+            validator=v,                            # 验证器（也可以是验证器列表，同一代理在各验证器上同时验证）
+            proxies=proxies,                        # 待验证的代理（可选，默认为池中的代理）
             handler=h,                              # 处理器
             repeat=3,                               # 每个代理的重复验证次数
             concurrency=10,                         # 最大并发数量
-            sleep=1,                                # 线程间歇（秒）
+            report_every=100,                       # 每验证 100 个代理报告一次进度（可选）
         )
+
+        ## 7. 合并 7 天前的按小时统计，使 proxy_stats 的行数与代理数量成正比（不小于过滤器的 pre_tested_timedelta）
+        MySQLMapper.rollup_proxy_stats(keep=Timedelta(days=7))
+        MySQLOperation.close_pool()
+
+    def job_002(self, context):
+        """这个作业的名称是 002 ：分片验证数据库中的全部代理
+
+        可以在多个进程或主机上同时启动，当天同一位置（Config.local）的各个 worker 分担验证，互不重叠；
+        某个 worker 意外终止时，它领取的代理在租约到期后由其他 worker 重新验证。
+
+        启动方式：$ python jobs.py start 002
+        """
+
+        from iproxy import ProxyPoolContext, ProxyLoaderContext, ProxyValidatorContext, \
+            MySQLProxyLoader, LeasedProxyLoader, IPValidator
+        from handler import HandlerContext, ProxyValidateHandler, MySQLStreamInserter, MySQLTestLogInserter, MySQLLeaseFinisher
+        from datetime import timedelta as Timedelta
+        from database import MySQLOperation
+
+        ctx = {
+            'job_name': context.job_name,
+            'job_time': context.job_time,
+            'logger': context.logger,
+        }
+        pool = ProxyPool(context=ProxyPoolContext(**ctx))
+        v = IPValidator(**IPValidator.PLAN_IP138, timeout=5, rate_limit=10, context=ProxyValidatorContext(**ctx))
+        ptf = SimpleProxyTestFilter(
+            timeout_exception_pr=0.34,
+            proxy_exception_pr=0.34,
+            valid_responses_pr=1,
+            pre_tested_timedelta=Timedelta(days=1),
+            pre_verification_ip=True,
+        )
+
+        MySQLOperation.init_pool()
+        # 同一天的 worker 共用一个验证轮次
+        with LeasedProxyLoader(
+            run_name=f"{context.job_name}_{context.job_time.strftime('%Y%m%d')}",
+            batch_size=100,                         # 每次领取的代理数量
+            lease_ttl=300,                          # 租约时长（秒），期间由心跳续租
+            context=ProxyLoaderContext(**ctx),
+        ) as loader:
+            # 入队是幂等的，先启动的 worker 负责即可
+            if loader.progress()['total'] == 0:
+                loader.enqueue(MySQLProxyLoader(context=ProxyLoaderContext(**ctx)).iter_load())
+
+            h = ProxyValidateHandler(
+                proxy_handler=MySQLStreamInserter(buffer_size=50, concurrency=10, linger=10, upsert=True,
+                    dead_letter_path=context.dead_letter_path('proxy'), context=HandlerContext(**ctx)),
+                test_log_handler=MySQLTestLogInserter(buffer_size=50, concurrency=10, linger=10, capture='zlib',
+                    dead_letter_path=context.dead_letter_path('test_log'), context=HandlerContext(**ctx)),
+                proxy_test_filter=ptf,
+                finish_handler=MySQLLeaseFinisher(loader, linger=10,   # 标记已验证的代理
+                    dead_letter_path=context.dead_letter_path('verify_lease'), context=HandlerContext(**ctx)),
+                context=HandlerContext(**ctx),
+            )
+            pool.verify(validator=v, proxies=pool.iter_load(loader), handler=h, repeat=3, concurrency=10)
+        MySQLOperation.close_pool()
+
+    def job_003(self, context):
+        """这个作业的名称是 003 ：常驻调度，持续重新验证代理
+
+        数据库中的代理在启动后的 10 分钟内陆续验证，爬虫每 10 分钟加载一次，新代理优先验证；
+        此后质量好的代理大约每 10 分钟验证一次，失效的代理按指数退避。
+
+        启动方式：$ python jobs.py start 003（按 Ctrl+C 停止）
+        """
+
+        from iproxy import ProxyLoaderContext, ProxyValidatorContext, MySQLProxyLoader, FatezeroProxySpider, IPValidator
+        from handler import HandlerContext, ProxyValidateHandler, MySQLStreamInserter, MySQLTestLogInserter
+        from scheduler import ProxyScheduler, ProxySchedulerContext
+        from datetime import timedelta as Timedelta
+        from database import MySQLOperation
+
+        ctx = {
+            'job_name': context.job_name,
+            'job_time': context.job_time,
+            'logger': context.logger,
+        }
+        v = IPValidator(**IPValidator.PLAN_IP138, timeout=5, rate_limit=10, context=ProxyValidatorContext(**ctx))
+        ptf = SimpleProxyTestFilter(
+            timeout_exception_pr=0.34,
+            proxy_exception_pr=0.34,
+            valid_responses_pr=1,
+            pre_tested_timedelta=Timedelta(days=1),
+            pre_verification_ip=True,
+        )
+        h = ProxyValidateHandler(
+            proxy_handler=MySQLStreamInserter(buffer_size=50, concurrency=10, linger=10, upsert=True,
+                dead_letter_path=context.dead_letter_path('proxy'), context=HandlerContext(**ctx)),
+            test_log_handler=MySQLTestLogInserter(buffer_size=50, concurrency=10, linger=10, capture='zlib',
+                dead_letter_path=context.dead_letter_path('test_log'), context=HandlerContext(**ctx)),
+            proxy_test_filter=ptf,
+            context=HandlerContext(**ctx),
+        )
+
+        MySQLOperation.init_pool()
+        scheduler = ProxyScheduler(
+            validator=v,
+            handler=h,
+            loaders=[FatezeroProxySpider(timeout=60, num=5000, context=ProxyLoaderContext(**ctx))],
+            budget=600,                             # 每分钟最多验证请求数
+            repeat=3,                               # 每个代理的重复验证次数
+            concurrency=10,                         # 最大并发数量
+            base_interval=600,                      # 质量最好的代理的验证间隔（秒）
+            max_interval=86400,                     # 最长验证间隔（秒）
+            drop_after=8,                           # 连续失败 8 次后不再验证
+            loader_interval=600,                    # 加载器的加载间隔（秒）
+            report_every=1000,                      # 每验证 1000 个代理报告一次进度
+            context=ProxySchedulerContext(**ctx),
+        )
+        scheduler.seed(MySQLProxyLoader(context=ProxyLoaderContext(**ctx)).iter_load())
+        scheduler.run()
+        MySQLOperation.close_pool()
+
+    def job_004(self, context):
+        """这个作业的名称是 004 ：合并 proxy_stats 中 7 天前的按小时统计
+
+        作业 001 执行后会自动合并；只运行作业 002 或 003 时，应每天启动一次这个作业。
+
+        启动方式：$ python jobs.py start 004
+        """
+
+        from datetime import timedelta as Timedelta
+        from database import MySQLOperation
+        from db_mapper import MySQLMapper
+
+        MySQLOperation.init_pool()
+        count = MySQLMapper.rollup_proxy_stats(keep=Timedelta(days=7))
+        context.logger.info(f'Rolled up proxy_stats into {count} rows.')
         MySQLOperation.close_pool()
 
 
@@ -122,6 +262,11 @@ class JobContext:
         logger_name = f"{self.job_name}_{self.job_time.strftime('%Y%m%d%H%M%S')}"
         self.logger = logging.getLogger(logger_name)
 
+    def dead_letter_path(self, name:str) -> str:
+        """处理器的死信文件（JSON Lines），与日志文件位于同一目录（未配置日志文件时为当前目录）。"""
+        dirname = os.path.dirname(Config.log.get('path') or '')
+        return os.path.join(dirname, f'{self.job_name}_{name}_dead_letter.jsonl')
+
 
 def init_logging():
     config = {
@@ -148,6 +293,18 @@ def init_logging():
     logging.basicConfig(**config)
 
 
+def init_metrics():
+    from metrics import REGISTRY
+
+    # 兼容没有 metrics 配置的旧 config.py
+    config = getattr(Config, 'metrics', None) or {}
+    if config.get('port'):
+        REGISTRY.serve(config['port'])
+    if config.get('snapshot_path'):
+        REGISTRY.start_snapshot(config['snapshot_path'], config.get('snapshot_interval') or 60)
+    return REGISTRY
+
+
 if __name__ == '__main__':
     init_logging()
 
@@ -158,4 +315,8 @@ if __name__ == '__main__':
         |  $ python jobs.py start name1 name2 name3 ...
         '''))
     elif sys.argv[1] == 'start':
-        Jobs().start(sys.argv[2:])
+        registry = init_metrics()
+        try:
+            Jobs().start(sys.argv[2:])
+        finally:
+            registry.stop()
@@ -0,0 +1,250 @@
+import json, time, bisect, threading
+from contextlib import contextmanager
+from datetime import datetime as Datetime
+
+
+class _Metric:
+    """指标的基类。每组标签值（按 labelnames 的顺序）对应一个样本；
+    也可以通过 set_function() 在采集时才计算样本的值（如队列长度），同一组标签的多个函数的结果相加。"""
+    type = None
+
+    def __init__(self, name:str, help:str='', labelnames:tuple=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def set_function(self, fn, **labels):
+        """fn 返回 None 时（如所属对象已被回收），该函数会被移除。"""
+        key = self._key(labels)
+        with self._lock:
+            self._functions.setdefault(key, []).append(fn)
+
+    def samples(self) -> list:
+        """返回 [(后缀, {标签}, 值), ...] 。"""
+        with self._lock:
+            values = dict(self._values)
+            functions = {key: list(fns) for key, fns in self._functions.items()}
+
+        for key, fns in functions.items():
+            results = [(fn, fn()) for fn in fns]
+            dead = [fn for fn, value in results if value is None]
+            if dead:
+                with self._lock:
+                    self._functions[key] = [fn for fn in self._functions[key] if fn not in dead]
+            alive = [value for _, value in results if value is not None]
+            if alive:
+                values[key] = values.get(key, 0) + sum(alive)
+        return [('', dict(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+    def _key(self, labels:dict) -> tuple:
+        return tuple([labels[name] for name in self.labelnames])
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount:float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount:float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    """固定分桶的直方图，observe() 只做一次二分查找和三次加法。"""
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name:str, help:str='', labelnames:tuple=(), buckets:tuple=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = {key: ([*counts[0]], counts[1], counts[2]) for key, counts in self._values.items()}
+
+        ls = []
+        for key, (buckets, total, count) in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float('inf')), buckets):
+                cumulative += n
+                ls.append(('_bucket', dict(labels, le='+Inf' if bound == float('inf') else repr(bound)), cumulative))
+            ls.append(('_sum', labels, total))
+            ls.append(('_count', labels, count))
+        return ls
+
+    def quantile(self, q:float, **labels) -> float:
+        """按分桶估计分位数（返回所在桶的上界），没有数据时返回 None 。"""
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            if counts is None or counts[2] == 0:
+                return None
+            buckets, count = [*counts[0]], counts[2]
+        rank, cumulative = q * count, 0
+        for bound, n in zip((*self.buckets, float('inf')), buckets):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+
+
+class MetricsRegistry:
+    """指标注册表。同名的指标只创建一次，各模块可以在导入时声明自己的指标。
+
+    * to_prometheus() ：Prometheus 文本格式。
+    * snapshot() ：JSON 可序列化的快照，直方图给出 count 、sum 和 p50 / p99（按分桶估计）。
+    * serve() ：在后台线程中提供 HTTP 接口，`/metrics` 为 Prometheus 文本，`/metrics.json` 为快照。
+    * start_snapshot() ：每隔 interval 秒将快照追加到文件（JSON Lines）。
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopped = threading.Event()
+
+    def counter(self, name:str, help:str='', labelnames:tuple=()) -> Counter:
+        return self.__get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name:str, help:str='', labelnames:tuple=()) -> Gauge:
+        return self.__get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name:str, help:str='', labelnames:tuple=(), buckets:tuple=Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self.__get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def get(self, name:str):
+        return self._metrics.get(name)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, value in metric.samples():
+                label_str = ','.join([f'{k}="{self.__escape(v)}"' for k, v in labels.items()])
+                lines.append(f'{metric.name}{suffix}{{{label_str}}} {float(value)!r}' if label_str else f'{metric.name}{suffix} {float(value)!r}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        result = {}
+        for metric in list(self._metrics.values()):
+            if isinstance(metric, Histogram):
+                samples = {}
+                for suffix, labels, value in metric.samples():
+                    if suffix == '_bucket':
+                        continue
+                    sample = samples.setdefault(tuple(labels.items()), dict(labels=labels))
+                    sample[suffix[1:]] = round(value, 6)
+                for sample in samples.values():
+                    for name, q in (('p50', 0.5), ('p99', 0.99)):
+                        bound = metric.quantile(q, **sample['labels'])
+                        sample[name] = '+Inf' if bound == float('inf') else bound
+                result[metric.name] = list(samples.values())
+            else:
+                result[metric.name] = [dict(labels=labels, value=value) for _, labels, value in metric.samples()]
+        return result
+
+    def serve(self, port:int=9100, host:str='0.0.0.0'):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = registry.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(registry.snapshot(), default=str).encode('utf-8'), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+        thread.start()
+        return server
+
+    def start_snapshot(self, path:str, interval:float=60):
+        def loop():
+            while not self._stopped.wait(interval):
+                self.write_snapshot(path)
+
+        thread = threading.Thread(target=loop, name='metrics-snapshot', daemon=True)
+        thread.start()
+        self._threads.append((thread, path))
+
+    def write_snapshot(self, path:str):
+        record = dict(time=Datetime.now().strftime('%Y-%m-%d %H:%M:%S'), metrics=self.snapshot())
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+    def stop(self):
+        """停止定期快照，并写入最后一次快照。"""
+        self._stopped.set()
+        for thread, path in self._threads:
+            thread.join()
+            self.write_snapshot(path)
+        self._threads = []
+
+    def __get_or_create(self, cls, name, help, labelnames, **keyword):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **keyword)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'Metric "{name}" is already registered with a different type or labels.')
+            return metric
+
+    @staticmethod
+    def __escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = MetricsRegistry()
+
+# 各阶段的耗时，由 iproxy 和 handler 记录
+STAGE_SECONDS = REGISTRY.histogram('proxy_pipeline_stage_seconds', 'Time spent per proxy (or per batch for flush) in each stage.', ('stage',))
+
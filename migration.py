@@ -0,0 +1,152 @@
+import os, re, sys
+from datetime import datetime as Datetime
+from database import MySQLOperation
+from util import trim_margin
+
+
+class Migration:
+    """数据库结构的版本管理。
+
+    迁移脚本位于 SQL/migrations 目录，文件名为 `V<版本号>__<名称>.sql` ，按版本号从小到大执行，
+    已执行的版本记录在 schema_version 表中。全新的数据库先执行 SQL/create_tables.sql（版本 0），再执行 upgrade() 。
+    """
+    _SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SQL')
+    _MIGRATION_DIR = os.path.join(_SQL_DIR, 'migrations')
+    _FILE_PATTERN = re.compile(r'^V(\d+)__(\w+)\.sql$')
+
+    def __init__(self, logger=None):
+        self._logger = logger
+
+    def migrations(self) -> list:
+        """返回 [(版本号, 名称, 文件路径), ...] ，按版本号排序。"""
+        ls = []
+        for filename in os.listdir(self._MIGRATION_DIR):
+            match = self._FILE_PATTERN.match(filename)
+            if match:
+                ls.append((int(match.group(1)), match.group(2), os.path.join(self._MIGRATION_DIR, filename)))
+        return sorted(ls)
+
+    def current_version(self) -> int:
+        self.__ensure_version_table()
+        rows = MySQLOperation.fetchall('select max(version) from schema_version;')
+        return rows[0][0] or 0
+
+    def pending(self) -> list:
+        version = self.current_version()
+        return [m for m in self.migrations() if m[0] > version]
+
+    def upgrade(self, target:int=None) -> int:
+        """执行所有未执行（且版本号不大于 target）的迁移脚本，返回升级后的版本号。"""
+        version = self.current_version()
+        for v, name, path in self.pending():
+            if target is not None and v > target:
+                break
+            self.__log(f'Migration: applying V{v:03d}__{name}.')
+            self.execute_script(path)
+            MySQLOperation.execute(
+                'insert into schema_version(version, name, applied_time) values (%s, %s, %s);',
+                (v, name, Datetime.now().replace(microsecond=0)),
+            )
+            version = v
+        return version
+
+    def execute_script(self, path:str):
+        with open(path, encoding='utf-8') as f:
+            script = f.read()
+        for statement in re.split(r';\s*(?:\n|$)', script):
+            lines = [l for l in statement.strip().split('\n') if l.strip() and not l.strip().startswith('--')]
+            if lines:
+                MySQLOperation.execute('\n'.join(lines) + ';')
+
+    def partition_test_log(self, months_ahead:int=3):
+        """按月对 test_log 进行范围分区（可选），并预建未来 months_ahead 个月的分区。
+
+        分区表的每个唯一键都必须包含分区列，因此主键会改为 (id, test_time) ，test_time 为空的记录会以 job_time 补齐。
+        已分区时只补充新的月份分区，可以定期执行。
+        """
+        now = Datetime.now()
+        last = self.__add_months(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0), months_ahead)
+        existing = MySQLOperation.fetchall('\n'.join((
+            "select partition_name from information_schema.partitions",
+            "where table_schema = database() and table_name = 'test_log' and partition_name is not null;",
+        )))
+
+        if not existing:
+            rows = MySQLOperation.fetchall('select min(test_time) from test_log;')
+            first = (rows[0][0] or now).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            self.__log('Migration: partitioning test_log by month.')
+            MySQLOperation.execute('update test_log set test_time = coalesce(job_time, now()) where test_time is null;')
+            MySQLOperation.execute('alter table test_log modify test_time datetime not null comment \'测试时间\', drop primary key, add primary key (id, test_time);')
+            partitions = [self.__partition(month) for month in self.__months(first, last)]
+            partitions.append('partition pmax values less than (maxvalue)')
+            partitions_sql = ',\n  '.join(partitions)
+            MySQLOperation.execute(f"alter table test_log partition by range columns(test_time) (\n  {partitions_sql}\n);")
+        else:
+            names = {row[0] for row in existing}
+            rows = MySQLOperation.fetchall('\n'.join((
+                "select max(partition_description) from information_schema.partitions",
+                "where table_schema = database() and table_name = 'test_log' and partition_name <> 'pmax';",
+            )))
+            start = Datetime.strptime(rows[0][0].strip("'"), '%Y-%m-%d %H:%M:%S') if rows[0][0] else now
+            months = [m for m in self.__months(start, last) if f'p{m:%Y%m}' not in names]
+            if months:
+                self.__log(f'Migration: adding {len(months)} partitions to test_log.')
+                partitions = [self.__partition(month) for month in months]
+                partitions.append('partition pmax values less than (maxvalue)')
+                partitions_sql = ',\n  '.join(partitions)
+                MySQLOperation.execute(f"alter table test_log reorganize partition pmax into (\n  {partitions_sql}\n);")
+
+    def __ensure_version_table(self):
+        MySQLOperation.execute('\n'.join((
+            "create table if not exists schema_version (",
+            "  version int primary key comment '版本号',",
+            "  name varchar(100) comment '迁移名称',",
+            "  applied_time datetime comment '执行时间'",
+            ");",
+        )))
+
+    def __log(self, msg):
+        print(msg)
+        if self._logger:
+            self._logger.info(msg)
+
+    @staticmethod
+    def __partition(month:Datetime) -> str:
+        upper = Migration.__add_months(month, 1)
+        return f"partition p{month:%Y%m} values less than ('{upper:%Y-%m-%d}')"
+
+    @staticmethod
+    def __months(first:Datetime, last:Datetime) -> list:
+        ls = []
+        month = first
+        while month <= last:
+            ls.append(month)
+            month = Migration.__add_months(month, 1)
+        return ls
+
+    @staticmethod
+    def __add_months(month:Datetime, n:int) -> Datetime:
+        index = month.year * 12 + month.month - 1 + n
+        return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(trim_margin('''
+        |Example:
+        |  $ python migration.py version
+        |  $ python migration.py upgrade
+        |  $ python migration.py upgrade 3
+        |  $ python migration.py partition
+        '''))
+    else:
+        MySQLOperation.init_pool()
+        migration = Migration()
+        if sys.argv[1] == 'version':
+            print(f'Current version: {migration.current_version()}')
+        elif sys.argv[1] == 'upgrade':
+            target = int(sys.argv[2]) if len(sys.argv) > 2 else None
+            print(f'Current version: {migration.upgrade(target)}')
+        elif sys.argv[1] == 'partition':
+            migration.partition_test_log()
+        MySQLOperation.close_pool()
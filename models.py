@@ -3,12 +3,18 @@ from decimal import Decimal
 from datetime import datetime as Datetime
 
 class Field:
-    def __init__(self, primary_key=False):
+    """immutable 为 True 的字段写入后保持不变：upsert 时主键重复的记录不更新该字段（如代理的入池时间）。"""
+
+    def __init__(self, primary_key=False, immutable=False):
         self._is_primary_key = primary_key
+        self._is_immutable = immutable
 
     def to_sql(self, value):
         raise NotImplementedError()
 
+    def to_param(self, value):
+        raise NotImplementedError()
+
 
 class TextField(Field):
     def to_sql(self, value:str):
@@ -18,6 +24,11 @@ class TextField(Field):
             return 'null'
         raise RuntimeError(f'TextField value cannot be of type "{type(value)}", value is "{value}".')
 
+    def to_param(self, value):
+        if isinstance(value, str) or value is None:
+            return value
+        raise RuntimeError(f'TextField value cannot be of type "{type(value)}", value is "{value}".')
+
     # TODO: 新增方法：有效值检查
 
 
@@ -33,6 +44,13 @@ class NumberField(Field):
             return 'null'
         raise RuntimeError(f'NumberField value cannot be of type "{type(value)}", value is "{value}".')
 
+    def to_param(self, value):
+        if isinstance(value, self.__SUPPORT_TYPE) or value is None:
+            return value
+        elif isinstance(value, str) and self.__canConvert(value):
+            return value
+        raise RuntimeError(f'NumberField value cannot be of type "{type(value)}", value is "{value}".')
+
     def __canConvert(self, value):
         for t in self.__SUPPORT_TYPE:
             try:
@@ -51,6 +69,11 @@ class BooleanField(Field):
             return 'null'
         raise RuntimeError(f'BooleanField value cannot be of type "{type(value)}", value is "{value}".')
 
+    def to_param(self, value):
+        if isinstance(value, bool) or value is None:
+            return value
+        raise RuntimeError(f'BooleanField value cannot be of type "{type(value)}", value is "{value}".')
+
 
 class DatetimeField(Field):
     def to_sql(self, value):
@@ -60,17 +83,69 @@ class DatetimeField(Field):
             return 'null'
         raise RuntimeError(f'DatetimeField value cannot be of type "{type(value)}", value is "{value}".')
 
+    def to_param(self, value):
+        if isinstance(value, Datetime):
+            return value.replace(microsecond=0)
+        elif value is None:
+            return None
+        raise RuntimeError(f'DatetimeField value cannot be of type "{type(value)}", value is "{value}".')
 
-class Model:
+
+class BytesField(Field):
+    def to_sql(self, value):
+        if isinstance(value, (bytes, bytearray)):
+            return f"x'{value.hex()}'"
+        elif value is None:
+            return 'null'
+        raise RuntimeError(f'BytesField value cannot be of type "{type(value)}", value is "{value}".')
+
+    def to_param(self, value):
+        if isinstance(value, (bytes, bytearray)) or value is None:
+            return value
+        raise RuntimeError(f'BytesField value cannot be of type "{type(value)}", value is "{value}".')
+
+
+class ModelMeta(type):
+    """模型元类：每个模型类只收集一次字段元数据，并以字段名生成 __slots__ 。"""
+
+    def __new__(mcs, name, bases, namespace):
+        metadata = {}
+        for base in reversed(bases):
+            metadata.update(getattr(base, '_metadata', {}))
+
+        own_fields = [attr for attr, value in namespace.items()
+                      if isinstance(value, Field) and not attr.startswith('_') and not attr.endswith('_')]
+        for attr in own_fields:
+            metadata[attr] = namespace.pop(attr)
+        namespace['__slots__'] = tuple(own_fields)
+        namespace['_metadata'] = metadata
+
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls._fields = tuple(metadata.keys())
+        cls._setters = tuple([getattr(cls, field).__set__ for field in cls._fields])
+        return cls
+
+
+class Model(metaclass=ModelMeta):
     def __init__(self):
-        self._metadata = {}
-        for attr in vars(self.__class__).keys():
-            if not attr.startswith('_') and not attr.endswith('_'):
-                self._metadata[attr] = getattr(self.__class__, attr)
-                setattr(self, attr, None)
-    
+        for setter in self._setters:
+            setter(self, None)
+
+    @classmethod
+    def from_row(cls, row, fields=None):
+        """由数据行构造实体。row 中的值与 fields 一一对应，fields 默认为该模型的全部字段（按定义顺序）。"""
+        entity = cls.__new__(cls)
+        if fields is None:
+            for setter, value in zip(cls._setters, row):
+                setter(entity, value)
+        else:
+            entity.__init__()
+            for field, value in zip(fields, row):
+                setattr(entity, field, value)
+        return entity
+
     def __iter__(self):
-        return iter([(field, getattr(self, field)) for field in self._metadata.keys()])
+        return iter([(field, getattr(self, field)) for field in self._fields])
 
     def __str__(self):
         fields = [f'{field}={value}' for field, value in self]
@@ -84,7 +159,7 @@ class Proxy(Model):
     port = NumberField()
     protocol = TextField()
     local = TextField()
-    collect_time = DatetimeField()
+    collect_time = DatetimeField(immutable=True)
 
 
 class TestLog(Model):
@@ -92,6 +167,7 @@ class TestLog(Model):
     proxy_url = TextField()
     website_name = TextField()
     website_url = TextField()
+    connect_elapsed = NumberField()
     response_elapsed = NumberField()
     transfer_elapsed = NumberField()
     transfer_size = NumberField()
@@ -102,4 +178,13 @@ class TestLog(Model):
     verification_ip = BooleanField()
     response_head = TextField()
     response_body = TextField()
+    response_head_hash = TextField()
+    response_body_hash = TextField()
     exception = TextField()
+
+
+class ResponseContent(Model):
+    content_hash = TextField(primary_key=True)
+    content_size = NumberField()
+    content = BytesField()
+    first_seen = DatetimeField()
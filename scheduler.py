@@ -0,0 +1,208 @@
+import time, heapq, random, threading
+from iproxy import ProxyPool, TokenBucket
+from handler import Handler
+
+
+class ProxySchedulerContext:
+    def __init__(self, job_name, job_time=None, logger=None):
+        self.job_name = job_name
+        self.job_time = job_time
+        self.logger = logger
+
+
+class _ProxyState:
+    __slots__ = ('due', 'seq', 'quality', 'failures', 'last_test')
+
+    def __init__(self, due, seq):
+        self.due = due
+        self.seq = seq
+        self.quality = None
+        self.failures = 0
+        self.last_test = None
+
+
+class _SchedulingHandler(Handler):
+    """包装作业的处理器，处理完验证结果后由调度器重新安排该代理。"""
+
+    def __init__(self, scheduler, handler):
+        super().__init__()
+        self._scheduler = scheduler
+        self._handler = handler
+
+    def handle(self, result:dict):
+        try:
+            self._handler.handle(result)
+        finally:
+            self._scheduler.reschedule(result['proxy'], result['test_logs'])
+
+    def is_decided(self, proxy, test_logs:list, repeat:int) -> bool:
+        is_decided = getattr(self._handler, 'is_decided', None)
+        return is_decided(proxy, test_logs, repeat) if is_decided else len(test_logs) >= repeat
+
+    def close(self):
+        self._handler.close()
+
+
+class ProxyScheduler:
+    """常驻的验证调度器：在优先队列中保存已知的代理，按到期时间依次重新验证。
+
+    * 加载器（loaders）每隔 loader_interval 秒加载一次，新代理立即到期，先于其他代理验证。
+    * 验证后按质量（有效响应的比例，与历史质量取平均）安排下次验证：间隔为 base_interval / 质量，
+      质量越好验证越频繁；没有有效响应时按 backoff 的指数退避（base_interval * backoff ** 连续失败次数），
+      间隔都不超过 max_interval 。连续失败 drop_after 次的代理不再验证（None 表示一直退避下去）。
+    * 每分钟最多发出 budget 次验证请求（每个代理按 repeat * 验证器数量 计算），通过令牌桶平滑。
+    * seed() 加入已知的代理（如数据库中的代理），到期时间在 base_interval 内随机分布，避免同时到期。
+
+    验证使用 ProxyPool.verify() ，handler 与一次性作业的处理器相同。run() 一直运行，直到调用 stop() ；
+    进度每验证 report_every 个代理报告一次，各阶段的耗时见 metrics 模块。
+    """
+
+    def __init__(self, validator, handler, loaders=(), budget:int=600, repeat:int=1, concurrency:int=10,
+            base_interval:float=600, max_interval:float=86400, backoff:float=2, drop_after:int=None,
+            loader_interval:float=600, report_every:int=1000, context:ProxySchedulerContext=None):
+        self._validators = ProxyPool._validators(validator)
+        self._handler = handler
+        self._loaders = list(loaders)
+        self._repeat = repeat
+        self._concurrency = concurrency
+        self._base_interval = base_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._drop_after = drop_after
+        self._loader_interval = loader_interval
+        self._report_every = report_every
+        self._context = context
+
+        self._cost = repeat * len(self._validators)
+        self._bucket = TokenBucket(budget / 60, burst=self._cost)
+        self._pool = ProxyPool()
+        self._states = {}
+        self._queue = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._stats = dict(verified=0, requests=0, dropped=0)
+
+    def seed(self, proxies) -> int:
+        """加入已知的代理，返回新加入的数量。"""
+        now = time.time()
+        return self.__add(proxies, lambda: now + random.uniform(0, self._base_interval))
+
+    def add(self, proxies) -> int:
+        """加入新代理（立即到期），返回新加入的数量。已知的代理只更新数据，不改变其到期时间。"""
+        return self.__add(proxies, lambda: 0)
+
+    def reschedule(self, proxy, test_logs:list):
+        """根据验证结果安排下次验证。"""
+        valid = [tl for tl in test_logs if tl.transfer_size and tl.transfer_size > 0]
+        quality = len(valid) / len(test_logs) if test_logs else 0
+        now = time.time()
+        with self._cond:
+            state = self._states.get(proxy.proxy_url)
+            if state is None:
+                return
+            state.last_test = now
+            state.quality = quality if state.quality is None else (state.quality + quality) / 2
+            self._stats['verified'] += 1
+            self._stats['requests'] += len(test_logs)
+
+            if quality == 0:
+                state.failures += 1
+                if self._drop_after is not None and state.failures >= self._drop_after:
+                    # 仍然保留状态，加载器再次加载到该代理时不会重新入队
+                    state.due = float('inf')
+                    self._stats['dropped'] += 1
+                    return
+                interval = self._base_interval * self._backoff ** state.failures
+            else:
+                state.failures = 0
+                interval = self._base_interval / max(state.quality, 0.01)
+            self.__push(proxy.proxy_url, state, now + min(interval, self._max_interval))
+
+    def run(self):
+        self.__log(f'ProxyScheduler: started with {len(self._states)} proxies.')
+        loader_thread = threading.Thread(target=self.__load_loop, daemon=True)
+        loader_thread.start()
+        try:
+            self._pool.verify(
+                validator=self._validators,
+                handler=_SchedulingHandler(self, self._handler),
+                repeat=self._repeat,
+                concurrency=self._concurrency,
+                proxies=self.__due_proxies(),
+                report_every=self._report_every,
+            )
+        except KeyboardInterrupt:
+            # verify() 已经关闭了处理器
+            self.stop()
+        loader_thread.join()
+        self.__log(f'ProxyScheduler: stopped, {self.stats()}.')
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """已知的代理数量、已到期的数量，以及累计验证的代理数、请求数和放弃的代理数。"""
+        now = time.time()
+        with self._cond:
+            due = sum([1 for state in self._states.values() if state.due <= now])
+            return dict(proxies=len(self._states), due=due, **self._stats)
+
+    def __add(self, proxies, due) -> int:
+        """逐个加锁，加载器（如爬虫）边下载边入队时不会阻塞调度。"""
+        count = 0
+        for proxy in proxies:
+            with self._cond:
+                self._pool.add(proxy)
+                if proxy.proxy_url not in self._states:
+                    self.__push(proxy.proxy_url, _ProxyState(None, None), due())
+                    self._cond.notify_all()
+                    count += 1
+        return count
+
+    def __push(self, proxy_url, state, due):
+        """入队。队列中同一代理的旧条目不删除，出队时按 seq 识别并跳过。"""
+        self._seq += 1
+        state.due, state.seq = due, self._seq
+        self._states[proxy_url] = state
+        heapq.heappush(self._queue, (due, self._seq, proxy_url))
+
+    def __due_proxies(self):
+        """按到期时间产出代理，没有到期的代理或预算耗尽时等待。"""
+        while not self._stopped.is_set():
+            with self._cond:
+                if not self._queue:
+                    self._cond.wait(1)
+                    continue
+                due, seq, proxy_url = self._queue[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self._cond.wait(min(delay, 1))
+                    continue
+                heapq.heappop(self._queue)
+                state = self._states.get(proxy_url)
+                if state is None or state.seq != seq:
+                    continue
+                state.due = float('inf')
+                proxy = self._pool.get(proxy_url)
+
+            for _ in range(self._cost):
+                self._bucket.acquire()
+            yield proxy
+
+    def __load_loop(self):
+        while self._loaders and not self._stopped.is_set():
+            for loader in self._loaders:
+                try:
+                    count = self.add(loader.iter_load())
+                    self.__log(f'ProxyScheduler: {count} new proxies from {loader.__class__.__name__}.')
+                except Exception:
+                    if self._context and self._context.logger:
+                        self._context.logger.exception(f'ProxyScheduler: Failed to load proxies from {loader.__class__.__name__}.')
+            self._stopped.wait(self._loader_interval)
+
+    def __log(self, msg):
+        if self._context and self._context.logger:
+            self._context.logger.info(msg)
@@ -0,0 +1,211 @@
+import sys, json, random, asyncio, logging
+from datetime import datetime as Datetime, timedelta as Timedelta
+from iproxy import ProxyPool
+from db_mapper import MySQLMapper
+from util import trim_margin
+
+
+class ProxyIndex:
+    """代理的只读内存索引，按 (protocol, local) 分组，None 表示不限。
+
+    每组预先构建别名表（Walker's alias method），按权重随机选取代理的耗时为 O(1) ；
+    权重为 1 / 平均响应时长，没有统计数据的代理按 default_elapsed 计算。代理的 JSON 也预先序列化。
+    """
+
+    def __init__(self, proxies, elapsed_means:dict=None, default_elapsed:float=5, min_elapsed:float=0.05):
+        elapsed_means = elapsed_means or {}
+        groups = {}
+        for proxy in proxies:
+            elapsed = float(elapsed_means.get(proxy.proxy_url) or default_elapsed)
+            item = (self.__to_json(proxy), 1 / max(elapsed, min_elapsed))
+            for key in ((None, None), (proxy.protocol, None), (None, proxy.local), (proxy.protocol, proxy.local)):
+                groups.setdefault(key, []).append(item)
+
+        self._groups = {key: self.__alias_table(items) for key, items in groups.items()}
+
+    def choice(self, protocol:str=None, local:str=None) -> bytes:
+        """按权重随机选取一个代理，返回其 JSON ；没有符合条件的代理时返回 None 。"""
+        group = self._groups.get((protocol, local))
+        if group is None:
+            return None
+        items, prob, alias = group
+        i = random.randrange(len(items))
+        return items[i] if random.random() < prob[i] else items[alias[i]]
+
+    def sample(self, num:int, protocol:str=None, local:str=None) -> list:
+        """按权重随机选取至多 num 个不同的代理。"""
+        group = self._groups.get((protocol, local))
+        if group is None:
+            return []
+        num = min(num, len(group[0]))
+        chosen = {}
+        for _ in range(num * 4):
+            item = self.choice(protocol, local)
+            chosen[item] = None
+            if len(chosen) >= num:
+                break
+        return list(chosen)
+
+    def count(self, protocol:str=None, local:str=None) -> int:
+        group = self._groups.get((protocol, local))
+        return len(group[0]) if group else 0
+
+    @staticmethod
+    def __alias_table(items:list) -> tuple:
+        n = len(items)
+        total = sum([weight for _, weight in items])
+        scaled = [weight * n / total for _, weight in items]
+        prob, alias = [1.0] * n, list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        return [data for data, _ in items], prob, alias
+
+    @staticmethod
+    def __to_json(proxy) -> bytes:
+        return json.dumps(dict(proxy), cls=ProxyPool.ModelJsonEncoder, ensure_ascii=False).encode('utf-8')
+
+
+class ProxyServerContext:
+    def __init__(self, job_name, job_time=None, logger=None):
+        self.job_name = job_name
+        self.job_time = job_time
+        self.logger = logger
+
+
+class ProxyServer:
+    """常驻的代理服务，在内存中保存达标的代理，并通过 HTTP 提供：
+
+    * `GET /proxy?protocol=&local=` ：按平均响应时长加权随机返回一个代理。
+    * `GET /proxies?protocol=&local=&num=10` ：返回至多 num 个不同的代理。
+    * `GET /stats` ：代理数量和最近一次刷新的时间。
+    * `GET /metrics` ：本进程的指标（Prometheus 文本格式），见 metrics 模块。
+
+    每隔 refresh_interval 秒通过 loader 重新加载代理（在线程池中执行，不阻塞请求；None 表示不自动刷新，可调用 update()），
+    平均响应时长取自 proxy_stats 表最近 elapsed_timedelta 内的有效响应。需要安装 aiohttp 。
+    """
+
+    def __init__(self, loader, host:str='0.0.0.0', port:int=8000, refresh_interval:float=60,
+            elapsed_timedelta:Timedelta=Timedelta(days=1), context:ProxyServerContext=None):
+        self._loader = loader
+        self._host = host
+        self._port = port
+        self._refresh_interval = refresh_interval
+        self._elapsed_timedelta = elapsed_timedelta
+        self._context = context
+        self._index = ProxyIndex([])
+        self._refresh_time = None
+
+    def refresh(self):
+        """重新加载代理并替换索引。替换只是一次赋值，进行中的请求仍使用旧索引。"""
+        pool = ProxyPool()
+        pool.load(self._loader)
+        self.update(pool, MySQLMapper.find_response_elapsed_means(self._elapsed_timedelta))
+        self.__log(f'ProxyServer: {len(pool)} proxies loaded.')
+
+    def update(self, proxies, elapsed_means:dict=None):
+        self._index = ProxyIndex(proxies, elapsed_means)
+        self._refresh_time = Datetime.now()
+
+    def app(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get('/proxy', self._handle_proxy)
+        app.router.add_get('/proxies', self._handle_proxies)
+        app.router.add_get('/stats', self._handle_stats)
+        app.router.add_get('/metrics', self._handle_metrics)
+        app.on_startup.append(self._start_refresh)
+        app.on_cleanup.append(self._stop_refresh)
+        return app
+
+    def run(self):
+        from aiohttp import web
+        web.run_app(self.app(), host=self._host, port=self._port, access_log=None)
+
+    async def _handle_proxy(self, request):
+        from aiohttp import web
+
+        body = self._index.choice(request.query.get('protocol'), request.query.get('local'))
+        if body is None:
+            return web.Response(status=404, body=b'{"error": "no proxy"}', content_type='application/json')
+        return web.Response(body=body, content_type='application/json')
+
+    async def _handle_proxies(self, request):
+        from aiohttp import web
+
+        try:
+            num = int(request.query.get('num', 10))
+        except ValueError:
+            return web.Response(status=400, body=b'{"error": "invalid num"}', content_type='application/json')
+        items = self._index.sample(num, request.query.get('protocol'), request.query.get('local'))
+        return web.Response(body=b'[' + b','.join(items) + b']', content_type='application/json')
+
+    async def _handle_stats(self, request):
+        from aiohttp import web
+
+        refresh_time = self._refresh_time.strftime('%Y-%m-%d %H:%M:%S') if self._refresh_time else None
+        return web.json_response(dict(count=self._index.count(), refresh_time=refresh_time))
+
+    async def _handle_metrics(self, request):
+        from aiohttp import web
+        from metrics import REGISTRY
+
+        return web.Response(text=REGISTRY.to_prometheus(), content_type='text/plain')
+
+    async def _start_refresh(self, app):
+        if self._refresh_interval is not None:
+            app['refresh_task'] = asyncio.ensure_future(self.__refresh_loop())
+
+    async def _stop_refresh(self, app):
+        if 'refresh_task' in app:
+            app['refresh_task'].cancel()
+
+    async def __refresh_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.refresh)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if self._context and self._context.logger:
+                    self._context.logger.exception('ProxyServer: Failed to refresh proxies.')
+            await asyncio.sleep(self._refresh_interval)
+
+    def __log(self, msg):
+        print(msg)
+        if self._context and self._context.logger:
+            self._context.logger.info(msg)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'start':
+        print(trim_margin('''
+        |Example:
+        |  $ python server.py start
+        |  $ python server.py start 8000
+        '''))
+    else:
+        from database import MySQLOperation
+        from filter import SimpleProxyTestFilter
+        from iproxy import SimpleMySQLProxyLoder
+
+        ptf = SimpleProxyTestFilter(
+            timeout_exception_pr=0.34,
+            proxy_exception_pr=0.34,
+            valid_responses_pr=1,
+            pre_tested_timedelta=Timedelta(days=1),
+            pre_verification_ip=True,
+        )
+        logging.basicConfig(level=logging.INFO, format='> %(asctime)s | %(name)s | %(levelname)s | %(message)s')
+        context = ProxyServerContext('server', logger=logging.getLogger('server'))
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+
+        MySQLOperation.init_pool()
+        ProxyServer(SimpleMySQLProxyLoder(ptf, from_stats=True), port=port, context=context).run()
+        MySQLOperation.close_pool()
@@ -0,0 +1,19 @@
+import os, sys
+from datetime import datetime as Datetime
+
+import pytest
+
+# 项目的模块位于仓库根目录（如 from iproxy import ProxyPool）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_proxy():
+    """构造代理：make_proxy(i) 为 http://10.0.0.<i>:80 ，也可以指定 ip 、port 、protocol 和 local 。"""
+    import models
+
+    def make(i:int=1, protocol:str='http', ip:str=None, port:int=80, local:str='home'):
+        ip = ip or f'10.0.0.{i}'
+        return models.Proxy.from_row([f'{protocol}://{ip}:{port}', ip, port, protocol, local, Datetime(2020, 7, 25, 10, 41, 31)])
+
+    return make
@@ -0,0 +1,156 @@
+import struct
+
+import pytest
+import pymysql
+from database import MySQLOperation
+
+
+def mysql_error(code:int, message:str='') -> Exception:
+    """按 pymysql 解析服务端错误包的方式构造异常（与真实连接上的异常类型一致）。"""
+    packet = b'\xff' + struct.pack('<h', code) + b'#HY000' + message.encode('utf-8')
+    try:
+        pymysql.err.raise_mysql_exception(packet)
+    except pymysql.err.Error as e:
+        return e
+
+
+@pytest.mark.parametrize('code, kind', [
+    (1213, 'transient'),    # Deadlock found
+    (1205, 'transient'),    # Lock wait timeout
+    (1054, 'fatal'),        # Unknown column（未执行迁移）
+    (1045, 'fatal'),        # Access denied
+    (1146, 'fatal'),        # Table doesn't exist
+    (1062, 'row'),          # Duplicate entry
+    (1406, 'row'),          # Data too long
+])
+def test_classify_error(code, kind):
+    assert MySQLOperation.classify_error(mysql_error(code)) == kind
+
+
+def test_classify_connection_errors():
+    assert MySQLOperation.classify_error(pymysql.err.InterfaceError(0, '')) == 'transient'
+    assert MySQLOperation.classify_error(ConnectionResetError()) == 'transient'
+
+
+class _RecordingConnection:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def cursor(self, *args):
+        calls = self.calls
+
+        class Cursor:
+            description = (('proxy_url',),)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                pass
+
+            def execute(self, sql, params=None):
+                calls.append('execute')
+
+            def fetchall(self):
+                return ()
+
+        return Cursor()
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def close(self):
+        self.calls.append('close')
+
+
+class _RecordingPool:
+    def __init__(self):
+        self.calls = []
+
+    def connection(self):
+        return _RecordingConnection(self.calls)
+
+
+def test_reads_end_their_transaction(monkeypatch):
+    """只读的查询也要提交后再归还连接，否则连接会停留在旧的快照上。"""
+    import models
+
+    pool = _RecordingPool()
+    monkeypatch.setattr(MySQLOperation, '_POOL', pool)
+    MySQLOperation.fetchall('select 1;')
+    MySQLOperation.query('select proxy_url from proxy;', models.Proxy)
+    assert pool.calls == ['execute', 'commit', 'close'] * 2
+
+
+@pytest.fixture
+def mysql_pool(monkeypatch):
+    """只有一个连接的连接池，连接不上 Config.database 时跳过。"""
+    from dbutils.pooled_db import PooledDB
+    from config import Config
+
+    config = dict(Config.database, mincached=1, maxcached=1, maxshared=0, maxconnections=1, blocking=True)
+    try:
+        pool = PooledDB(creator=pymysql, **config)
+        pool.connection().close()
+    except pymysql.err.Error as e:
+        pytest.skip(f'MySQL is not available: {e!r}')
+    monkeypatch.setattr(MySQLOperation, '_POOL', pool)
+    yield config
+    pool.close()
+
+
+def test_reads_see_concurrent_commits(mysql_pool):
+    config = {k: v for k, v in mysql_pool.items() if k in ('host', 'port', 'user', 'password', 'db', 'charset')}
+    writer = pymysql.connect(**config)
+    try:
+        with writer.cursor() as cursor:
+            cursor.execute('create table test_read_snapshot (id int primary key);')
+        writer.commit()
+
+        assert MySQLOperation.fetchall('select count(*) from test_read_snapshot;')[0][0] == 0
+        with writer.cursor() as cursor:
+            cursor.execute('insert into test_read_snapshot values (1);')
+        writer.commit()
+        # 连接池中唯一的连接被再次使用，应当看到另一个连接提交的数据
+        assert MySQLOperation.fetchall('select count(*) from test_read_snapshot;')[0][0] == 1
+    finally:
+        with writer.cursor() as cursor:
+            cursor.execute('drop table if exists test_read_snapshot;')
+        writer.close()
+
+
+def test_upsert_keeps_primary_key_and_collect_time():
+    import models
+
+    sql = MySQLOperation.on_duplicate_substament(models.Proxy)
+    updates = sql.split('update', 1)[1]
+    assert 'ip = values(ip)' in updates and 'local = values(local)' in updates
+    assert 'proxy_url' not in updates
+    assert 'collect_time' not in updates
+
+
+def test_load_data_writes_bytes_as_hex(monkeypatch):
+    import models
+
+    calls = []
+
+    def execute(sql, params=None):
+        with open(params[0], encoding='utf-8') as f:
+            calls.append((sql, f.read()))
+        return 1
+
+    monkeypatch.setattr(MySQLOperation, 'execute', execute)
+    content = models.ResponseContent.from_row(['abc', 3, b'\x00\t\n\\\xff', None])
+    MySQLOperation.batch_insert([content], method='load_data')
+
+    sql, data = calls[0]
+    assert data == 'abc\t3\t00090a5cff\t\\N\n'
+    assert '(content_hash, content_size, @content, first_seen)' in sql
+    assert 'set content = unhex(@content);' in sql
+
+
+def test_test_log_inserter_rejects_upsert():
+    from handler import MySQLTestLogInserter
+
+    with pytest.raises(ValueError):
+        MySQLTestLogInserter(buffer_size=10, concurrency=1, upsert=True)
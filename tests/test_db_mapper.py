@@ -0,0 +1,15 @@
+import pymysql.cursors
+import database
+from db_mapper import MySQLMapper
+
+
+def test_enqueue_verify_leases_is_a_multi_row_insert(monkeypatch, make_proxy):
+    """values 中只有占位符时，pymysql 的 executemany 才会合并为一条多行 insert 语句。"""
+    calls = []
+    monkeypatch.setattr(database.MySQLOperation, 'executemany', lambda sql, params_list: calls.append((sql, params_list)) or len(params_list))
+    proxies = [make_proxy(i) for i in range(3)]
+
+    assert MySQLMapper.enqueue_verify_leases('run', 'home', proxies) == 3
+    sql, params_list = calls[0]
+    assert pymysql.cursors.RE_INSERT_VALUES.match(sql)
+    assert all([len(params) == sql.count('%s') for params in params_list])
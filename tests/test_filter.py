@@ -0,0 +1,51 @@
+from datetime import datetime as Datetime, timedelta as Timedelta
+import models
+from filter import SimpleProxyTestFilter
+
+
+def make_test_log(website_name, verification_ip, transfer_size=100):
+    tl = models.TestLog()
+    tl.proxy_url = 'http://10.0.0.1:80'
+    tl.website_name = website_name
+    tl.response_elapsed = 1
+    tl.transfer_elapsed = 1
+    tl.transfer_size = transfer_size
+    tl.timeout_exception = False
+    tl.proxy_exception = False
+    tl.verification_ip = verification_ip
+    tl.test_time = Datetime.now()
+    return tl
+
+
+def make_filter():
+    return SimpleProxyTestFilter(
+        timeout_exception_pr=0.34,
+        proxy_exception_pr=0.34,
+        valid_responses_pr=1,
+        pre_tested_timedelta=Timedelta(days=1),
+        pre_verification_ip=True,
+    )
+
+
+def test_is_decided_mixed_validators_keyword_log_first(make_proxy):
+    """关键字验证器（verification_ip=False）的结果先到达时，不能据此提前判定失败。"""
+    ptf, proxy = make_filter(), make_proxy()
+    keyword_log = make_test_log('keyword', verification_ip=False)
+    ip_logs = [make_test_log('ip138', verification_ip=True) for _ in range(3)]
+
+    assert not ptf.is_decided(proxy, [keyword_log], 4)
+    assert not ptf.is_decided(proxy, [keyword_log] + ip_logs[:2], 4)
+    assert ptf.assess(proxy, [keyword_log] + ip_logs)
+
+
+def test_is_decided_when_remaining_checks_cannot_pass(make_proxy):
+    ptf, proxy = make_filter(), make_proxy()
+    failed = make_test_log('ip138', verification_ip=True, transfer_size=0)
+
+    assert ptf.is_decided(proxy, [failed], 3)
+    assert not ptf.assess(proxy, [failed] + [make_test_log('ip138', verification_ip=True)] * 2)
+
+
+def test_is_decided_after_all_checks(make_proxy):
+    ptf, proxy = make_filter(), make_proxy()
+    assert ptf.is_decided(proxy, [make_test_log('ip138', verification_ip=True)] * 3, 3)
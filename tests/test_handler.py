@@ -0,0 +1,40 @@
+import pytest
+from handler import StreamHandler
+
+
+class _FailingHandler(StreamHandler):
+    def __init__(self, error, **keyword):
+        super().__init__(buffer_size=5, concurrency=1, retry_backoff=0, **keyword)
+        self.error = error
+        self.calls = 0
+
+    def batch_handle(self, data_list:list):
+        self.calls += 1
+        raise self.error
+
+    def _classify_error(self, e:Exception) -> str:
+        return e.args[0]
+
+
+def test_row_error_isolates_each_row():
+    h = _FailingHandler(ValueError('row'))
+    for i in range(5):
+        h.handle(i)
+    h.close()
+
+    assert h.calls == 6
+    assert h.stats()['isolated_rows'] == 5 and h.stats()['dead'] == 5
+
+
+def test_fatal_error_stops_handler(tmp_path):
+    path = tmp_path / 'dead_letter.jsonl'
+    h = _FailingHandler(ValueError('fatal'), dead_letter_path=str(path))
+    for i in range(5):
+        h.handle(i)
+    h._executor.shutdown(True)
+
+    with pytest.raises(RuntimeError, match='fatal error'):
+        h.handle(5)
+    assert h.calls == 1
+    assert h.stats()['dead'] == 6
+    assert len(path.read_text(encoding='utf-8').splitlines()) == 6
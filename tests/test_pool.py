@@ -0,0 +1,91 @@
+import contextlib
+
+import pytest
+from iproxy import ProxyPool, ProxyValidator
+
+
+class _StubValidator(ProxyValidator):
+    """不发出请求，直接返回有效的测试日志。"""
+
+    def __init__(self):
+        super().__init__('stub', 'http://example.invalid/', None, timeout=5)
+
+    def new_session(self):
+        return contextlib.nullcontext()
+
+    def new_asession(self, **kwargs):
+        return contextlib.nullcontext()
+
+    def verify(self, proxy, session=None):
+        tl = self._new_test_log(proxy)
+        tl.transfer_size = 1
+        return tl
+
+    async def averify(self, proxy, session):
+        return self.verify(proxy)
+
+
+class _RecordingHandler:
+    def __init__(self):
+        self.handled = []
+        self.closed = False
+
+    def handle(self, data):
+        self.handled.append(data['proxy'].proxy_url)
+
+    def close(self):
+        self.closed = True
+
+
+def failing_loader(proxies):
+    yield from proxies
+    raise RuntimeError('loader failed')
+
+
+@pytest.mark.parametrize('method', ['verify', 'averify'])
+def test_handler_closed_when_loader_fails(method, make_proxy):
+    handler = _RecordingHandler()
+    with pytest.raises(RuntimeError, match='loader failed'):
+        getattr(ProxyPool(), method)(_StubValidator(), handler, proxies=failing_loader([make_proxy(i) for i in range(3)]), concurrency=2)
+
+    assert handler.closed
+    assert len(handler.handled) <= 3
+
+
+@pytest.mark.parametrize('method', ['verify', 'averify'])
+def test_handler_closed_after_success(method, make_proxy):
+    handler = _RecordingHandler()
+    proxies = [make_proxy(i) for i in range(3)]
+    getattr(ProxyPool(), method)(_StubValidator(), handler, proxies=proxies, concurrency=2)
+
+    assert handler.closed
+    assert sorted(handler.handled) == [p.proxy_url for p in proxies]
+
+
+def test_averify_blocking_handler_does_not_block_event_loop(make_proxy):
+    """handler 阻塞时（如 StreamHandler 的队列已满），其他代理的验证仍在事件循环中继续。"""
+    import time, threading
+
+    class SlowHandler(_RecordingHandler):
+        def handle(self, data):
+            assert threading.current_thread() is not threading.main_thread()
+            time.sleep(0.3)
+            super().handle(data)
+
+    handler = SlowHandler()
+    start = time.perf_counter()
+    ProxyPool().averify(_StubValidator(), handler, proxies=[make_proxy(i) for i in range(4)], concurrency=4)
+
+    assert len(handler.handled) == 4
+    assert time.perf_counter() - start < 1.0
+
+
+def test_mysql_loaders_keep_positional_context():
+    """新增的参数位于 context 之后，旧的按位置传参方式不受影响。"""
+    from iproxy import MySQLProxyLoader, SimpleMySQLProxyLoder, ProxyLoaderContext
+    from filter import SimpleProxyTestFilter
+
+    ctx = ProxyLoaderContext('test')
+    assert MySQLProxyLoader(ctx)._context is ctx
+    loader = SimpleMySQLProxyLoder(SimpleProxyTestFilter(), ctx)
+    assert loader._context is ctx and loader._chunk_size == 1000 and loader._from_stats is False
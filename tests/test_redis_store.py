@@ -0,0 +1,102 @@
+import pytest
+import iproxy
+from iproxy import RedisProxyStore
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可以拨动的 time.time() ，RedisProxyStore 按它计算过期时间。"""
+    now = [1_600_000_000.0]
+    monkeypatch.setattr(iproxy.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def store():
+    return RedisProxyStore(fakeredis.FakeRedis(), key='test', ttl=60)
+
+
+def test_top_orders_by_score(store, make_proxy):
+    store.update([(make_proxy(1), 3.0), (make_proxy(2), 1.0), (make_proxy(3), 2.0), (make_proxy(4, 'https'), 0.5)])
+
+    assert [p['proxy_url'] for p in store.top(3)] == ['https://10.0.0.4:80', 'http://10.0.0.2:80', 'http://10.0.0.3:80']
+    assert [p['proxy_url'] for p in store.top(10, protocol='http')] == ['http://10.0.0.2:80', 'http://10.0.0.3:80', 'http://10.0.0.1:80']
+    assert [p['proxy_url'] for p in store.top(10, protocol='https')] == ['https://10.0.0.4:80']
+
+
+def test_update_replaces_score_and_fields(store, make_proxy):
+    store.update([(make_proxy(1), 1.0), (make_proxy(2), 2.0)])
+    proxy = make_proxy(1)
+    proxy.local = 'office'
+    store.update([(proxy, 5.0)])
+
+    top = store.top(10)
+    assert [p['proxy_url'] for p in top] == ['http://10.0.0.2:80', 'http://10.0.0.1:80']
+    assert top[1] == dict(proxy_url='http://10.0.0.1:80', ip='10.0.0.1', port='80', protocol='http', local='office', collect_time='2020-07-25 10:41:31')
+
+
+def test_purge_expired(store, clock, make_proxy):
+    store.update([(make_proxy(1), 1.0)])
+    clock[0] += 30
+    store.update([(make_proxy(2), 2.0)])
+
+    # 只有 10.0.0.1 超过了 ttl
+    clock[0] += 40
+    assert store.purge_expired() == 1
+    assert [p['proxy_url'] for p in store.top(10)] == ['http://10.0.0.2:80']
+    assert [p['proxy_url'] for p in store.top(10, protocol='http')] == ['http://10.0.0.2:80']
+
+    # 刷新后重新计算过期时间
+    store.update([(make_proxy(2), 2.0)])
+    clock[0] += 40
+    assert store.purge_expired() == 0
+    assert [p['proxy_url'] for p in store.top(10)] == ['http://10.0.0.2:80']
+
+
+def test_remove(store, make_proxy):
+    store.update([(make_proxy(1), 1.0), (make_proxy(2, 'https'), 2.0)])
+
+    assert store.remove(['https://10.0.0.2:80']) == 1
+    assert [p['proxy_url'] for p in store.top(10)] == ['http://10.0.0.1:80']
+    assert store.top(10, protocol='https') == []
+
+
+def test_sorted_sets_expire(store, make_proxy):
+    store.update([(make_proxy(1), 1.0), (make_proxy(2, 'https'), 2.0)])
+    client = store._client
+
+    for name in ('test:all', 'test:expire', 'test:protocols', 'test:protocol:http', 'test:protocol:https'):
+        assert 0 < client.ttl(name) <= 60
+
+
+def test_top_purges_expired(store, clock, make_proxy):
+    store.update([(make_proxy(1), 1.0), (make_proxy(2), 2.0)])
+    clock[0] += 30
+    store.update([(make_proxy(2), 2.0)])
+
+    # 写入停止后，读取时也会清理过期的成员
+    clock[0] += 40
+    assert [p['proxy_url'] for p in store.top(10, protocol='http')] == ['http://10.0.0.2:80']
+    assert store._client.zrange('test:protocol:http', 0, -1) == [b'http://10.0.0.2:80']
+
+
+def test_to_redis_scores_by_response_elapsed(monkeypatch, make_proxy):
+    import redis
+    from iproxy import ProxyPool
+    from db_mapper import MySQLMapper
+
+    client = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(redis, 'StrictRedis', lambda **conn_config: client)
+    monkeypatch.setattr(MySQLMapper, 'find_response_elapsed_means', staticmethod(lambda pre_tested_timedelta=None: {
+        'http://10.0.0.1:80': 2.5, 'http://10.0.0.2:80': 0.5,
+    }))
+    pool = ProxyPool()
+    for i in (1, 2, 3):
+        pool.add(make_proxy(i))
+    pool.to_redis({}, 'test', 60)
+
+    assert client.zrange('test:protocol:http', 0, -1, withscores=True) == [
+        (b'http://10.0.0.2:80', 0.5), (b'http://10.0.0.1:80', 2.5), (b'http://10.0.0.3:80', 60.0),
+    ]
@@ -0,0 +1,77 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from iproxy import KeywordValidator
+
+
+class _LocalProxy:
+    """本地的 HTTP 代理，对任何请求都返回 body ，Content-Type 为 content_type 。"""
+
+    def __init__(self, body:bytes, content_type:str):
+        body_, content_type_ = body, content_type
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type_)
+                self.send_header('Content-Length', str(len(body_)))
+                self.end_headers()
+                self.wfile.write(body_)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def local_proxy(make_proxy):
+    proxies = []
+
+    def start(body, content_type):
+        proxies.append(_LocalProxy(body, content_type))
+        return make_proxy(ip='127.0.0.1', port=proxies[-1].port)
+
+    yield start
+    for p in proxies:
+        p.close()
+
+
+def new_validator(kw):
+    return KeywordValidator('test', 'http://example.invalid/', None, kw=kw, timeout=5)
+
+
+def test_non_ascii_keyword_with_latin1_response(local_proxy):
+    """text/* 没有 charset 时按 ISO-8859-1 解码，无法编码的关键词不能被截断后提前匹配。"""
+    proxy = local_proxy(b'please login now', 'text/html')
+    tl = new_validator('login 登录').verify(proxy)
+
+    assert tl.exception is None
+    assert tl.proxy_exception is True
+    assert tl.response_body == 'please login now'
+
+
+def test_non_ascii_keyword_with_utf8_response(local_proxy):
+    proxy = local_proxy('请 login 登录 后继续'.encode('utf-8'), 'text/html; charset=utf-8')
+    tl = new_validator('login 登录').verify(proxy)
+
+    assert tl.exception is None
+    assert tl.proxy_exception is False
+
+
+def test_new_reader_skips_unencodable_needles(make_proxy):
+    proxy = make_proxy()
+    validator = new_validator('login 登录')
+
+    assert validator._new_reader(proxy, 'ISO-8859-1').needles == ()
+    assert validator._new_reader(proxy, 'utf-8').needles == ('login 登录'.encode('utf-8'),)